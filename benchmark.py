@@ -0,0 +1,157 @@
+#!/usr/bin/env python2
+import sys
+import json
+import argparse
+from gdg import bench
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmarks parts of the gallery.")
+    parser.add_argument('--json', metavar='FILE', help="also write the results to FILE as JSON")
+    commands = parser.add_subparsers(dest='command')
+
+    thumbs = commands.add_parser('thumbnails', help="full decoding against draft mode on large JPEGs")
+    thumbs.add_argument('--count', type=int, default=10)
+    thumbs.add_argument('--width', type=int, default=7728)
+    thumbs.add_argument('--height', type=int, default=5152)
+    thumbs.add_argument('--aspect-ratio', default="square", choices=["square", "top_square", "proportional"])
+
+    connections = commands.add_parser('connections', help="a connection per request against one per thread, under load")
+    connections.add_argument('--count', type=int, default=2000, help="images in the generated library")
+    connections.add_argument('--threads', type=int, default=10)
+    connections.add_argument('--requests', type=int, default=200, help="requests per thread")
+
+    pages = commands.add_parser('pages', help="rendering gallery pages, and the filesystem calls it takes")
+    pages.add_argument('--count', type=int, default=2000, help="images in the generated library")
+    pages.add_argument('--page-size', type=int, default=100)
+    pages.add_argument('--pages', type=int, default=200, help="pages rendered")
+
+    plans = commands.add_parser('plans', help="checks that the hot queries use an index, and that old databases upgrade")
+    plans.add_argument('--count', type=int, default=2000, help="images in the generated library")
+
+    names = commands.add_parser('names', help="the name index against a regex on every row")
+    names.add_argument('--count', type=int, default=100000, help="images in the generated library")
+    names.add_argument('--queries', type=int, default=200)
+
+    lev = commands.add_parser('levenshtein', help="the fuzzy ranking engines against the plain edit distance")
+    lev.add_argument('--count', type=int, default=20000, help="names to rank for each search")
+    lev.add_argument('--queries', type=int, default=50)
+    lev.add_argument('--max-dist', type=int, default=5)
+
+    dupes = commands.add_parser('duplicates', help="the perceptual hash indexes against comparing every image")
+    dupes.add_argument('--count', type=int, default=100000, help="images in the generated library")
+    dupes.add_argument('--queries', type=int, default=200)
+    dupes.add_argument('--max-distance', type=int, default=4)
+
+    colors = commands.add_parser('colors', help="searching by color through the grid against comparing every image")
+    colors.add_argument('--count', type=int, default=100000, help="images in the generated library")
+    colors.add_argument('--queries', type=int, default=200)
+    colors.add_argument('--limit', type=int, default=100)
+
+    metadata = commands.add_parser('metadata', help="reading image headers against decoding the whole image")
+    metadata.add_argument('--count', type=int, default=50)
+    metadata.add_argument('--width', type=int, default=4000)
+    metadata.add_argument('--height', type=int, default=3000)
+
+    writes = commands.add_parser('writes', help="the scraper's database writes a row at a time against in bulk")
+    writes.add_argument('--count', type=int, default=100000, help="images written")
+
+    walk = commands.add_parser('walk', help="listing directories one at a time against in parallel, on a slow disk")
+    walk.add_argument('--directories', type=int, default=200)
+    walk.add_argument('--files', type=int, default=50, help="files in each directory")
+    walk.add_argument('--latency', type=float, default=2.0, help="milliseconds added to every listdir() and stat()")
+    walk.add_argument('--threads', type=int, default=8)
+
+    slack = commands.add_parser('slack', help="posting to Slack on a new connection each time against through the dispatcher")
+    slack.add_argument('--count', type=int, default=500, help="messages posted")
+    slack.add_argument('--workers', type=int, default=2)
+    slack.add_argument('--latency', type=float, default=5.0, help="milliseconds the stub webhook takes to answer")
+
+    load = commands.add_parser('load', help="a mix of page views, searches and API calls through wsgi.py, from several threads")
+    scrape = commands.add_parser('scrape', help="each phase of scraping a library, then of rescanning it")
+    for p in [load, scrape]:
+        p.add_argument('--count', type=int, default=10000, help="images in the generated library")
+        p.add_argument('--shape', default="flat", choices=["flat", "deep"], help="galleries all at the top, or nested a few levels deep")
+        p.add_argument('--galleries', type=int, default=20)
+        p.add_argument('--collisions', type=float, default=0.1, help="the share of images named the same as one in another gallery")
+    load.add_argument('--tags', type=int, default=100, help="tags to hand out, up to three an image")
+    load.add_argument('--threads', type=int, default=8)
+    load.add_argument('--requests', type=int, default=500, help="requests per thread")
+    scrape.add_argument('--processes', type=int, help="workers processing images, one per CPU by default")
+    scrape.add_argument('--changes', type=float, default=0.01, help="the share of images added, changed and deleted before rescanning")
+
+    compare = commands.add_parser('compare', help="the differences between two reports saved with --json")
+    compare.add_argument('old')
+    compare.add_argument('new')
+
+    args = parser.parse_args()
+    if args.command == 'compare':
+        with open(args.old) as old, open(args.new) as new:
+            report = bench.compare_reports(json.load(old), json.load(new))
+        bench.print_comparison(report)
+    elif args.command == 'load':
+        report = bench.bench_load(args.count, args.threads, args.requests, args.shape, args.galleries, args.collisions, args.tags)
+        bench.print_load(report)
+    elif args.command == 'scrape':
+        report = bench.bench_scrape(args.count, args.shape, args.galleries, args.collisions, args.processes, args.changes)
+        bench.print_scrape(report)
+    elif args.command == 'thumbnails':
+        report = bench.bench_thumbnails(args.count, (args.width, args.height), args.aspect_ratio)
+        bench.print_thumbnails(report)
+    elif args.command == 'connections':
+        report = bench.bench_connections(args.count, args.threads, args.requests)
+        bench.print_connections(report)
+    elif args.command == 'pages':
+        report = bench.bench_pages(args.count, args.page_size, args.pages)
+        bench.print_pages(report)
+    elif args.command == 'plans':
+        report = bench.check_query_plans(args.count)
+        bench.print_query_plans(report)
+    elif args.command == 'names':
+        report = bench.bench_names(args.count, args.queries)
+        bench.print_names(report)
+    elif args.command == 'levenshtein':
+        report = bench.bench_levenshtein(args.count, args.queries, args.max_dist)
+        bench.print_levenshtein(report)
+    elif args.command == 'duplicates':
+        report = bench.bench_duplicates(args.count, args.queries, args.max_distance)
+        bench.print_duplicates(report)
+    elif args.command == 'colors':
+        report = bench.bench_colors(args.count, args.queries, args.limit)
+        bench.print_colors(report)
+    elif args.command == 'metadata':
+        report = bench.bench_metadata(args.count, (args.width, args.height))
+        bench.print_metadata(report)
+    elif args.command == 'walk':
+        report = bench.bench_walk(args.directories, args.files, args.latency, args.threads)
+        bench.print_walk(report)
+    elif args.command == 'slack':
+        report = bench.bench_slack(args.count, args.workers, args.latency)
+        bench.print_slack(report)
+    elif args.command == 'writes':
+        report = bench.bench_writes(args.count)
+        bench.print_writes(report)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.command == 'load' and report['uncached']['errors'] + report['cached']['errors'] > 0:
+        sys.exit(1)
+    if args.command == 'plans' and not (report['upgrade']['ok'] and all(q['indexed'] for q in report['queries'])):
+        sys.exit(1)
+    if args.command == 'pages' and (report['calls_per_image'] > 0 or report['full']['errors'] > 0):
+        sys.exit(1)
+    if args.command == 'levenshtein' and report['mismatches'] > 0:
+        sys.exit(1)
+    if args.command == 'metadata' and report['wrong'] > 0:
+        sys.exit(1)
+    if args.command == 'walk' and report['mismatches'] > 0:
+        sys.exit(1)
+    if args.command == 'slack' and report['mismatches'] + report['wrongly_dropped'] > 0:
+        sys.exit(1)
+    if args.command == 'writes' and report['mismatches'] > 0:
+        sys.exit(1)
+    if args.command == 'colors' and report['mismatches'] > 0:
+        sys.exit(1)
+    if args.command == 'duplicates' and report['mismatches'] + report['cluster_mismatches'] + report['route_mismatches'] > 0:
+        sys.exit(1)
@@ -1,3 +1,5 @@
+-- Bump this along with the migrations in gdg/data.py
+PRAGMA user_version = 12;
 
 -- Table: images
 CREATE TABLE images ( 
@@ -10,9 +12,175 @@ CREATE TABLE images (
     y       INTEGER,
     r       INTEGER,
     g       INTEGER,
-    b       INTEGER
+    b       INTEGER,
+    mtime   REAL,
+    size    INTEGER,
+    inode   INTEGER,
+    hash    VARCHAR( 32 ),
+    thumb_key VARCHAR( 40 ),
+    phash   INTEGER,
+    colors  VARCHAR( 64 ),
+    orientation INTEGER,
+    taken   VARCHAR( 19 ),
+    camera  VARCHAR( 128 ),
+    frames  INTEGER,
+    animation VARCHAR( 255 )
 );
 
+CREATE INDEX images_path ON images ( path );
+CREATE INDEX images_gallery ON images ( gallery, path );
+CREATE INDEX images_parent ON images ( parent, gallery );
+CREATE INDEX images_path_nocase ON images ( path COLLATE NOCASE );
+CREATE INDEX images_gallery_nocase ON images ( gallery, path COLLATE NOCASE );
+CREATE INDEX images_inode ON images ( inode );
+CREATE INDEX images_hash ON images ( hash );
+CREATE INDEX images_thumb_key ON images ( thumb_key );
+CREATE INDEX images_phash_0 ON images ( phash & 65535 );
+CREATE INDEX images_phash_1 ON images ( ( phash >> 16 ) & 65535 );
+CREATE INDEX images_phash_2 ON images ( ( phash >> 32 ) & 65535 );
+CREATE INDEX images_phash_3 ON images ( ( phash >> 48 ) & 65535 );
+CREATE INDEX images_unread ON images ( id ) WHERE frames IS NULL;
+
+-- Table: directories
+CREATE TABLE directories ( 
+    id     INTEGER         PRIMARY KEY,
+    path   VARCHAR( 255 )  NOT NULL
+                           UNIQUE,
+    parent VARCHAR( 255 ),
+    mtime  REAL            NOT NULL
+);
+
+CREATE INDEX directories_parent ON directories ( parent );
+
+-- Table: galleries
+CREATE TABLE galleries ( 
+    id       INTEGER         PRIMARY KEY,
+    path     VARCHAR( 255 )  NOT NULL
+                             UNIQUE,
+    parent   VARCHAR( 255 ),
+    images   INTEGER         NOT NULL
+                             DEFAULT 0,
+    total    INTEGER         NOT NULL
+                             DEFAULT 0,
+    cover_id INTEGER,
+    mtime    REAL
+);
+
+CREATE INDEX galleries_parent ON galleries ( parent, path );
+
+-- Table: gallery_changes
+CREATE TABLE gallery_changes ( 
+    path VARCHAR( 255 ) PRIMARY KEY
+);
+
+-- Trigger: images_added
+CREATE TRIGGER images_added AFTER INSERT ON images
+BEGIN
+    INSERT OR IGNORE INTO gallery_changes ( path ) VALUES ( NEW.gallery );
+END;
+
+-- Trigger: images_removed
+CREATE TRIGGER images_removed AFTER DELETE ON images
+BEGIN
+    INSERT OR IGNORE INTO gallery_changes ( path ) VALUES ( OLD.gallery );
+END;
+
+-- Trigger: images_changed
+CREATE TRIGGER images_changed AFTER UPDATE OF path, gallery, mtime ON images
+WHEN OLD.path IS NOT NEW.path OR OLD.gallery IS NOT NEW.gallery OR OLD.mtime IS NOT NEW.mtime
+BEGIN
+    INSERT OR IGNORE INTO gallery_changes ( path ) VALUES ( OLD.gallery );
+    INSERT OR IGNORE INTO gallery_changes ( path ) VALUES ( NEW.gallery );
+END;
+
+-- Table: name_changes
+CREATE TABLE name_changes ( 
+    image_id INTEGER PRIMARY KEY
+);
+
+-- Trigger: images_named
+CREATE TRIGGER images_named AFTER INSERT ON images
+BEGIN
+    INSERT OR IGNORE INTO name_changes ( image_id ) VALUES ( NEW.id );
+END;
+
+-- Trigger: images_unnamed
+CREATE TRIGGER images_unnamed AFTER DELETE ON images
+BEGIN
+    INSERT OR IGNORE INTO name_changes ( image_id ) VALUES ( OLD.id );
+END;
+
+-- Trigger: images_renamed
+CREATE TRIGGER images_renamed AFTER UPDATE OF path ON images
+WHEN OLD.path IS NOT NEW.path
+BEGIN
+    INSERT OR IGNORE INTO name_changes ( image_id ) VALUES ( NEW.id );
+END;
+
+-- Table: image_colors
+CREATE TABLE image_colors ( 
+    id       INTEGER PRIMARY KEY,
+    image_id INTEGER NOT NULL
+                     REFERENCES images ( id ) ON DELETE CASCADE,
+    color    INTEGER NOT NULL,
+    share    INTEGER NOT NULL,
+    cell     INTEGER NOT NULL,
+    l        REAL    NOT NULL,
+    a        REAL    NOT NULL,
+    b        REAL    NOT NULL
+);
+
+CREATE INDEX image_colors_image ON image_colors ( image_id );
+CREATE INDEX image_colors_cell ON image_colors ( cell );
+
+-- Trigger: image_colors_removed
+CREATE TRIGGER image_colors_removed AFTER DELETE ON images
+BEGIN
+    DELETE FROM image_colors WHERE image_id = OLD.id;
+END;
+
+-- Trigger: image_colors_changed
+CREATE TRIGGER image_colors_changed AFTER UPDATE OF colors ON images
+WHEN OLD.colors IS NOT NEW.colors
+BEGIN
+    DELETE FROM image_colors WHERE image_id = NEW.id;
+END;
+
+-- Table: jobs
+CREATE TABLE jobs ( 
+    image_id INTEGER         PRIMARY KEY
+                             REFERENCES images ( id ) ON DELETE CASCADE,
+    state    VARCHAR( 16 )   NOT NULL
+                             DEFAULT 'pending',
+    attempts INTEGER         NOT NULL
+                             DEFAULT 0,
+    due      REAL            NOT NULL
+                             DEFAULT 0,
+    error    TEXT 
+);
+
+CREATE INDEX jobs_due ON jobs ( state, due );
+
+-- Trigger: jobs_removed
+CREATE TRIGGER jobs_removed AFTER DELETE ON images
+BEGIN
+    DELETE FROM jobs WHERE image_id = OLD.id;
+END;
+
+-- Trigger: jobs_changed
+CREATE TRIGGER jobs_changed AFTER UPDATE OF mtime, size, inode ON images
+WHEN OLD.mtime IS NOT NEW.mtime OR OLD.size IS NOT NEW.size OR OLD.inode IS NOT NEW.inode
+BEGIN
+    DELETE FROM jobs WHERE image_id = NEW.id;
+END;
+
+-- Table: generation
+CREATE TABLE generation ( 
+    value INTEGER NOT NULL 
+);
+
+INSERT INTO generation ( value ) VALUES ( 0 );
+
 -- Table: tags
 CREATE TABLE tags ( 
     id   INTEGER         PRIMARY KEY,
@@ -31,6 +199,57 @@ CREATE TABLE tag_image (
                      REFERENCES tags ( id ) ON DELETE CASCADE 
 );
 
+CREATE UNIQUE INDEX tag_image_image ON tag_image ( image_id, tag_id );
+CREATE INDEX tag_image_tag ON tag_image ( tag_id, image_id );
+
+-- Table: image_search
+CREATE VIRTUAL TABLE image_search USING fts5 ( name, gallery, tags, tokenize = 'unicode61' );
+
+-- Trigger: image_search_added
+CREATE TRIGGER image_search_added AFTER INSERT ON images
+BEGIN
+    INSERT INTO image_search ( rowid, name, gallery, tags )
+         VALUES ( NEW.id, replace( NEW.path, rtrim( NEW.path, replace( NEW.path, '/', '' ) ), '' ), NEW.gallery, '' );
+END;
+
+-- Trigger: image_search_removed
+CREATE TRIGGER image_search_removed AFTER DELETE ON images
+BEGIN
+    DELETE FROM image_search WHERE rowid = OLD.id;
+END;
+
+-- Trigger: image_search_moved
+CREATE TRIGGER image_search_moved AFTER UPDATE OF path, gallery ON images
+WHEN OLD.path IS NOT NEW.path OR OLD.gallery IS NOT NEW.gallery
+BEGIN
+    UPDATE image_search
+       SET name = replace( NEW.path, rtrim( NEW.path, replace( NEW.path, '/', '' ) ), '' ),
+           gallery = NEW.gallery
+     WHERE rowid = NEW.id;
+END;
+
+-- Trigger: image_search_tagged
+CREATE TRIGGER image_search_tagged AFTER INSERT ON tag_image
+BEGIN
+    UPDATE image_search SET tags = ( SELECT group_concat( t.name, ' ' ) FROM tag_image ti JOIN tags t ON t.id = ti.tag_id WHERE ti.image_id = NEW.image_id )
+     WHERE rowid = NEW.image_id;
+END;
+
+-- Trigger: image_search_untagged
+CREATE TRIGGER image_search_untagged AFTER DELETE ON tag_image
+BEGIN
+    UPDATE image_search SET tags = coalesce( ( SELECT group_concat( t.name, ' ' ) FROM tag_image ti JOIN tags t ON t.id = ti.tag_id WHERE ti.image_id = OLD.image_id ), '' )
+     WHERE rowid = OLD.image_id;
+END;
+
+-- Trigger: image_search_retagged
+CREATE TRIGGER image_search_retagged AFTER UPDATE OF name ON tags
+WHEN OLD.name IS NOT NEW.name
+BEGIN
+    UPDATE image_search SET tags = ( SELECT group_concat( t.name, ' ' ) FROM tag_image ti JOIN tags t ON t.id = ti.tag_id WHERE ti.image_id = image_search.rowid )
+     WHERE rowid IN ( SELECT image_id FROM tag_image WHERE tag_id = NEW.id );
+END;
+
 -- Table: users
 CREATE TABLE users (
     id    INTEGER PRIMARY KEY,
@@ -1,15 +1,27 @@
 import os
 import random
 import re
-import httplib
+import time
+import base64
 import json
+import functools
+import threading
 import cherrypy
+import cherrypy.lib.static
 import gdg
 import bcrypt
-from urlparse import urljoin, urlparse
+from urlparse import urljoin
 from mako.template import Template
 from mako.lookup import TemplateLookup
 from gdg.data import *
+from gdg.thumbs import ThumbnailCache, TimeoutError
+from gdg.responses import ResponseCache
+from gdg.slack import SlackDispatcher
+from gdg.names import get_name_index
+from gdg import fuzzy
+from gdg import metrics
+from gdg.duplicates import find_duplicates
+from gdg.colors import parse_color, parse_colors, format_color, find_images_by_color
 
 # Content is relative to the base directory, not the module directory.
 current_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
@@ -18,10 +30,32 @@ virtual_dir = ''
 templates = TemplateLookup(directories=['html'], strict_undefined=True)
 
 application = None
+application_lock = threading.Lock()
+
+thumbnail_cache = None
+thumbnail_cache_lock = threading.Lock()
+
+response_cache = None
+response_cache_lock = threading.Lock()
+
+slack_dispatcher = None
+slack_dispatcher_lock = threading.Lock()
+
+# Databases already brought up to date by this process
+migrated_databases = set()
 
 class ImageModel(object):
-    def __init__(self, **entries):
-        self.__dict__.update(entries)
+# what the gallery and the API show of an image
+    __slots__ = ('path', 'file', 'thumb', 'thumbs', 'average_color', 'size_x', 'size_y', 'filesize', 'grey', 'colors', 'taken', 'camera', 'frames', 'animation', 'tags')
+
+    def to_dict(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+# The columns an ImageModel is made from
+model_columns = [Image.id, Image.path, Image.thumb, Image.thumb_key, Image.animation, Image.size, Image.x, Image.y, Image.r, Image.g, Image.b, Image.colors, Image.taken, Image.camera, Image.frames]
+
+# Anything urljoin() would take for more than a plain relative path
+unjoinable = re.compile(r"[:?#;\\\t\r\n]|//|/\.\.?(/|$)")
 
 def get_relative_path(base, path):
     if path == None:
@@ -40,42 +74,247 @@ def filesize(num):
 def get_base_url():
     return urljoin(cherrypy.request.base, virtual_dir + '/')
 
-def get_model(img):
-    p = os.path.abspath(img.path)
-    if not os.path.exists(p):
-        return None
-    
-    filename = os.path.basename(p)
-    size = filesize(os.path.getsize(p))
+class ModelContext(object):
+# what the models of a page's images have in common, worked out once a page
+    def __init__(self, baseurl):
+        config = cherrypy.request.app.config
+        self.baseurl = baseurl
+        self.root = current_dir + os.sep
+        self.images = os.path.join(current_dir, config['images']['path']) + os.sep
+        self.sizes = get_thumb_sizes(config['thumbnails']['sizes'])
+        # Browsers use the first source they support, so JPEG goes last
+        self.formats = sorted(get_thumb_formats(config['thumbnails']['formats']), key=lambda f: f == 'jpeg')
+        self.lazy_url = urljoin(baseurl, "thumbs/{}/".format(self.sizes[0]))
+
+    def url(self, path):
+    # the same as get_relative_path(), only paths under current_dir are cut
+    # down to size rather than worked out and joined
+        if path == None:
+            return None
+        if path.startswith(self.root) and unjoinable.search(path, len(self.root) - 1) == None:
+            return self.baseurl + path[len(self.root):]
+        return get_relative_path(self.baseurl, path)
+
+    def thumbnails(self, img):
+    # a srcset for each configured thumbnail format, relative to the default size
+        if img.thumb_key == None or img.thumb == None:
+            return []
+        thumb_dir = os.path.dirname(img.thumb)
+        thumbs = []
+        # and the animated thumbnail before any of them, the rest being its poster
+        if not img.animation == None:
+            thumbs.append({ 'type': "image/" + os.path.splitext(img.animation)[1][1:], 'srcset': self.url(img.animation) })
+        for f in self.formats:
+            srcset = ["{} {:g}x".format(self.url(os.path.join(thumb_dir, get_thumb_name(img.thumb_key, s, f))), float(s) / self.sizes[0]) for s in self.sizes]
+            thumbs.append({ 'type': "image/" + f, 'srcset': ", ".join(srcset) })
+        return thumbs
+
+    def lazy_thumbnail(self, img):
+    # the on-demand thumbnail for an image the scraper hasn't gotten to yet
+        if img.path.startswith(self.images) and unjoinable.search(img.path, len(self.images) - 1) == None:
+            return self.lazy_url + img.path[len(self.images):]
+        path = os.path.relpath(img.path, self.images).replace('\\', '/')
+        return urljoin(self.baseurl, "thumbs/{}/{}".format(self.sizes[0], path))
+
+def get_thumbnail_cache():
+    global thumbnail_cache
+    with thumbnail_cache_lock:
+        if thumbnail_cache == None:
+            thumb_config = cherrypy.request.app.config['thumbnails']
+            path = os.path.join(current_dir, thumb_config.get('cache_path', 'thumbs/cache'))
+            max_bytes = thumb_config.get('cache_size', 512) * 1024 * 1024
+            thumbnail_cache = ThumbnailCache(path, max_bytes, thumb_config.get('render_workers', 2))
+        return thumbnail_cache
+
+def get_response_cache():
+    global response_cache
+    with response_cache_lock:
+        if response_cache == None:
+            size = cherrypy.request.app.config['gallery'].get('response_cache', 32)
+            response_cache = ResponseCache(size * 1024 * 1024)
+        return response_cache
+
+def cached(encode_json=False):
+# serves what the handler returns from the response cache until the database's
+# generation changes, and answers conditional GETs for it with a 304.  Responses
+# are kept apart by URL and by who's logged in.  With encode_json set, what the
+# handler returns is sent as JSON.
+    def encode(body):
+        return json.dumps(body) if encode_json else body
+
+    def decorate(handler):
+        @functools.wraps(handler)
+        def respond(*args, **kwargs):
+            dbpath = cherrypy.request.app.config['database']['path']
+            if not os.path.isfile(os.path.join(dbpath, 'gallery.db')):
+                body = encode(handler(*args, **kwargs))
+                if encode_json:
+                    cherrypy.response.headers['Content-Type'] = "application/json"
+                return body
+
+            request = cherrypy.request
+            user = cherrypy.session.get('user')
+            key = (request.base, request.script_name, request.path_info, request.query_string, None if user == None else user['email'])
+            cache = get_response_cache()
+            # Read before anything the handler reads, so a change made in
+            # between only makes the cached copy newer than its generation
+            with GoddamnDatabase(dbpath):
+                generation = get_generation()
+            entry = cache.get(key, generation)
+            if entry == None:
+                entry = cache.put(key, generation, encode(handler(*args, **kwargs)))
+            etag, body = entry
+
+            if encode_json:
+                cherrypy.response.headers['Content-Type'] = "application/json"
+            cherrypy.response.headers['ETag'] = etag
+            cherrypy.response.headers['Cache-Control'] = "no-cache"
+            cherrypy.response.headers['Vary'] = "Cookie"
+            cherrypy.lib.cptools.validate_etags()
+            return body
+        return respond
+    return decorate
+
+def get_slack_dispatcher():
+    global slack_dispatcher
+    with slack_dispatcher_lock:
+        if slack_dispatcher == None:
+            slack_config = cherrypy.request.app.config['slack']
+            slack_dispatcher = SlackDispatcher(slack_config.get('workers', 2), slack_config.get('queue_size', 100), slack_config.get('timeout', 5), slack_config.get('retries', 3), log=cherrypy.log)
+        return slack_dispatcher
+
+def get_handler_name(handler):
+# "Controller.action" of what the dispatcher picked to handle a request
+    f = getattr(handler, 'callable', None)
+    if f == None:
+        return "none"
+    cls = getattr(f, 'im_class', None)
+    return f.__name__ if cls == None else "{}.{}".format(cls.__name__, f.__name__)
+
+def start_metrics():
+# times the request and counts its queries, see gdg/metrics.py
+    cherrypy.request.metrics_start = time.time()
+    # Tools wrap the handler in their own later on
+    cherrypy.request.metrics_handler = get_handler_name(cherrypy.request.handler)
+    metrics.start_request()
+    cherrypy.request.hooks.attach('on_end_request', finish_metrics)
+
+def finish_metrics():
+    request = cherrypy.request
+    elapsed = time.time() - request.metrics_start
+    stats = metrics.end_request()
+    # Static files are served instead of calling the handler
+    handler = "static" if request.handler == None else request.metrics_handler
+    status = str(cherrypy.response.status).split(' ')[0]
+    metrics.requests.observe(elapsed, handler, request.method, status)
+    metrics.queries.observe(stats.queries, handler)
+    metrics.query_time.observe(stats.query_time, handler)
+
+    slow = request.app.config.get('metrics', {}).get('slow_request', 0)
+    if slow > 0 and elapsed >= slow:
+        path = request.path_info + ('?' + request.query_string if request.query_string else '')
+        cherrypy.log("Slow request: {} {} took {:.0f}ms ({} from {}, {} queries taking {:.0f}ms, rendering {:.0f}ms)".format(request.method, path, elapsed * 1000, status, handler, stats.queries, stats.query_time * 1000, stats.render_time * 1000))
+
+cherrypy.tools.metrics = cherrypy.Tool('on_start_resource', start_metrics)
+
+def get_model(img, context=None, tags=None):
+# an image's model, from its row alone.  The files are taken to be where the
+# database says, the scraper keeps it that way.
+    if context == None:
+        context = ModelContext(get_base_url())
+    model = ImageModel()
+    model.path = context.url(img.path)
+    model.file = os.path.basename(img.path)
+    model.thumb = context.url(img.thumb) if not img.thumb == None else context.lazy_thumbnail(img)
+    model.thumbs = context.thumbnails(img)
     if not img.r == None:
-        color = "#%02X%02X%02X" % (img.r, img.g, img.b)
-        grey = int((img.r * 0.299) + (img.g * 0.587) + (img.b * 0.114))
+        model.average_color = "#%02X%02X%02X" % (img.r, img.g, img.b)
+        model.grey = int((img.r * 0.299) + (img.g * 0.587) + (img.b * 0.114))
     else:
-        color = "#FFFFFF"
-        grey = 255
+        model.average_color = "#FFFFFF"
+        model.grey = 255
+    model.size_x = img.x
+    model.size_y = img.y
+    # Only images the scraper hasn't fingerprinted yet lack a size
+    model.filesize = filesize(img.size if not img.size == None else os.path.getsize(img.path))
+    model.colors = [format_color(rgb) for rgb, share in parse_colors(img.colors)]
+    model.taken = img.taken
+    model.camera = img.camera
+    model.frames = img.frames
+    model.animation = context.url(img.animation)
+    model.tags = [] if tags == None else tags
+    return model
 
-    baseurl = get_base_url()
+def get_models(images):
+# models for a page of images, rows with the model_columns, and their tags
+    context = ModelContext(get_base_url())
+    tags = get_image_tags([img.id for img in images])
+    return [get_model(img, context, tags.get(img.id)) for img in images]
 
-    tags = [t.name for t in [ti.tag for ti in img.tagimage_set_prefetch]] if hasattr(img, 'tagimage_set_prefetch') else []
-    
-    model = {
-        'path': get_relative_path(baseurl, img.path),
-        'file': filename,
-        'thumb': get_relative_path(baseurl, img.thumb),
-        'average_color': color,
-        'size_x': img.x,
-        'size_y': img.y,
-        'filesize': size,
-        'grey': grey,
-        'tags': tags
-    }
-    
-    return ImageModel(**model)
+def select_image_tags(ids):
+    return TagImage.select(TagImage.image, Tag.name).join(Tag).where(TagImage.image << ids).order_by(TagImage.id)
+
+def get_image_tags(ids):
+# each image's tag names, in the order they were added, by its id
+    tags = {}
+    if len(ids) == 0:
+        return tags
+    for id, name in select_image_tags(ids).tuples():
+        tags.setdefault(id, []).append(name)
+    return tags
     
+def encode_cursor(path, value):
+# an opaque token for where a page starts or ends: an image path, kept relative
+# so tokens don't give away where the gallery lives, and a number
+    if not path == None:
+        path = os.path.relpath(path, current_dir)
+    return base64.urlsafe_b64encode(json.dumps([path, value])).rstrip('=')
+
+def decode_cursor(token):
+    try:
+        path, value = json.loads(base64.urlsafe_b64decode(str(token) + '=' * (-len(token) % 4)))
+        if not isinstance(value, (int, long)) or not isinstance(path, (unicode, type(None))):
+            raise ValueError(token)
+    except (TypeError, ValueError, UnicodeEncodeError):
+        raise cherrypy.HTTPError(400, "That's not a goddamn page token.")
+    if not path == None:
+        path = os.path.join(current_dir, path)
+    return path, value
+
 def get_viewmodel():
-    return { 'message': '', 'images': [], 'page': 1, 'total_images': 0, 'total_pages': 1, 'gallery_url': '', 'gallery': '', 'parent_gallery': '', 'children': [] }
+    return { 'message': '', 'images': [], 'page': 1, 'total_images': 0, 'total_pages': 1, 'gallery_url': '', 'gallery': '', 'parent_gallery': '', 'children': [], 'child_totals': {}, 'next_page': None, 'previous_page': None, 'last_page': None }
+
+def select_gallery_images(gallery, tag=""):
+# a gallery's images, or only those with tag
+    q = Image.select().where(Image.gallery == gallery)
+    if not tag == "":
+        q = q.join(TagImage).join(Tag).where(Tag.name == tag)
+    return q
+
+def select_gallery_count(gallery):
+    return Gallery.select(Gallery.images).where(Gallery.path == gallery)
+
+def select_child_galleries(gallery):
+    return Gallery.select(Gallery.path, Gallery.total).where(Gallery.parent == gallery).order_by(Gallery.path)
+
+def select_page_number(q, page, page_size):
+    return q.order_by(Image.path).paginate(page, page_size)
+
+def select_page_after(q, last, page_size):
+# the page starting after the image at path last
+    return q.where(Image.path > last).order_by(Image.path).limit(page_size)
+
+def select_page_before(q, first, page_size):
+# the page ending before the image at path first, or the last page if first is
+# None, last image first
+    if not first == None:
+        q = q.where(Image.path < first)
+    return q.order_by(Image.path.desc()).limit(page_size)
 
-def get_images(dbpath, model=None, page=1, page_size=20, gallery="", tag=""):
+def get_images(dbpath, model=None, page=1, page_size=20, gallery="", tag="", after=None, before=None):
+# a page of a gallery.  Pages are found by the path of the image either side of
+# them (after/before, from the tokens in the model), so any page costs the same
+# as the first; page numbers are kept for display and for old links.
     if model == None:
         model = get_viewmodel()
 
@@ -99,33 +338,56 @@ def get_images(dbpath, model=None, page=1, page_size=20, gallery="", tag=""):
     model['parent_gallery'] = parent_gallery
     
     with GoddamnDatabase(dbpath):
-        q = Image.select().where(Image.gallery == gallery)
+        q = select_gallery_images(gallery, tag)
         
         if not tag == "":
             model['tagged'] = tag
-            q = q.join(TagImage).join(Tag).where(Tag.name == tag)
+            count = q.count()
         else:
             model['tagged'] = None
-        
-        count = q.count()
+            g = select_gallery_count(gallery).first()
+            count = 0 if g == None else g.images
+
+        children = select_child_galleries(gallery)
+        model['children'] = [c.path for c in children]
+        model['child_totals'] = dict((c.path, c.total) for c in children)
+
         if count == 0:
             return model
 
         model['total_images'] = count
         
-        q = q.order_by(Image.path)
+        backwards = False
         
-        if not page_size == None:
-            model['total_pages'] = int((count - 1) / page_size) + 1
+        if page_size == None:
+            q = q.order_by(Image.path)
+        else:
+            total_pages = int((count - 1) / page_size) + 1
+            if not after == None:
+                last, page = decode_cursor(after)
+                q = select_page_after(q, last, page_size)
+            elif not before == None:
+                # Walk back from the first image of the following page
+                first, page = decode_cursor(before)
+                backwards = True
+                q = select_page_before(q, first, page_size if page < total_pages else count - (total_pages - 1) * page_size)
+            else:
+                q = select_page_number(q, page, page_size)
+            model['total_pages'] = total_pages
             model['page'] = page
-            q = q.paginate(page, page_size)
 
-        tags = TagImage.select(TagImage, Tag).join(Tag)
-        image_tags = prefetch(q, tags)
+        images = list(q.select(*model_columns).namedtuples())
+        if backwards:
+            images.reverse()
         
-        model['images'] = [get_model(i) for i in image_tags]
+        model['images'] = get_models(images)
 
-        model['children'] = [i.gallery for i in Image.select().group_by(Image.gallery).having(Image.parent == gallery)]
+        if not page_size == None and len(images) > 0:
+            if page < model['total_pages']:
+                model['next_page'] = encode_cursor(images[-1].path, page + 1)
+                model['last_page'] = encode_cursor(None, model['total_pages'])
+            if page > 1:
+                model['previous_page'] = encode_cursor(images[0].path, page - 1)
         
     return model
 
@@ -160,30 +422,24 @@ ext = "\.\w{2,}$"
 extension = re.compile(ext)
 spaces = re.compile("[\\\]*\s+")
 symbols = re.compile("([^\w\s\.]+)")
-filename = re.compile("/([^\\/]+)" + ext)
 
-def filename_lev(a, f):
-    fn = filename.search(f)
-    if fn == None:
-        return levenshtein(a, f)
-    else:
-        return levenshtein(a, fn.group(1))
-
-# Returns a list of key-value pairs {image, distance}
+# Returns a list of key-value pairs {image, distance} for (image, file name) pairs
 def filter_images_by_lev(name, image_list, max_dist):
-    for filename in image_list:
-        lev_dist = 0 if max_dist < 0 else filename_lev(name.lower(), filename.lower())
-        if max_dist >= 0 and lev_dist > max_dist:
-            continue
-        yield { 'image': filename, 'distance': lev_dist }
+    if max_dist < 0:
+        return [{ 'image': image, 'distance': 0 } for image, filename in image_list]
+    name = name.lower()
+    # Names whose lengths differ by more than max_dist can't be close enough
+    close = [(image, f) for image, f in ((image, extension.sub("", filename).lower()) for image, filename in image_list) if abs(len(f) - len(name)) <= max_dist]
+    found = fuzzy.distances(name, [f for image, f in close], max_dist)
+    return [{ 'image': image, 'distance': d } for (image, f), d in zip(close, found) if not d == None]
 
-def find_images_by_name(name):
-    if name == None or name == "":
-        return []
-        
-    baseurl = get_base_url()
-    dbpath = cherrypy.request.app.config['database']['path']
-    
+def get_image_paths(ids, chunk=500):
+    paths = {}
+    for n in range(0, len(ids), chunk):
+        paths.update(Image.select(Image.id, Image.path).where(Image.id << ids[n:n + chunk]).tuples())
+    return paths
+
+def get_name_pattern(name):
     pattern = symbols.sub("[\W_]*?", name)
     pattern = spaces.sub("[\s\-_\.]*?", pattern)
     
@@ -194,31 +450,113 @@ def find_images_by_name(name):
         pattern += ".*" + ext
     else:
         pattern += "$"
+    return pattern
+
+def find_images_by_name(name):
+    if name == None or name == "":
+        return []
+        
+    baseurl = get_base_url()
+    dbpath = cherrypy.request.app.config['database']['path']
+    pattern = get_name_pattern(name)
     
-    with GoddamnDatabase(dbpath):
-        images = [get_relative_path(baseurl, i.path) for i in Image.select().where(Image.path.regexp(pattern)).order_by(SQL('path collate nocase'))]
-    
-    if len(images) > 1:
-        if not 'api' in cherrypy.request.app.config:
-            return "You haven't configured the goddamn API."
+    with GoddamnDatabase(dbpath) as db:
+        index = get_name_index(dbpath)
+        index.refresh(db)
+        found = index.find(pattern, name)
+        matches = [{ 'image': id, 'distance': 0 } for id, filename in found]
+        
+        if len(matches) > 1:
+            if not 'api' in cherrypy.request.app.config:
+                return "You haven't configured the goddamn API."
 
-        max_dist = cherrypy.request.app.config['api']['max_lev_distance']
-        max_dist = -1 if max_dist is None else max_dist
+            max_dist = cherrypy.request.app.config['api']['max_lev_distance']
+            max_dist = -1 if max_dist is None else max_dist
 
-        # Filter and then sort the images by their levenshtein distance
-        filtered_images = sorted(filter_images_by_lev(name, images, max_dist), key=lambda kvp: kvp['distance'])
-        images = [kvp['image'] for kvp in filtered_images]
-    return images
+            matches = filter_images_by_lev(name, found, max_dist)
+        paths = get_image_paths([m['image'] for m in matches])
 
-def find_images_by_tags(tags):
+    # Sorted by their levenshtein distance, then by path
+    matches = sorted((m for m in matches if m['image'] in paths), key=lambda m: (m['distance'], paths[m['image']].lower()))
+    return [get_relative_path(baseurl, paths[m['image']]) for m in matches]
+
+def select_images_by_tags(tags):
+# paths of the images with any of tags, by their exact names.  The tags are
+# found by name, then their images through tag_image's index on tag_id.
+    tagged = TagImage.select(TagImage.image).join(Tag).where(Tag.name << tags)
+    return Image.select(Image.path).where(Image.id << tagged).order_by(Image.path)
+
+def find_images_by_tags(tags, limit=None):
     if tags is None or tags == []:
         return []
 
     baseurl = get_base_url()
     dbpath = cherrypy.request.app.config['database']['path']
 
+    q = select_images_by_tags(tags)
+    if not limit == None:
+        q = q.limit(limit)
+    with GoddamnDatabase(dbpath):
+        return [get_relative_path(baseurl, path) for (path,) in q.tuples()]
+
+# The same words SQLite's tokenizer would find, so quoting them is always safe
+search_words = re.compile("[^\W_]+", re.U)
+
+def get_phrase(column, text, prefix=False):
+# an FTS5 phrase for the words in text, or None if it hasn't got any
+    words = search_words.findall(text)
+    if len(words) == 0:
+        return None
+    return '{} : "{}"{}'.format(column, " ".join(words), " *" if prefix else "")
+
+def get_search_query(text):
+# turns a search like `cat gallery:memes #reaction` into an FTS5 query.  Plain
+# words match the start of words in file names, galleries and tags, gallery:
+# matches a gallery's path and # (or tag:) a tag.  Everything has to match.
+    terms = []
+    for term in text.split():
+        if term.startswith('#'):
+            terms.append(get_phrase('tags', term[1:]))
+        elif term.lower().startswith('tag:'):
+            terms.append(get_phrase('tags', term[4:]))
+        elif term.lower().startswith('gallery:'):
+            terms.append(get_phrase('gallery', term[8:], True))
+        else:
+            terms.extend('"{}" *'.format(w) for w in search_words.findall(term))
+    terms = [t for t in terms if not t == None]
+    return " AND ".join(terms) if len(terms) > 0 else None
+
+def select_search(query, limit=None):
+# (sql, params) for the paths of the images matching an FTS5 query, best matches
+# first.  File names count for more than tags, and tags for more than galleries.
+    sql = """SELECT i.path FROM image_search
+               JOIN images i ON i.id = image_search.rowid
+              WHERE image_search MATCH ?
+              ORDER BY bm25(image_search, 10.0, 1.0, 5.0)"""
+    params = [query]
+    if not limit == None:
+        sql += " LIMIT ?"
+        params.append(limit)
+    return sql, params
+
+def search_images(query, limit=100):
+    if query == None:
+        return []
+    baseurl = get_base_url()
+    dbpath = cherrypy.request.app.config['database']['path']
+    sql, params = select_search(query, limit)
+    with GoddamnDatabase(dbpath) as db:
+        return [get_relative_path(baseurl, path) for (path,) in db.execute_sql(sql, params)]
+
+def search_images_by_color(rgb, limit=100):
+# images with one of their main colors closest to rgb
+    baseurl = get_base_url()
+    dbpath = cherrypy.request.app.config['database']['path']
+    max_distance = cherrypy.request.app.config.get('api', {}).get('max_color_distance', 25)
     with GoddamnDatabase(dbpath):
-        return [get_relative_path(baseurl, i.path) for i in Image.select().join(TagImage).join(Tag).where(Tag.name << tags)]
+        ids = find_images_by_color(rgb, limit, max_distance)
+        paths = get_image_paths(ids)
+    return [get_relative_path(baseurl, paths[id]) for id in ids if id in paths]
 
 def find_image(text):
     if not text:
@@ -262,10 +600,14 @@ class BaseController(object):
         
         if model:
             base_model.update(model)
-        return tmp.render(**base_model)
+        start = time.time()
+        page = tmp.render(**base_model)
+        metrics.record_render(template, time.time() - start)
+        return page
 
 class GalleryController(BaseController):
     @cherrypy.expose
+    @cached()
     def index(self, gallery="", page="1", **kwargs):
         model = get_viewmodel()
         
@@ -279,7 +621,7 @@ class GalleryController(BaseController):
             pagesize = cherrypy.request.app.config['gallery']['images_per_page']
             tag = kwargs['tagged'] if 'tagged' in kwargs else ""
             
-            get_images(dbpath, model, page=int(page), page_size=pagesize, gallery=gallery, tag=tag)
+            get_images(dbpath, model, page=int(page), page_size=pagesize, gallery=gallery, tag=tag, after=kwargs.get('after'), before=kwargs.get('before'))
         
         return self.render_page("index.html", model)
 
@@ -322,22 +664,29 @@ class AccountController(BaseController):
         baseurl = get_base_url()
         raise cherrypy.HTTPRedirect(baseurl)
 
+def select_tags_for_image(path):
+    return Tag.select().join(TagImage).join(Image).where(Image.path == path)
+
+def list_tags(image=""):
+# every tag, or an image's
+    dbpath = cherrypy.request.app.config['database']['path']
+    if not image:
+        with GoddamnDatabase(dbpath):
+            return [t.slug for t in Tag.select()]
+    image_folder = cherrypy.request.app.config['images']['path']
+    full_path = os.path.join(current_dir, image_folder, image)
+    with GoddamnDatabase(dbpath):
+        return [t.slug for t in select_tags_for_image(full_path)]
+
 class TagController(object):
     def __init__(self):
         pass
 
     @cherrypy.expose
-    @cherrypy.tools.json_out()
+    @cached(encode_json=True)
     def list(self, image=""):
         cherrypy.log(cherrypy.request.method)
-        dbpath = cherrypy.request.app.config['database']['path']
-        if not image:
-            with GoddamnDatabase(dbpath):
-                return [t.slug for t in Tag.select()]
-        image_folder = cherrypy.request.app.config['images']['path']
-        full_path = os.path.join(current_dir, image_folder, image)
-        with GoddamnDatabase(dbpath):
-            return [t.slug for t in Tag.select().join(TagImage).join(Image).where(Image.path == full_path)]
+        return list_tags(image)
     
     @cherrypy.expose
     @cherrypy.tools.allow(methods=['POST', 'PUT', 'PATCH'])
@@ -362,13 +711,14 @@ class TagController(object):
                 tag, _ = Tag.get_or_create(name=tag_name, slug=tag_name)
                 _, created = TagImage.get_or_create(image=image, tag=tag)
                 if created:
+                    bump_generation()
                     return "Image has been successfully tagged"
                 else:
                     return "Image was already tagged"
     
     @cherrypy.expose
     @cherrypy.tools.allow(methods=['DELETE'])
-    def remove_tag(self, image="", tag=""):
+    def remove_tag(self, image="", tag="", **kwargs):
         if 'user' not in cherrypy.session and not verify_key(kwargs.get('key', '')):
             raise cherrypy.HTTPError(401, "What's the magic word?")
         if not tag:
@@ -391,6 +741,7 @@ class TagController(object):
                 t = tags[0]
                 n = TagImage.delete().where(TagImage.tag == t, TagImage.image == i).execute()
                 if n > 0:
+                    bump_generation()
                     return "Image has been successfully untagged"
                 else:
                     return "Image was already untagged"
@@ -400,30 +751,151 @@ class ImageController(object):
         self.tags = TagController()
     
     @cherrypy.expose
-    @cherrypy.tools.json_out()
+    @cached(encode_json=True)
     def details(self, image):
         image_folder = cherrypy.request.app.config['images']['path']
         full_path = os.path.join(current_dir, image_folder, image)
-        details = get_image_details(full_path).__dict__ # required for JSON serialization for some reason
-        details['tags'] = self.tags.list(image)
+        dbpath = cherrypy.request.app.config['database']['path']
+        with GoddamnDatabase(dbpath):
+            details = get_image_details(full_path).to_dict()
+            details['tags'] = list_tags(image)
         return details
+
+    @cherrypy.expose
+    @cached(encode_json=True)
+    def duplicates(self, image, distance=None):
+    # images that look like this one, closest first
+        max_distance = cherrypy.request.app.config.get('duplicates', {}).get('max_distance', 4)
+        if not distance == None:
+            try:
+                max_distance = min(max(int(distance), 0), 12)
+            except ValueError:
+                raise cherrypy.HTTPError(400, "The distance needs to be a goddamn number.")
+        image_folder = cherrypy.request.app.config['images']['path']
+        full_path = os.path.join(current_dir, image_folder, image)
+        dbpath = cherrypy.request.app.config['database']['path']
+        baseurl = get_base_url()
+        with GoddamnDatabase(dbpath):
+            i = select_hashed_image(full_path).first()
+            if i == None:
+                raise cherrypy.HTTPError(404, "Image \"{}\" does not exist".format(image))
+            found = find_duplicates(i, max_distance)
+        return {
+            "image": get_relative_path(baseurl, full_path),
+            "hashed": not i.phash == None,
+            "duplicates": [{ "image": get_relative_path(baseurl, path), "distance": d } for d, id, path in found]
+        }
     
     @cherrypy.expose
-    @cherrypy.tools.json_out()
-    def list(self, gallery=""):
-        model = get_viewmodel()
+    @cherrypy.config(**{ 'response.stream': True })
+    def list(self, gallery="", limit=None, after=None):
+    # every image at once, streamed as it's read, unless a limit or an after
+    # token asks for a page of them
         dbpath = cherrypy.request.app.config['database']['path']
         baseurl = get_base_url()
+        if gallery == None:
+            gallery = ""
+        cherrypy.response.headers['Content-Type'] = "application/json"
+
+        if limit == None and after == None:
+            return stream_image_list(dbpath, baseurl, gallery)
+
+        try:
+            limit = min(max(int(limit or 100), 1), 1000)
+        except ValueError:
+            raise cherrypy.HTTPError(400, "The limit needs to be a goddamn number.")
+        after = None if after == None else decode_cursor(after)
+
         result = {}
+        if not gallery == "":
+            result["gallery"] = gallery
+        with GoddamnDatabase(dbpath):
+            images = list(select_image_list(gallery, after, limit))
+        result["images"] = [get_relative_path(baseurl, path) for id, path in images]
+        result["next"] = encode_cursor(images[-1][1], images[-1][0]) if len(images) == limit else None
+        return json.dumps(result)
+
+def select_hashed_image(path):
+# what find_duplicates needs of the image at path
+    return Image.select(Image.id, Image.phash, Image.r, Image.g, Image.b).where(Image.path == path)
+
+def select_image_list(gallery, after=None, limit=1000):
+# image ids and paths in case-insensitive order, starting after an (path, id)
+    images = Image.select(Image.id, Image.path)
+    if not gallery == "":
+        images = images.where(Image.gallery == gallery)
+    if not after == None:
+        # The first half lets SQLite seek straight to the page
+        images = images.where(SQL("path COLLATE NOCASE >= ? AND (path COLLATE NOCASE > ? OR id > ?)", after[0], after[0], after[1]))
+    return images.order_by(SQL('path COLLATE NOCASE'), Image.id).limit(limit).tuples()
+
+def stream_image_list(dbpath, baseurl, gallery, chunk=1000):
+# the same JSON the API has always returned, a chunk of images at a time
+    if gallery == "":
+        yield '{"images": ['
+    else:
+        yield '{"gallery": ' + json.dumps(gallery) + ', "images": ['
+    after = None
+    separator = ""
+    while True:
         with GoddamnDatabase(dbpath):
-            images = Image.select()
-            if not gallery == "" and not gallery == None:
-                images = images.where(Image.gallery == gallery)
-                result["gallery"] = gallery
-                
-            images = images.order_by(SQL('path collate nocase'))
-            result["images"] = [get_relative_path(baseurl, i.path) for i in images]
-        return result
+            images = list(select_image_list(gallery, after, chunk))
+        if len(images) == 0:
+            break
+        yield separator + ", ".join(json.dumps(get_relative_path(baseurl, path)) for id, path in images)
+        separator = ", "
+        after = (images[-1][1], images[-1][0])
+    yield ']}'
+
+class ThumbnailController(object):
+    @cherrypy.expose
+    def render(self, size, image):
+        thumb_config = cherrypy.request.app.config['thumbnails']
+        try:
+            size = int(size)
+        except ValueError:
+            raise cherrypy.NotFound()
+        if not size in get_thumb_sizes(thumb_config['sizes']):
+            raise cherrypy.NotFound()
+
+        image_folder = os.path.join(current_dir, cherrypy.request.app.config['images']['path'])
+        full_path = os.path.normpath(os.path.join(image_folder, image))
+        if not full_path.startswith(image_folder + os.sep) or not os.path.isfile(full_path):
+            raise cherrypy.NotFound()
+
+        formats = get_thumb_formats(thumb_config['formats'])
+        format = 'jpeg'
+        if 'webp' in formats and 'image/webp' in cherrypy.request.headers.get('Accept', ''):
+            format = 'webp'
+
+        try:
+            path, key = get_thumbnail_cache().get(full_path, size, format, thumb_config['aspect_ratio'], thumb_config.get('draft', True))
+        except TimeoutError:
+            raise cherrypy.HTTPError(503, "The thumbnail is taking too goddamn long.")
+        except IOError:
+            raise cherrypy.HTTPError(415, "That isn't an image.")
+
+        cherrypy.response.headers['ETag'] = '"{}"'.format(key)
+        cherrypy.response.headers['Cache-Control'] = "public, max-age=86400"
+        cherrypy.response.headers['Vary'] = "Accept"
+        cherrypy.lib.cptools.validate_etags()
+        return cherrypy.lib.static.serve_file(path, "image/" + format)
+
+class MetricsController(object):
+    @cherrypy.expose
+    def index(self):
+    # everything measured so far, in Prometheus' text format
+        if not metrics.enabled:
+            raise cherrypy.NotFound()
+        cherrypy.response.headers['Content-Type'] = "text/plain; version=0.0.4"
+        body = metrics.render(metrics.web_metrics)
+        # The scraper runs on its own, and leaves what it measured by the database
+        try:
+            with open(os.path.join(cherrypy.request.app.config['database']['path'], 'scraper.prom')) as f:
+                body += f.read()
+        except IOError:
+            pass
+        return body
 
 class ApiController(object):
     def __init__(self):
@@ -434,15 +906,25 @@ class ApiController(object):
         return self
 
     @cherrypy.expose
-    @cherrypy.tools.json_out()
-    def search(self, q="", t=""):
+    @cached(encode_json=True)
+    def search(self, q="", t="", color="", limit="100"):
+        try:
+            limit = min(max(int(limit), 1), 1000)
+        except ValueError:
+            raise cherrypy.HTTPError(400, "The limit needs to be a goddamn number.")
+        if color != "":
+            rgb = parse_color(color)
+            if rgb == None:
+                raise cherrypy.HTTPError(400, "That isn't a goddamn color, try #RRGGBB.")
+            cherrypy.log("Executing search for color {}".format(format_color(rgb)))
+            return { "color" : format_color(rgb), "results" : search_images_by_color(rgb, limit) }
         if t != "":
             t = t.replace('+', ' ')
             cherrypy.log("Executing search for tags \"{}\"".format(t))
             tags = [tag.strip() for tag in t.split(' ') if tag and not tag.isspace()]
-            return { "tags" : t, "results" : find_images_by_tags(tags) }
+            return { "tags" : t, "results" : find_images_by_tags(tags, limit) }
         cherrypy.log("Executing search for \"{}\"".format(q))
-        return { "query" : q, "results" : find_images_by_name(q) }
+        return { "query" : q, "results" : search_images(get_search_query(q), limit) }
 
     @cherrypy.expose
     def slack(self, **kwargs):
@@ -482,15 +964,9 @@ class ApiController(object):
             if not username == None and not username == "":
                 message['username'] = username
             
-            p = urlparse(url)
-            con = httplib.HTTPSConnection(p.netloc)
-            con.request("POST", p.path, json.dumps(message))
-            
-            # Slack doesn't like when you return from your slash command
-            # before you receive the response from the webhook.  Weird.
-            response = con.getresponse()
-            response.read()
-
+            # Delivered in the background, Slack only waits 3 seconds for a reply
+            if not get_slack_dispatcher().send(url, message):
+                return "Slack's getting too many goddamn images at once, try again in a bit."
             return ""
         except:
             cherrypy.log("An error occurred while attempting to send an image to Slack.", traceback=True)
@@ -505,12 +981,15 @@ def configure_routes(script_name=''):
     dispatch.connect("add_tag", "/api/images/{image:.*?}/tags/{tag}", TagController(), action='add_tag', conditions={ "method": ["PUT", "PATCH"] })
     dispatch.connect("add_tag_post", "/api/images/{image:.*?}/tags", TagController(), action='add_tag', conditions={ "method": ["POST"] })
     dispatch.connect("image_tags", "/api/images/{image:.*?}/tags", TagController(), action='list')
+    dispatch.connect("image_duplicates", "/api/images/{image:.*?}/duplicates", ImageController(), action='duplicates')
     dispatch.connect("image", "/api/images/{image:.*?}", ImageController(), action='details')
     dispatch.connect("list_tags", "/api/tags", TagController(), action='list')
     dispatch.connect("api", "/api/images", ImageController(), action='list')
     dispatch.connect("api", "/api/list", ImageController(), action='list')
     dispatch.connect("search", "/api/search", ApiController(), action='search')
     dispatch.connect("slack", "/api/slack", ApiController(), action='slack')
+    dispatch.connect("thumbnail", "/thumbs/{size}/{image:.*?}", ThumbnailController(), action='render')
+    dispatch.connect("metrics", "/metrics", MetricsController(), action='index')
     dispatch.connect("account_login", "/account/login", AccountController(), action='handle_login', conditions={ "method": ["POST"] })
     dispatch.connect("account", "/account/{action}", AccountController(), action='index')
     dispatch.connect("gallery_page", "/{gallery:.*?}/page/:page", GalleryController(), action='index')
@@ -519,16 +998,32 @@ def configure_routes(script_name=''):
     route_config = { '/': { 'request.dispatch': dispatch } }
 
     application = cherrypy.tree.mount(root=None, script_name=script_name, config='gdg.conf')
+    metrics.enabled = application.config.get('metrics', {}).get('enabled', True)
+    route_config['/']['tools.metrics.on'] = metrics.enabled
     application.merge(route_config)
+    configure_database(application.config['database'])
+
+def prepare_database():
+# brings the configured database up to date, once per process
+    dbpath = application.config['database']['path']
+    if not dbpath in migrated_databases:
+        with GoddamnDatabase(dbpath) as db:
+            migrate_database(db)
+        migrated_databases.add(dbpath)
 
 def main():
     configure_routes()
+    prepare_database()
     cherrypy.log("Using database at {}".format(os.path.join(application.config['database']['path'], "gallery.db")))
     cherrypy.engine.start()
     cherrypy.engine.block()
 
 def wsgi(env, start_response, script_name=''):
+# configures the application on the first request, and hands every request to it
     global virtual_dir
-    virtual_dir = script_name
-    configure_routes(script_name)
+    with application_lock:
+        if application == None:
+            virtual_dir = script_name
+            configure_routes(script_name)
+            prepare_database()
     return cherrypy.tree(env, start_response)
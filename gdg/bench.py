@@ -0,0 +1,1417 @@
+import os
+import re
+import math
+import json
+import sys
+import time
+import errno
+import shutil
+import random
+import resource
+import tempfile
+import threading
+from StringIO import StringIO
+from multiprocessing import Process, Queue
+import PIL
+from PIL import ImageChops, ImageStat
+from gdg import scrape
+from peewee import fn
+from gdg.data import Image, Gallery, GoddamnDatabase, refresh_galleries, close_database
+
+def make_photo(path, size, seed=0):
+# writes a noisy gradient JPEG, which compresses about as badly as a real photo
+    rnd = random.Random(seed)
+    small = PIL.Image.new("RGB", (64, 48))
+    small.putdata([(rnd.randint(0, 255), rnd.randint(0, 255), rnd.randint(0, 255)) for _ in range(64 * 48)])
+    img = small.resize(size, PIL.Image.BILINEAR)
+    noise = PIL.Image.effect_noise(size, 40).convert("RGB")
+    img = ImageChops.add(img, noise, 2, -64)
+    img.save(path, "JPEG", quality=90)
+
+def make_photos(files, size):
+    for n, f in enumerate(files):
+        if not os.path.isfile(f):
+            make_photo(f, size, n)
+
+def percentile(values, p):
+    values = sorted(values)
+    if len(values) == 0:
+        return 0
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+def _thumbnail_worker(files, thumb_path, aspect_ratio, draft, queue):
+    options = { 'path': thumb_path, 'sizes': [200], 'formats': ['jpeg'], 'aspect_ratio': aspect_ratio, 'draft': draft }
+    times = []
+    results = []
+    for f in files:
+        i = Image(path=f)
+        start = time.time()
+        scrape.scrape_image_data((i, options))
+        times.append(time.time() - start)
+        results.append((f, i.thumb, (i.r, i.g, i.b)))
+    # ru_maxrss is in kilobytes on Linux
+    queue.put({ 'times': times, 'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, 'results': results })
+
+def run_thumbnails(files, thumb_path, aspect_ratio, draft):
+# runs in a fresh process so peak RSS belongs to this run alone
+    queue = Queue()
+    p = Process(target=_thumbnail_worker, args=(files, thumb_path, aspect_ratio, draft, queue))
+    p.start()
+    result = queue.get()
+    p.join()
+    return result
+
+def bench_thumbnails(count=10, size=(7728, 5152), aspect_ratio="square", workdir=None):
+# compares full decoding against draft mode on large JPEGs, returning timings,
+# peak RSS and how far the draft thumbnails and colors drift from the full ones
+    cleanup = workdir == None
+    if cleanup:
+        workdir = tempfile.mkdtemp(prefix="gdg-bench-")
+    try:
+        images = os.path.join(workdir, "images")
+        if not os.path.isdir(images):
+            os.makedirs(images)
+        files = [os.path.join(images, "photo_{:04d}.jpg".format(n)) for n in range(count)]
+        # Generated in another process so this one stays small for the workers it forks
+        p = Process(target=make_photos, args=(files, size))
+        p.start()
+        p.join()
+
+        report = { 'images': count, 'size': list(size), 'aspect_ratio': aspect_ratio }
+        runs = {}
+        for name, draft in [('full', False), ('draft', True)]:
+            thumbs = os.path.join(workdir, "thumbs_" + name)
+            if os.path.isdir(thumbs):
+                shutil.rmtree(thumbs)
+            os.makedirs(thumbs)
+            runs[name] = run_thumbnails(files, thumbs, aspect_ratio, draft)
+            times = runs[name]['times']
+            report[name] = {
+                'mean_ms': 1000 * sum(times) / len(times),
+                'p50_ms': 1000 * percentile(times, 50),
+                'p99_ms': 1000 * percentile(times, 99),
+                'peak_rss_kb': runs[name]['peak_rss_kb']
+            }
+
+        pixel_diffs = []
+        color_diffs = []
+        for (f, full_thumb, full_color), (_, draft_thumb, draft_color) in zip(runs['full']['results'], runs['draft']['results']):
+            a = PIL.Image.open(full_thumb)
+            b = PIL.Image.open(draft_thumb)
+            pixel_diffs.append(sum(ImageStat.Stat(ImageChops.difference(a, b)).mean) / 3)
+            color_diffs.append(max(abs(x - y) for x, y in zip(full_color, draft_color)))
+        report['mean_pixel_difference'] = sum(pixel_diffs) / len(pixel_diffs)
+        report['max_color_difference'] = max(color_diffs)
+        return report
+    finally:
+        if cleanup:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+def print_thumbnails(report):
+    print("{} images at {}x{}, {} thumbnails".format(report['images'], report['size'][0], report['size'][1], report['aspect_ratio']))
+    for name in ['full', 'draft']:
+        r = report[name]
+        print("  {:6} {:8.1f}ms/image (p50 {:.1f}ms, p99 {:.1f}ms), peak RSS {:.1f}MB".format(name, r['mean_ms'], r['p50_ms'], r['p99_ms'], r['peak_rss_kb'] / 1024.0))
+    print("  thumbnails differ by {:.2f}/255 on average, average colors by at most {}".format(report['mean_pixel_difference'], report['max_color_difference']))
+
+def get_image_name(n):
+    return "IMG_{:06d}.jpg".format(n)
+
+words = ["beach", "sunset", "cat", "kitten", "birthday", "party", "dog", "snow", "mountain", "lake", "goddamn", "wedding", "cake", "IMG", "DSC", "family", "holiday", "garden"]
+
+def get_photo_name(n):
+# names like people give their photos, from a small vocabulary so searches hit
+    rnd = random.Random(n)
+    sep = rnd.choice([" ", "_", "-", ""])
+    name = sep.join(rnd.choice(words) for _ in range(rnd.randint(1, 3)))
+    return "{}{}{:04d}.{}".format(name, sep, n % 10000, rnd.choice(["jpg", "jpg", "png", "gif"]))
+
+def get_gallery_name(n, galleries=20, shape="flat", depth=4):
+# which of galleries galleries image n goes in.  "flat" ones are all at the top,
+# "deep" ones are the leaves of a tree depth levels deep.
+    g = n % galleries
+    if shape == "flat":
+        return "gallery{:02d}".format(g)
+    fanout = max(int(math.ceil(galleries ** (1.0 / depth))), 2)
+    parts = []
+    for level in range(depth):
+        parts.append("level{}_{:02d}".format(level, g % fanout))
+        g //= fanout
+    return "/".join(parts)
+
+def make_library(workdir, count, galleries=20, name=get_image_name, shape="flat", collisions=0.0, tags=0, files=True, database=True):
+# a library of count small images spread over a few galleries, with a database
+# already describing them, so the web tier can be measured without scraping.
+# A share of them, collisions, are named the same as images in other galleries,
+# and each image gets up to three of tags random tags.  files=False leaves the
+# images out of the disk and database=False out of the database.
+    import sqlite3
+    from gdg.data import get_parent_gallery
+    images = os.path.join(workdir, "images")
+    samples = []
+    for n in range(16):
+        samples.append(os.path.join(workdir, "sample{}.jpg".format(n)))
+        PIL.Image.new("RGB", (64, 64), (200 - n * 8, 100 + n * 8, 50)).save(samples[-1], "JPEG")
+    if database:
+        conn = sqlite3.connect(os.path.join(workdir, "gallery.db"))
+        with open(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "gallery.sql")) as sql:
+            conn.executescript(sql.read())
+        tag_names = [w + str(n) for n, w in enumerate((words * (tags // len(words) + 1))[:tags])]
+        conn.executemany("INSERT INTO tags (name, slug) VALUES (?, ?)", [(t, t) for t in tag_names])
+    rnd = random.Random(count)
+    made = set()
+    rows = []
+    tagged = []
+    for n in range(count):
+        g = get_gallery_name(n, galleries, shape)
+        # The image in the same place in the first gallery, so none clash with
+        # another in their own
+        p = os.path.join(images, g, name(n - n % galleries if rnd.random() < collisions else n))
+        if files:
+            d = os.path.dirname(p)
+            if not d in made:
+                if not os.path.isdir(d):
+                    os.makedirs(d)
+                made.add(d)
+            if not os.path.exists(p):
+                try:
+                    os.link(samples[n % 16], p)
+                except OSError as ex:
+                    if not ex.errno == errno.EMLINK:
+                        raise
+                    # Out of links to that one, start on a copy
+                    shutil.copyfile(samples[n % 16], p)
+                    samples[n % 16] = p
+        if not database:
+            continue
+        rows.append((p, g, get_parent_gallery(g), os.path.getsize(samples[n % 16]), 64, 64, 200, 100, 50, random.Random(n).getrandbits(63)))
+        if tags > 0:
+            tagged.extend((n + 1, t + 1) for t in rnd.sample(range(tags), rnd.randint(0, min(3, tags))))
+        if len(rows) >= 10000 or n == count - 1:
+            conn.executemany("INSERT INTO images (path, gallery, parent, size, x, y, r, g, b, phash) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            conn.executemany("INSERT INTO tag_image (image_id, tag_id) VALUES (?, ?)", tagged)
+            rows = []
+            tagged = []
+    if database:
+        conn.commit()
+        conn.close()
+        with GoddamnDatabase(workdir) as db:
+            refresh_galleries(db)
+        close_database()
+    return images
+
+def wsgi_get(app, path, query=""):
+    environ = {
+        'REQUEST_METHOD': "GET", 'SCRIPT_NAME': "", 'PATH_INFO': path, 'QUERY_STRING': query,
+        'SERVER_NAME': "localhost", 'SERVER_PORT': "80", 'SERVER_PROTOCOL': "HTTP/1.1",
+        'HTTP_HOST': "localhost", 'REMOTE_ADDR': "127.0.0.1", 'wsgi.url_scheme': "http", 'wsgi.input': StringIO(), 'wsgi.errors': sys.stderr,
+        'wsgi.version': (1, 0), 'wsgi.multithread': True, 'wsgi.multiprocess': False, 'wsgi.run_once': False
+    }
+    status = []
+    result = app(environ, lambda s, headers, exc_info=None: status.append(s))
+    try:
+        body = "".join(result)
+    finally:
+        if hasattr(result, 'close'):
+            result.close()
+    return status[0], body
+
+def get_app(workdir, images):
+    import cherrypy
+    import gdg
+    cherrypy.config.update({ 'log.screen': False, 'environment': 'embedded' })
+    gdg.configure_routes()
+    gdg.application.config['database']['path'] = workdir
+    gdg.application.config['images']['path'] = images
+    return cherrypy.tree
+
+def run_load(app, paths, threads, requests):
+# requests GETs per thread, cycling through paths.  Returns the latencies and
+# how long the whole run took.
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    def worker(offset):
+        mine = []
+        for n in range(requests):
+            path, query = paths[(offset + n) % len(paths)]
+            start = time.time()
+            status, body = wsgi_get(app, path, query)
+            mine.append(time.time() - start)
+            if not status.startswith("200"):
+                with lock:
+                    errors.append((path, status))
+        with lock:
+            latencies.extend(mine)
+    workers = [threading.Thread(target=worker, args=(n * 7,)) for n in range(threads)]
+    start = time.time()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    return latencies, time.time() - start, errors
+
+def bench_connections(count=2000, threads=10, requests=200):
+# compares opening a connection per request against keeping one per thread
+    from gdg import data
+    workdir = tempfile.mkdtemp(prefix="gdg-bench-")
+    try:
+        images = make_library(workdir, count)
+        app = get_app(workdir, images)
+        paths = []
+        for n in range(0, count, max(1, count // 50)):
+            paths.append(("/api/images/gallery{:02d}/IMG_{:06d}.jpg".format(n % 20, n), ""))
+            paths.append(("/api/tags", ""))
+        report = { 'images': count, 'threads': threads, 'requests': threads * requests }
+        for name, persistent in [('per_request', False), ('persistent', True)]:
+            data.persistent_connections = persistent
+            wsgi_get(app, *paths[0])
+            latencies, elapsed, errors = run_load(app, paths, threads, requests)
+            report[name] = {
+                'requests_per_second': len(latencies) / elapsed,
+                'p50_ms': 1000 * percentile(latencies, 50),
+                'p99_ms': 1000 * percentile(latencies, 99),
+                'errors': len(errors)
+            }
+        data.persistent_connections = True
+        return report
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def print_connections(report):
+    print("{} requests from {} threads against {} images".format(report['requests'], report['threads'], report['images']))
+    for name in ['per_request', 'persistent']:
+        r = report[name]
+        print("  {:12} {:8.1f} req/s (p50 {:.1f}ms, p99 {:.1f}ms), {} errors".format(name, r['requests_per_second'], r['p50_ms'], r['p99_ms'], r['errors']))
+
+def get_hot_queries():
+# the queries every page view or scrape runs, as (name, peewee query)
+    import gdg
+    from gdg.data import TagImage
+    from gdg.duplicates import select_similar
+    from gdg.colors import select_colors_near
+    p = "/images/gallery01/IMG_000001.jpg"
+    page = gdg.select_gallery_images("gallery01")
+    tagged = gdg.select_gallery_images("gallery01", "cats")
+    return [
+        ('image by path', Image.select().where(Image.path == p)),
+        ('gallery count', gdg.select_gallery_count("gallery01")),
+        ('gallery page', gdg.select_page_number(page, 3, 20).select(*gdg.model_columns)),
+        ('child galleries', gdg.select_child_galleries("")),
+        # What count() runs
+        ('tagged gallery count', tagged._aggregate()),
+        ('tagged gallery page', gdg.select_page_number(tagged, 1, 20).select(*gdg.model_columns)),
+        ('tags for page', gdg.select_image_tags(range(1, 21))),
+        ('tags for image', gdg.select_tags_for_image(p)),
+        ('images by tags', gdg.select_images_by_tags(["cats", "dogs"]).limit(100)),
+        ('tag on image', TagImage.select().where(TagImage.tag == 1, TagImage.image == 1)),
+        ('gallery page after', gdg.select_page_after(page, p, 20).select(*gdg.model_columns)),
+        ('gallery page before', gdg.select_page_before(page, p, 20).select(*gdg.model_columns)),
+        ('last gallery page', gdg.select_page_before(page, None, 20).select(*gdg.model_columns)),
+        ('image list after', gdg.select_image_list("", (p, 1), 100)),
+        ('gallery list after', gdg.select_image_list("gallery01", (p, 1), 100)),
+        ('known images', Image.select(Image.id, Image.path).where(Image.path > p).order_by(Image.path).limit(1000)),
+        ('image to match', gdg.select_hashed_image(p)),
+        ('similar images', select_similar(0x0123456789abcdef, 4)),
+        ('search', gdg.select_search(gdg.get_search_query("cat gallery:memes #reaction"), 100)),
+        ('colors near', select_colors_near((50.0, 20.0, -10.0), 25.0)),
+    ]
+
+# A virtual table "scanned" with a constraint, like FTS5 with a MATCH, is
+# looked up through the table's own index
+virtual_lookup = re.compile(r"VIRTUAL TABLE INDEX \d+:\S+")
+
+def is_full_scan(line):
+    return line.startswith("SCAN") and not "USING" in line and virtual_lookup.search(line) == None
+
+def explain(db, query):
+# the plan of a peewee query, or of (sql, params) for queries written out in SQL
+    sql, params = query if isinstance(query, tuple) else query.sql()
+    return [row[-1] for row in db.execute_sql("EXPLAIN QUERY PLAN " + sql, params).fetchall()]
+
+# gallery.sql as it was before the database had a version, which every
+# migration has to be able to start from
+original_schema = """
+CREATE TABLE images (
+    id      INTEGER         PRIMARY KEY AUTOINCREMENT,
+    path    VARCHAR( 255 )  NOT NULL,
+    thumb   VARCHAR( 255 ),
+    gallery VARCHAR( 255 )  NOT NULL,
+    parent  VARCHAR( 255 ),
+    x       INTEGER,
+    y       INTEGER,
+    r       INTEGER,
+    g       INTEGER,
+    b       INTEGER
+);
+CREATE TABLE tags (
+    id   INTEGER         PRIMARY KEY,
+    name VARCHAR( 128 )  NOT NULL
+                         UNIQUE,
+    slug VARCHAR( 128 )  NOT NULL
+                         UNIQUE
+);
+CREATE TABLE tag_image (
+    id       INTEGER PRIMARY KEY,
+    image_id INTEGER NOT NULL
+                     REFERENCES images ( id ) ON DELETE CASCADE,
+    tag_id   INTEGER NOT NULL
+                     REFERENCES tags ( id ) ON DELETE CASCADE
+);
+CREATE TABLE users (
+    id    INTEGER PRIMARY KEY,
+    name  VARCHAR( 128 ) NOT NULL
+                        UNIQUE,
+    email VARCHAR( 512 ) NOT NULL,
+    hash  VARCHAR( 128 ) NOT NULL
+);
+CREATE VIEW images_by_tag AS
+       SELECT t.name AS tag_name, t.slug AS tag_slug, i.*
+         FROM tags t
+              LEFT JOIN tag_image ti ON ti.tag_id = t.id
+              LEFT JOIN images i ON i.id = ti.image_id;
+CREATE VIEW tags_by_image AS
+       SELECT i.path, t.*
+         FROM images i
+              LEFT JOIN tag_image ti ON ti.image_id = i.id
+              LEFT JOIN tags t ON t.id = ti.tag_id;
+"""
+
+def check_upgrade():
+# migrates a database made from original_schema, with a few images and tags in
+# it, to the latest version, and checks they all survive
+    import sqlite3
+    from gdg import select_image_tags
+    from gdg.data import migrate_database, migrations
+    workdir = tempfile.mkdtemp(prefix="gdg-bench-")
+    try:
+        images = [("/images/a.jpg", ""), ("/images/cats/b.jpg", "cats"), ("/images/cats/old/c.jpg", "cats/old")]
+        conn = sqlite3.connect(os.path.join(workdir, "gallery.db"))
+        conn.executescript(original_schema)
+        conn.executemany("INSERT INTO images (path, gallery, parent, r, g, b) VALUES (?, ?, ?, 10, 20, 30)", [(p, g, os.path.dirname(g) if g else None) for p, g in images])
+        conn.executemany("INSERT INTO tags (name, slug) VALUES (?, ?)", [("cats", "cats"), ("old", "old")])
+        # Tagged twice over, from before that was prevented
+        conn.executemany("INSERT INTO tag_image (image_id, tag_id) VALUES (?, ?)", [(2, 1), (3, 1), (3, 2), (3, 2)])
+        conn.commit()
+        conn.close()
+
+        report = { 'expected': len(migrations), 'version': None, 'error': None }
+        try:
+            with GoddamnDatabase(workdir) as db:
+                report['version'] = migrate_database(db)
+                report['images'] = sorted(Image.select(Image.path, Image.gallery).tuples()) == sorted(images)
+                tags = {}
+                for id, name in select_image_tags([1, 2, 3]).tuples():
+                    tags.setdefault(id, []).append(name)
+                report['tags'] = tags == { 2: ["cats"], 3: ["cats", "old"] }
+                report['galleries'] = dict(Gallery.select(Gallery.path, Gallery.total).tuples()) == { "": 3, "cats": 2, "cats/old": 1 }
+        except Exception as ex:
+            report['error'] = "{}: {}".format(ex.__class__.__name__, ex)
+        finally:
+            close_database()
+        report['ok'] = report['error'] == None and report['version'] == report['expected'] and all(report.get(k) for k in ['images', 'tags', 'galleries'])
+        return report
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def check_query_plans(count=2000):
+# runs EXPLAIN QUERY PLAN on the hot queries against a generated library.  A
+# query fails if it scans a whole table, or sorts a whole table to page it.
+    from gdg.data import migrate_database
+    workdir = tempfile.mkdtemp(prefix="gdg-bench-")
+    try:
+        make_library(workdir, count)
+        report = { 'images': count, 'queries': [] }
+        with GoddamnDatabase(workdir) as db:
+            report['version'] = migrate_database(db)
+            db.execute_sql("ANALYZE")
+            for name, query in get_hot_queries():
+                plan = explain(db, query)
+                scans = [line for line in plan if is_full_scan(line)]
+                report['queries'].append({ 'name': name, 'plan': plan, 'indexed': len(scans) == 0 })
+        close_database()
+        report['upgrade'] = check_upgrade()
+        return report
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def print_query_plans(report):
+    print("Schema version {}, {} images".format(report['version'], report['images']))
+    u = report['upgrade']
+    if u['ok']:
+        print("  upgraded an unversioned database to version {}".format(u['version']))
+    else:
+        print("  upgrading an unversioned database FAILED at version {} of {}: {}".format(u['version'], u['expected'], u['error'] or ", ".join(k for k in ['images', 'tags', 'galleries'] if not u.get(k))))
+    for q in report['queries']:
+        print("  {:20} {}".format(q['name'], "ok" if q['indexed'] else "FULL SCAN"))
+        for line in q['plan']:
+            print("      " + line)
+
+def bench_names(count=100000, queries=200, max_dist=5):
+# compares the name index against matching a regex on every row, which is what
+# name searches used to do, and checks that both rank the results the same way
+    import gdg
+    from gdg.names import NameIndex
+    from gdg.data import migrate_database
+    workdir = tempfile.mkdtemp(prefix="gdg-bench-")
+    try:
+        make_library(workdir, count, name=get_photo_name)
+        rnd = random.Random(1)
+        texts = []
+        for n in range(queries):
+            name = get_photo_name(rnd.randint(0, count - 1))
+            choice = n % 4
+            if choice == 0:
+                texts.append(name)
+            elif choice == 1:
+                texts.append(os.path.splitext(name)[0])
+            elif choice == 2:
+                texts.append(" ".join(rnd.sample(words, 2)))
+            else:
+                texts.append(rnd.choice(words))
+
+        def rank(text, found):
+            if len(found) > 1:
+                found = list(gdg.filter_images_by_lev(text, found, max_dist))
+            else:
+                found = [{ 'image': path, 'distance': 0 } for path, f in found]
+            return [m['image'] for m in sorted(found, key=lambda m: (m['distance'], m['image'].lower()))]
+
+        report = { 'images': count, 'queries': queries }
+        scan_times = []
+        index_times = []
+        mismatches = 0
+        with GoddamnDatabase(workdir) as db:
+            migrate_database(db)
+            start = time.time()
+            NameIndex(os.path.join(workdir, 'gallery.names')).refresh(db)
+            report['build_ms'] = 1000 * (time.time() - start)
+            index = NameIndex(os.path.join(workdir, 'gallery.names'))
+            start = time.time()
+            index.refresh(db)
+            report['load_ms'] = 1000 * (time.time() - start)
+            paths = dict(Image.select(Image.id, Image.path).tuples())
+
+            for text in texts:
+                pattern = gdg.get_name_pattern(text)
+                start = time.time()
+                scanned = [(p, os.path.basename(p)) for (p,) in Image.select(Image.path).where(Image.path.regexp(pattern)).tuples()]
+                scanned = rank(text, scanned)
+                scan_times.append(time.time() - start)
+
+                start = time.time()
+                found = rank(text, [(paths[id], f) for id, f in index.find(pattern, text)])
+                index_times.append(time.time() - start)
+
+                # Only file names count now, not the folders they're in
+                if not found == [p for p in scanned if re.search(pattern, os.path.basename(p), re.I)]:
+                    mismatches += 1
+        close_database()
+
+        for name, times in [('scan', scan_times), ('index', index_times)]:
+            report[name] = {
+                'mean_ms': 1000 * sum(times) / len(times),
+                'p50_ms': 1000 * percentile(times, 50),
+                'p99_ms': 1000 * percentile(times, 99)
+            }
+        report['mismatches'] = mismatches
+        return report
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def print_names(report):
+    print("{} searches against {} images, index built in {:.0f}ms and loaded in {:.0f}ms".format(report['queries'], report['images'], report['build_ms'], report['load_ms']))
+    for name in ['scan', 'index']:
+        r = report[name]
+        print("  {:6} {:8.2f}ms/search (p50 {:.2f}ms, p99 {:.2f}ms)".format(name, r['mean_ms'], r['p50_ms'], r['p99_ms']))
+    print("  {} searches ranked differently".format(report['mismatches']))
+
+def misspell(rnd, text, edits):
+    for _ in range(edits):
+        n = rnd.randint(0, len(text))
+        c = rnd.choice("abcdefghijklmnopqrstuvwxyz_ 0123456789")
+        choice = rnd.randint(0, 2)
+        if choice == 0 or len(text) == 0:
+            text = text[:n] + c + text[n:]
+        elif choice == 1:
+            text = text[:n] + c + text[n + 1:]
+        else:
+            text = text[:n] + text[n + 1:]
+    return text
+
+def bench_levenshtein(candidates=20000, queries=50, max_dist=5):
+# times ranking a search's candidates with each way of working out distances
+# against the plain one, and checks they all come up with the same distances
+    import gdg
+    from gdg import fuzzy
+    rnd = random.Random(1)
+    names = []
+    for n in range(candidates):
+        choice = n % 3
+        if choice == 0:
+            names.append(get_photo_name(n))
+        elif choice == 1:
+            names.append(get_image_name(n))
+        else:
+            names.append("DSC_{:04d}.JPG".format(n % 10000))
+    names = [gdg.extension.sub("", f).lower() for f in names]
+    texts = [misspell(rnd, rnd.choice(names), rnd.randint(0, 3)) for _ in range(queries)]
+
+    def reference(text, names, max_dist):
+        results = []
+        for f in names:
+            d = None
+            if abs(len(f) - len(text)) <= max_dist:
+                d = gdg.levenshtein(text, f)
+            results.append(d if not d == None and d <= max_dist else None)
+        return results
+
+    backends = [('reference', reference), ('python', fuzzy.python_distances)]
+    if not fuzzy.numpy == None:
+        backends.append(('numpy', fuzzy.numpy_distances))
+
+    report = { 'candidates': candidates, 'queries': queries, 'max_dist': max_dist, 'backends': {} }
+    expected = []
+    mismatches = 0
+    for name, distances in backends:
+        times = []
+        for n, text in enumerate(texts):
+            start = time.time()
+            found = distances(text, names, max_dist)
+            times.append(time.time() - start)
+            if name == 'reference':
+                expected.append(found)
+            elif not found == expected[n]:
+                mismatches += 1
+        report['backends'][name] = {
+            'mean_ms': 1000 * sum(times) / len(times),
+            'p99_ms': 1000 * percentile(times, 99),
+            'names_per_second': candidates * len(times) / sum(times)
+        }
+    report['matches'] = sum(len([d for d in found if not d == None]) for found in expected)
+    report['mismatches'] = mismatches
+    return report
+
+def print_levenshtein(report):
+    print("{} searches over {} names, within {} edits ({} matches)".format(report['queries'], report['candidates'], report['max_dist'], report['matches']))
+    for name in ['reference', 'python', 'numpy']:
+        r = report['backends'].get(name)
+        if not r == None:
+            print("  {:9} {:8.2f}ms/search (p99 {:.2f}ms), {:.0f} names/s".format(name, r['mean_ms'], r['p99_ms'], r['names_per_second']))
+    print("  {} searches with different distances".format(report['mismatches']))
+
+def bench_duplicates(count=100000, queries=200, max_distance=4):
+# times finding an image's duplicates through the hash indexes against comparing
+# it with every image, then times grouping them all, and checks the results agree,
+# along with what the API answers.  The hashes are random, with a fifth of the
+# images made slightly changed copies of others, some of them in another color.
+    import gdg
+    from gdg import duplicates
+    from gdg.data import migrate_database
+    from gdg.responses import ResponseCache
+    workdir = tempfile.mkdtemp(prefix="gdg-bench-")
+    try:
+        images = make_library(workdir, count)
+        rnd = random.Random(1)
+        rows = []
+        for id in range(1, count + 1):
+            if len(rows) > 0 and rnd.random() < 0.2:
+                h, r, g, b = rows[rnd.randint(0, len(rows) - 1)][:4]
+                h = duplicates.to_unsigned(h)
+                for _ in range(rnd.randint(0, max_distance + 2)):
+                    h ^= 1 << rnd.randint(0, duplicates.hash_bits - 1)
+                r, g, b = [min(255, max(0, c + rnd.randint(-8, 8))) for c in (r, g, b)]
+                # The same picture in a different color isn't a duplicate
+                if rnd.random() < 0.25:
+                    r, g, b = 255 - r, 255 - g, 255 - b
+            else:
+                h = rnd.getrandbits(duplicates.hash_bits)
+                r, g, b = rnd.randint(0, 255), rnd.randint(0, 255), rnd.randint(0, 255)
+            rows.append((duplicates.to_signed(h), r, g, b, id))
+
+        report = { 'images': count, 'queries': queries, 'max_distance': max_distance }
+        expected = {}
+        lookup_times = []
+        scan_times = []
+        mismatches = 0
+        with GoddamnDatabase(workdir) as db:
+            migrate_database(db)
+            with db.transaction():
+                db.get_cursor().executemany("UPDATE images SET phash = ?, r = ?, g = ?, b = ? WHERE id = ?", rows)
+            db.execute_sql("ANALYZE")
+
+            start = time.time()
+            clusters = duplicates.find_duplicate_clusters(max_distance)
+            report['clusters_s'] = time.time() - start
+            report['clusters'] = len(clusters)
+            report['clustered'] = sum(len(c) for c in clusters)
+            cluster_of = {}
+            for n, c in enumerate(clusters):
+                for id in c:
+                    cluster_of[id] = n
+
+            # Every duplicate the slow way finds has to be found the fast way, and be in the same group
+            cluster_mismatches = 0
+            for h, r, g, b, id in rnd.sample(rows, queries):
+                start = time.time()
+                found = duplicates.find_duplicates(Image(id=id, phash=h, r=r, g=g, b=b), max_distance)
+                lookup_times.append(time.time() - start)
+
+                start = time.time()
+                scanned = [other for oh, orr, og, ob, other in rows if not other == id and duplicates.hamming(h, oh) <= max_distance and duplicates.similar_colors((r, g, b), (orr, og, ob))]
+                scan_times.append(time.time() - start)
+
+                if not sorted(scanned) == sorted(f[1] for f in found):
+                    mismatches += 1
+                if any(not cluster_of.get(other) == cluster_of.get(id) for other in scanned):
+                    cluster_mismatches += 1
+                expected[id] = scanned
+            paths = dict(Image.select(Image.id, Image.path).tuples())
+        close_database()
+
+        # The API has to find the same ones, from just the image's path
+        ids = dict((p, id) for id, p in paths.iteritems())
+        app = get_app(workdir, images)
+        gdg.response_cache = ResponseCache(0)
+        route_mismatches = 0
+        for id in sorted(expected)[0:50]:
+            status, body = wsgi_get(app, "/api/images/" + os.path.relpath(paths[id], images) + "/duplicates", "distance={}".format(max_distance))
+            if not status.startswith("200"):
+                route_mismatches += 1
+                continue
+            found = [ids.get(os.path.join(images, d['image'].split("/images/")[-1])) for d in json.loads(body)['duplicates']]
+            if not sorted(found) == sorted(expected[id]):
+                route_mismatches += 1
+
+        for name, times in [('scan', scan_times), ('lookup', lookup_times)]:
+            report[name] = {
+                'mean_ms': 1000 * sum(times) / len(times),
+                'p50_ms': 1000 * percentile(times, 50),
+                'p99_ms': 1000 * percentile(times, 99)
+            }
+        report['mismatches'] = mismatches
+        report['cluster_mismatches'] = cluster_mismatches
+        report['route_mismatches'] = route_mismatches
+        return report
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def print_duplicates(report):
+    print("{} images, duplicates within {} bits".format(report['images'], report['max_distance']))
+    for name in ['scan', 'lookup']:
+        r = report[name]
+        print("  {:6} {:8.2f}ms/image (p50 {:.2f}ms, p99 {:.2f}ms)".format(name, r['mean_ms'], r['p50_ms'], r['p99_ms']))
+    print("  grouped {} images into {} groups in {:.1f}s".format(report['clustered'], report['clusters'], report['clusters_s']))
+    print("  {} images with different duplicates, {} split from theirs, {} different through the API".format(report['mismatches'], report['cluster_mismatches'], report['route_mismatches']))
+
+def bench_colors(count=100000, queries=200, limit=100, max_distance=25.0):
+# times searching by color through the grid against comparing every image's
+# colors, and checks that both find the same images in the same order
+    from gdg import colors
+    from gdg.data import ImageColor, migrate_database, update_rows
+    workdir = tempfile.mkdtemp(prefix="gdg-bench-")
+    try:
+        make_library(workdir, count)
+        rnd = random.Random(1)
+        report = { 'images': count, 'queries': queries, 'limit': limit, 'max_distance': max_distance }
+        search_times = []
+        scan_times = []
+        mismatches = 0
+        with GoddamnDatabase(workdir) as db:
+            migrate_database(db)
+            rows = []
+            for id in range(1, count + 1):
+                # Photos lean towards dull colors, so these do too
+                shares = sorted((rnd.randint(5, 60) for _ in range(3)), reverse=True)
+                picked = [(tuple(int(rnd.betavariate(2, 2) * 255) for _ in range(3)), share) for share in shares]
+                rows.append((id, colors.format_colors(picked)))
+            with db.transaction():
+                update_rows(Image, ['colors'], rows)
+                colors.index_colors([Image(id=id, colors=text) for id, text in rows])
+            db.execute_sql("ANALYZE")
+            indexed = list(ImageColor.select(ImageColor.image, ImageColor.share, ImageColor.l, ImageColor.a, ImageColor.b).tuples())
+
+            for n in range(queries):
+                rgb = (rnd.randint(0, 255), rnd.randint(0, 255), rnd.randint(0, 255))
+                start = time.time()
+                found = colors.find_images_by_color(rgb, limit, max_distance)
+                search_times.append(time.time() - start)
+
+                start = time.time()
+                lab = colors.to_lab(rgb)
+                best = {}
+                for id, share, l, a, b in indexed:
+                    d = colors.get_distance(lab, (l, a, b))
+                    if d <= max_distance and (not id in best or (d, -share) < best[id]):
+                        best[id] = (d, -share)
+                scanned = [id for id, rank in sorted(best.iteritems(), key=lambda f: (f[1], f[0]))[:limit]]
+                scan_times.append(time.time() - start)
+
+                # The search can stop early, once it has enough that are closer than the rest
+                if not found == scanned:
+                    mismatches += 1
+        close_database()
+
+        for name, times in [('scan', scan_times), ('grid', search_times)]:
+            report[name] = {
+                'mean_ms': 1000 * sum(times) / len(times),
+                'p50_ms': 1000 * percentile(times, 50),
+                'p99_ms': 1000 * percentile(times, 99)
+            }
+        report['mismatches'] = mismatches
+        return report
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def print_colors(report):
+    print("{} color searches against {} images, the best {} within {}".format(report['queries'], report['images'], report['limit'], report['max_distance']))
+    for name in ['scan', 'grid']:
+        r = report[name]
+        print("  {:6} {:8.2f}ms/search (p50 {:.2f}ms, p99 {:.2f}ms)".format(name, r['mean_ms'], r['p50_ms'], r['p99_ms']))
+    print("  {} searches found different images".format(report['mismatches']))
+
+def make_exif(orientation=1, taken="2019:06:01 12:00:00", make="Goddamn", model="Goddamn Camera 1"):
+# the smallest EXIF block a phone might write, for the tags the scraper reads
+    import struct
+    def entries(tags, offset):
+        # (tag, type, value) as an IFD starting at offset, followed by its strings
+        head = struct.pack("<H", len(tags))
+        data = ""
+        start = offset + 2 + 12 * len(tags) + 4
+        for tag, kind, value in tags:
+            if kind == 2:
+                value += "\x00"
+                if len(value) <= 4:
+                    head += struct.pack("<HHI", tag, kind, len(value)) + value.ljust(4, "\x00")
+                else:
+                    head += struct.pack("<HHII", tag, kind, len(value), start + len(data))
+                    data += value
+            else:
+                head += struct.pack("<HHII", tag, kind, 1, value)
+        return head + struct.pack("<I", 0) + data
+    ifd0 = [(271, 2, make), (272, 2, model), (274, 3, orientation), (0x8769, 4, 0)]
+    size = len(entries(ifd0, 8))
+    ifd0[3] = (0x8769, 4, 8 + size)
+    tiff = "II*\x00" + struct.pack("<I", 8) + entries(ifd0, 8) + entries([(36867, 2, taken)], 8 + size)
+    return "Exif\x00\x00" + tiff
+
+def bench_metadata(count=50, size=(4000, 3000)):
+# compares reading what the metadata pass needs from the headers against
+# decoding the whole image, which is what getting it used to take
+    from gdg import metadata
+    workdir = tempfile.mkdtemp(prefix="gdg-bench-")
+    try:
+        small = PIL.Image.new("RGB", (64, 48))
+        small.putdata([(n % 256, (n * 7) % 256, (n * 13) % 256) for n in range(64 * 48)])
+        files = []
+        for n in range(count):
+            f = os.path.join(workdir, "photo_{:04d}.jpg".format(n))
+            if n == 0:
+                small.resize(size, PIL.Image.BILINEAR).save(f, "JPEG", quality=90, exif=make_exif(6))
+            else:
+                os.link(files[0], f)
+            files.append(f)
+
+        report = { 'images': count, 'size': list(size) }
+        header_times = []
+        decode_times = []
+        wrong = 0
+        for f in files:
+            start = time.time()
+            found = metadata.read_image_metadata(f)
+            header_times.append(time.time() - start)
+
+            start = time.time()
+            image = PIL.Image.open(f)
+            image.load()
+            decode_times.append(time.time() - start)
+
+            if not (found['x'], found['y'], found['orientation'], found['taken']) == (size[1], size[0], 6, "2019-06-01 12:00:00"):
+                wrong += 1
+
+        for name, times in [('decode', decode_times), ('headers', header_times)]:
+            report[name] = {
+                'mean_ms': 1000 * sum(times) / len(times),
+                'p99_ms': 1000 * percentile(times, 99)
+            }
+        report['wrong'] = wrong
+        return report
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def print_metadata(report):
+    print("{} images of {}x{}".format(report['images'], report['size'][0], report['size'][1]))
+    for name in ['decode', 'headers']:
+        r = report[name]
+        print("  {:8} {:8.2f}ms/image (p99 {:.2f}ms)".format(name, r['mean_ms'], r['p99_ms']))
+    print("  {} images read wrong".format(report['wrong']))
+
+def bench_writes(count=100000):
+# times what the scraper writes for a fresh import, a row at a time the way it
+# used to against in bulk, then checks both databases ended up the same
+    from gdg import colors
+    from gdg.data import ImageColor, migrate_database, insert_rows, update_rows, delete_rows
+    workdir = tempfile.mkdtemp(prefix="gdg-bench-")
+    try:
+        rnd = random.Random(1)
+        rows = []
+        results = []
+        for n in range(count):
+            g = "gallery{:02d}".format(n % 20)
+            rows.append({ 'path': os.path.join(workdir, "images", g, get_image_name(n)), 'gallery': g, 'parent': '', 'mtime': 1500000000.0 + n, 'size': 1000 + n, 'inode': n, 'hash': "{:032x}".format(rnd.getrandbits(128)) })
+            picked = [((rnd.randint(0, 255), rnd.randint(0, 255), rnd.randint(0, 255)), share) for share in (50, 30, 20)]
+            results.append((n + 1, "/thumbs/{}.jpg".format(n), "{:040x}".format(n), None, 640, 480, rnd.randint(0, 255), rnd.randint(0, 255), rnd.randint(0, 255), rnd.getrandbits(63), colors.format_colors(picked), 1, None, None, 1))
+        deleted = range(1, count + 1, 3)
+
+        report = { 'images': count, 'deleted': len(deleted) }
+        dumps = {}
+        for way in ['rows', 'bulk']:
+            path = os.path.join(workdir, way)
+            os.makedirs(path)
+            times = {}
+            with GoddamnDatabase(path) as db:
+                migrate_database(db)
+
+                start = time.time()
+                if way == 'rows':
+                    for b in range(0, count, 50):
+                        with db.transaction():
+                            for row in rows[b:b+50]:
+                                Image(**row).save()
+                else:
+                    for b in range(0, count, scrape.write_size):
+                        with db.transaction():
+                            insert_rows(Image, rows[b:b+scrape.write_size])
+                times['insert'] = time.time() - start
+
+                # Processing results are saved in batches of the same size either way
+                start = time.time()
+                for b in range(0, count, scrape.batch_size):
+                    batch = results[b:b+scrape.batch_size]
+                    with db.transaction():
+                        if way == 'rows':
+                            for r in batch:
+                                Image.update(**dict(zip(scrape.derived_columns, r[1:]))).where(Image.id == r[0]).execute()
+                                colors.index_colors([Image(id=r[0], colors=r[10])])
+                        else:
+                            update_rows(Image, scrape.derived_columns, batch)
+                            colors.index_colors([Image(id=r[0], colors=r[10]) for r in batch])
+                times['save'] = time.time() - start
+
+                start = time.time()
+                if way == 'rows':
+                    for b in range(0, len(deleted), 50):
+                        with db.transaction():
+                            Image.delete().where(Image.id << deleted[b:b+50]).execute()
+                else:
+                    for b in range(0, len(deleted), scrape.write_size):
+                        with db.transaction():
+                            delete_rows(Image, deleted[b:b+scrape.write_size])
+                times['delete'] = time.time() - start
+
+                dumps[way] = [db.execute_sql(sql).fetchall() for sql in ["SELECT * FROM images ORDER BY id", "SELECT image_id, color, share, cell FROM image_colors ORDER BY image_id, color", "SELECT rowid, * FROM image_search ORDER BY rowid"]]
+            close_database()
+            report[way] = dict((name, 1000 * t) for name, t in times.iteritems())
+
+        report['mismatches'] = sum(len(set(a) ^ set(b)) for a, b in zip(dumps['rows'], dumps['bulk']))
+        return report
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def print_writes(report):
+    print("{} images inserted, saved and {} of them deleted".format(report['images'], report['deleted']))
+    for name in ['insert', 'save', 'delete']:
+        rows, bulk = report['rows'][name], report['bulk'][name]
+        print("  {:8} {:10.0f}ms a row at a time, {:8.0f}ms in bulk ({:.1f}x)".format(name, rows, bulk, rows / max(bulk, 0.001)))
+    print("  {} rows differ".format(report['mismatches']))
+
+def walk_serially(path):
+# the scraper's walk before it listed directories in parallel, to check against
+    import stat
+    import mimetypes
+    entries = []
+    for name in os.listdir(path):
+        full = os.path.join(path, name)
+        st = os.stat(full)
+        if stat.S_ISDIR(st.st_mode):
+            entries.append((name + '/', full, None))
+        elif (mimetypes.guess_type(name)[0] or "").startswith('image'):
+            entries.append((name, full, st))
+    entries.sort()
+    for key, full, st in entries:
+        if st == None:
+            for f in walk_serially(full):
+                yield f
+        else:
+            yield full, st
+
+def bench_walk(directories=200, files=50, latency=2.0, threads=8):
+# times walking a tree of directories with every listdir() and stat() taking
+# latency milliseconds longer, like a network share, one directory at a time
+# against the parallel walker, and checks both find the same files in order
+    from gdg import walk
+    workdir = tempfile.mkdtemp(prefix="gdg-bench-")
+    listdir, stat = os.listdir, os.stat
+    scandir = walk.scandir
+    try:
+        sample = os.path.join(workdir, "sample.jpg")
+        PIL.Image.new("RGB", (8, 8)).save(sample, "JPEG")
+        root = os.path.join(workdir, "images")
+        for d in range(directories):
+            path = os.path.join(root, "year{}".format(d % 10), "gallery{:04d}".format(d))
+            os.makedirs(path)
+            for n in range(files):
+                # Some of everything a real share has lying around
+                name = get_image_name(n) if n % 10 else "notes{}.txt".format(n)
+                os.link(sample, os.path.join(path, name))
+
+        def slow(f):
+            def call(*args):
+                time.sleep(latency / 1000.0)
+                return f(*args)
+            return call
+        os.listdir, os.stat = slow(listdir), slow(stat)
+        # Both are timed on listdir() and stat() alone
+        walk.scandir = None
+
+        report = { 'directories': directories, 'files': directories * files, 'latency_ms': latency, 'threads': threads }
+        start = time.time()
+        serial = [f for f, st in walk_serially(root)]
+        report['serial_ms'] = 1000 * (time.time() - start)
+        start = time.time()
+        parallel = [f for f, st in walk.get_image_files(root, threads=threads)]
+        report['parallel_ms'] = 1000 * (time.time() - start)
+        report['found'] = len(parallel)
+        report['mismatches'] = 0 if serial == parallel else max(len(set(serial) ^ set(parallel)), 1)
+        return report
+    finally:
+        os.listdir, os.stat = listdir, stat
+        walk.scandir = scandir
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def print_walk(report):
+    print("{} files in {} directories, {}ms a call".format(report['files'], report['directories'], report['latency_ms']))
+    print("  serial   {:8.0f}ms".format(report['serial_ms']))
+    print("  parallel {:8.0f}ms on {} threads ({:.1f}x)".format(report['parallel_ms'], report['threads'], report['serial_ms'] / max(report['parallel_ms'], 0.001)))
+    print("  {} images found, {} out of place".format(report['found'], report['mismatches']))
+
+def start_webhook_stub(latency=5.0):
+# a stand-in for Slack's webhooks on localhost, answering after latency
+# milliseconds.  Messages say how they want to be treated: "fail" turns the
+# first try away with a 500, "limit" with a 429, and "bad" always gets a 400.
+# Every 25th response quietly closes its connection, like an idle timeout.
+    import json
+    import BaseHTTPServer
+    import SocketServer
+    stub = { 'received': [], 'connections': 0, 'requests': 0, 'turned_away': set() }
+    lock = threading.Lock()
+
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # Written a header at a time, responses on a kept-alive connection
+        # would each wait out a delayed ACK
+        wbufsize = -1
+
+        def setup(self):
+            BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+            with lock:
+                stub['connections'] += 1
+
+        def do_POST(self):
+            message = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            time.sleep(latency / 1000.0)
+            status = 200
+            with lock:
+                stub['requests'] += 1
+                close = stub['requests'] % 25 == 0
+                kind = message.get('kind')
+                if kind == 'bad':
+                    status = 400
+                elif kind in ('fail', 'limit') and not message['n'] in stub['turned_away']:
+                    stub['turned_away'].add(message['n'])
+                    status = 500 if kind == 'fail' else 429
+                else:
+                    stub['received'].append(message.get('n', message))
+            body = "ok" if status == 200 else "no"
+            self.send_response(status)
+            self.send_header('Content-Length', str(len(body)))
+            if status == 429:
+                self.send_header('Retry-After', "0")
+            self.end_headers()
+            self.wfile.write(body)
+            if close:
+                self.close_connection = 1
+
+        def log_message(self, *args):
+            pass
+
+    class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+        daemon_threads = True
+
+    server = Server(("127.0.0.1", 0), Handler)
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    return server, stub
+
+def post_directly(url, message):
+# how the slash command used to post, on a new connection each time
+    import json
+    import httplib
+    from urlparse import urlparse
+    p = urlparse(url)
+    con = httplib.HTTPConnection(p.netloc)
+    con.request("POST", p.path, json.dumps(message))
+    con.getresponse().read()
+    con.close()
+
+def bench_slack(messages=500, workers=2, latency=5.0):
+# times posting to a stub webhook the way the slash command used to, waiting on
+# a new connection each time, against handing messages to the dispatcher, and
+# checks every message the stub should have accepted arrived exactly once
+    from gdg.slack import SlackDispatcher
+    server, stub = start_webhook_stub(latency)
+    try:
+        url = "http://127.0.0.1:{}/services/T000/B000/XXXX".format(server.server_address[1])
+        report = { 'messages': messages, 'workers': workers, 'latency_ms': latency }
+
+        acks = []
+        start = time.time()
+        for n in range(messages):
+            t = time.time()
+            post_directly(url, { 'n': -n - 1 })
+            acks.append(time.time() - t)
+        report['direct'] = { 'total_ms': 1000 * (time.time() - start), 'ack_p50_ms': 1000 * percentile(acks, 50), 'connections': messages }
+        del stub['received'][:]
+        connections = stub['connections']
+
+        log = []
+        dispatcher = SlackDispatcher(workers, messages, 2, 3, 0.01, log=lambda message, traceback=False: log.append(message))
+        expected = []
+        acks = []
+        start = time.time()
+        for n in range(messages):
+            kind = ['fail', 'limit', 'bad'][n % 3] if n % 10 == 0 else None
+            if not kind == 'bad':
+                expected.append(n)
+            t = time.time()
+            dispatcher.send(url, { 'n': n, 'kind': kind })
+            acks.append(time.time() - t)
+        dispatcher.join()
+        report['dispatched'] = {
+            'total_ms': 1000 * (time.time() - start),
+            'ack_p50_ms': 1000 * percentile(acks, 50),
+            'connections': stub['connections'] - connections,
+            'delivered': dispatcher.delivered,
+            'dropped': dispatcher.dropped,
+            'retried': len(stub['turned_away'])
+        }
+        report['mismatches'] = len(set(expected) ^ set(stub['received'])) + len(stub['received']) - len(set(stub['received']))
+        report['wrongly_dropped'] = len([m for m in log if not " 400 " in m])
+        return report
+    finally:
+        server.shutdown()
+        server.server_close()
+
+def print_slack(report):
+    print("{} messages to a stub webhook answering in {}ms".format(report['messages'], report['latency_ms']))
+    for name in ['direct', 'dispatched']:
+        r = report[name]
+        print("  {:10} {:8.0f}ms in all, {:.3f}ms to acknowledge, {} connections".format(name, r['total_ms'], r['ack_p50_ms'], r['connections']))
+    r = report['dispatched']
+    print("  {} delivered ({} after a retry), {} dropped, {} wrongly".format(r['delivered'], r['retried'], r['dropped'], report['wrongly_dropped']))
+    print("  {} messages missing or repeated".format(report['mismatches']))
+
+def bench_pages(count=2000, page_size=100, pages=200):
+# times rendering gallery pages of page_size images, with the response cache
+# off, and counts the filesystem calls made for them.  Whatever a page costs
+# on top of a page of one image is what its images cost.
+    import gdg
+    from gdg.responses import ResponseCache
+    workdir = tempfile.mkdtemp(prefix="gdg-bench-")
+    stat, lstat, listdir = os.stat, os.lstat, os.listdir
+    try:
+        images = make_library(workdir, count, tags=len(words))
+        app = get_app(workdir, images)
+        gdg.response_cache = ResponseCache(0)
+        paths = [("/gallery{:02d}".format(n), "") for n in range(20)]
+
+        calls = [0]
+        def counted(f):
+            def call(*args):
+                calls[0] += 1
+                return f(*args)
+            return call
+
+        report = { 'images': count, 'page_size': page_size, 'pages': pages }
+        for name, size in [('single', 1), ('full', page_size)]:
+            gdg.application.config['gallery']['images_per_page'] = size
+            wsgi_get(app, *paths[0])
+            os.stat, os.lstat, os.listdir = counted(stat), counted(lstat), counted(listdir)
+            calls[0] = 0
+            errors = 0
+            for path, query in paths:
+                status, body = wsgi_get(app, path, query)
+                if not status.startswith("200"):
+                    errors += 1
+            os.stat, os.lstat, os.listdir = stat, lstat, listdir
+            latencies, elapsed, load_errors = run_load(app, paths, 1, pages)
+            report[name] = {
+                'filesystem_calls': float(calls[0]) / len(paths),
+                'p50_ms': 1000 * percentile(latencies, 50),
+                'p99_ms': 1000 * percentile(latencies, 99),
+                'errors': errors + len(load_errors)
+            }
+        report['calls_per_image'] = (report['full']['filesystem_calls'] - report['single']['filesystem_calls']) / max(page_size - 1, 1)
+        return report
+    finally:
+        os.stat, os.lstat, os.listdir = stat, lstat, listdir
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def print_pages(report):
+    print("{} pages from a library of {} images".format(report['pages'], report['images']))
+    for name, size in [('single', 1), ('full', report['page_size'])]:
+        r = report[name]
+        print("  {:4} images a page: {:6.1f}ms (p99 {:.1f}ms), {:.1f} filesystem calls, {} errors".format(size, r['p50_ms'], r['p99_ms'], r['filesystem_calls'], r['errors']))
+    print("  {:.2f} filesystem calls for each image".format(report['calls_per_image']))
+
+def get_wsgi_app(workdir, images):
+# the application wsgi.py hands to the web server, set up on the library in
+# workdir rather than on gdg.conf's
+    import cherrypy
+    import gdg
+    import wsgi
+    cherrypy.config.update({ 'log.screen': False, 'environment': 'embedded' })
+    gdg.configure_routes()
+    gdg.application.config['database']['path'] = workdir
+    gdg.application.config['images']['path'] = images
+    gdg.prepare_database()
+    return wsgi.application
+
+def get_load_routes(workdir, images, tags, rnd, count=50):
+# count requests of each kind a visitor or the API might make, as
+# {route: [(path, query)]}, for images in the library in workdir
+    from gdg.data import Tag
+    with GoddamnDatabase(workdir):
+        galleries = [(g, n) for g, n in Gallery.select(Gallery.path, Gallery.images).where(Gallery.images > 0).tuples()]
+        paths = [p for (p,) in Image.select(Image.path).order_by(fn.Random()).limit(count).tuples()]
+        tag_names = [t for (t,) in Tag.select(Tag.name).order_by(fn.Random()).limit(count).tuples()]
+    close_database()
+    picks = [rnd.choice(galleries) for n in range(count)]
+    routes = {
+        'gallery': [("/" + g, "") for g, n in picks],
+        'gallery_page': [("/{}/page/{}".format(g, rnd.randint(1, max((n - 1) // 25 + 1, 1))), "") for g, n in picks],
+        'search': [("/api/search", "q=" + rnd.choice(words)) for n in range(count)],
+        'images': [("/api/images", "limit=100&gallery=" + g) for g, n in picks],
+        'details': [("/api/images/" + os.path.relpath(p, images), "") for p in paths]
+    }
+    if len(tag_names) > 0:
+        routes['tag_search'] = [("/api/search", "t=" + t) for t in tag_names]
+    return routes
+
+def run_mixed_load(app, routes, threads, requests):
+# requests GETs per thread, picked from every route in turn.  Returns each
+# route's latencies, how long the whole run took and the failed requests.
+    names = sorted(routes)
+    latencies = dict((name, []) for name in names)
+    errors = []
+    lock = threading.Lock()
+    def worker(offset):
+        mine = dict((name, []) for name in names)
+        for n in range(requests):
+            name = names[(offset + n) % len(names)]
+            path, query = routes[name][(offset + n) % len(routes[name])]
+            start = time.time()
+            status, body = wsgi_get(app, path, query)
+            mine[name].append(time.time() - start)
+            if not status.startswith("200"):
+                with lock:
+                    errors.append((path, query, status))
+        with lock:
+            for name in names:
+                latencies[name].extend(mine[name])
+    workers = [threading.Thread(target=worker, args=(n * 7,)) for n in range(threads)]
+    start = time.time()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    return latencies, time.time() - start, errors
+
+def bench_load(count=10000, threads=8, requests=500, shape="flat", galleries=20, collisions=0.1, tags=100):
+# drives wsgi.py's application in-process with threads threads making a mix of
+# page views, searches and API calls against a generated library, with the
+# response cache off and then on.  The images themselves are left off the disk,
+# pages are made from the database alone.
+    import gdg
+    from gdg.responses import ResponseCache
+    workdir = tempfile.mkdtemp(prefix="gdg-bench-")
+    try:
+        start = time.time()
+        images = make_library(workdir, count, galleries, get_photo_name, shape, collisions, tags, files=False)
+        report = { 'images': count, 'shape': shape, 'galleries': galleries, 'collisions': collisions, 'tags': tags, 'threads': threads, 'requests': threads * requests, 'library_s': time.time() - start }
+        app = get_wsgi_app(workdir, images)
+        routes = get_load_routes(workdir, images, tags, random.Random(count))
+        for name, size in [('uncached', 0), ('cached', 32)]:
+            gdg.response_cache = ResponseCache(size * 1024 * 1024)
+            for r in routes.values():
+                wsgi_get(app, *r[0])
+            latencies, elapsed, errors = run_mixed_load(app, routes, threads, requests)
+            everything = [t for route in latencies.values() for t in route]
+            report[name] = {
+                'requests_per_second': len(everything) / elapsed,
+                'p50_ms': 1000 * percentile(everything, 50),
+                'p99_ms': 1000 * percentile(everything, 99),
+                'errors': len(errors),
+                'routes': dict((route, { 'p50_ms': 1000 * percentile(t, 50), 'p99_ms': 1000 * percentile(t, 99) }) for route, t in latencies.iteritems())
+            }
+        # ru_maxrss is in kilobytes on Linux
+        report['peak_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return report
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def print_load(report):
+    print("{} requests from {} threads against {} images in {} {} galleries ({:.0f}s to generate)".format(report['requests'], report['threads'], report['images'], report['galleries'], report['shape'], report['library_s']))
+    for name in ['uncached', 'cached']:
+        r = report[name]
+        print("  {:9} {:8.1f} req/s (p50 {:.1f}ms, p99 {:.1f}ms), {} errors".format(name, r['requests_per_second'], r['p50_ms'], r['p99_ms'], r['errors']))
+        for route in sorted(r['routes']):
+            print("    {:13} p50 {:7.1f}ms, p99 {:7.1f}ms".format(route, r['routes'][route]['p50_ms'], r['routes'][route]['p99_ms']))
+    print("  peak RSS {:.0f}MB".format(report['peak_rss_kb'] / 1024.0))
+
+def _scrape_worker(workdir, images, full, processes, queue):
+# runs a scrape of images in workdir, timing each of its phases.  Runs in a
+# process of its own, so peak RSS is the scraper's alone.
+    from gdg.names import NameIndex
+    from gdg.data import configure_database
+    scrape.config.read(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'gdg.conf'))
+    scrape.config.set('database', 'path', workdir)
+    scrape.config.set('images', 'path', images)
+    scrape.config.set('thumbnails', 'path', os.path.join(workdir, "thumbs"))
+    scrape.config.set('thumbnails', 'cache_path', os.path.join(workdir, "thumbs", "cache"))
+    configure_database(dict(scrape.config.items('database')))
+
+    times = {}
+    def timed(name, f):
+        def call(*args, **kwargs):
+            start = time.time()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                times[name] = times.get(name, 0) + time.time() - start
+        return call
+    phases = [('add', 'add_images'), ('update', 'update_images'), ('move', 'move_images'), ('remove', 'remove_images'), ('galleries', 'refresh_galleries'), ('metadata', 'read_metadata'), ('save', 'save_results')]
+    for name, f in phases:
+        setattr(scrape, f, timed(name, getattr(scrape, f)))
+    NameIndex.update = timed('names', NameIndex.update)
+    saved = []
+    save_results = scrape.save_results
+    def count_saved(*args, **kwargs):
+        n = save_results(*args, **kwargs)
+        saved.append(n)
+        return n
+    scrape.save_results = count_saved
+
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        with GoddamnDatabase(workdir) as db:
+            scrape.migrate_database(db)
+            start = time.time()
+            scrape.find_images(db, full)
+            times['scan'] = time.time() - start
+            scrape.resume_jobs()
+        close_database()
+        workers = scrape.Workers(processes)
+        with GoddamnDatabase(workdir) as db:
+            del saved[:]
+            start = time.time()
+            scrape.process_images(db, workers, wait=False)
+            times['process'] = time.time() - start
+        workers.close()
+        workers.join()
+    finally:
+        sys.stdout = stdout
+    # What's left of the scan once everything it calls is taken out of it
+    times['walk'] = times['scan'] - sum(times.get(name, 0) for name in ['add', 'update', 'move', 'remove', 'galleries', 'metadata', 'names'])
+    queue.put({
+        'times_ms': dict((name, 1000 * t) for name, t in times.iteritems()),
+        'processed': sum(saved),
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'peak_worker_rss_kb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    })
+
+def run_scrape(workdir, images, full=False, processes=None):
+    queue = Queue()
+    p = Process(target=_scrape_worker, args=(workdir, images, full, processes, queue))
+    p.start()
+    result = queue.get()
+    p.join()
+    return result
+
+def bench_scrape(count=10000, shape="flat", galleries=20, collisions=0.1, processes=None, changes=0.01):
+# times each phase of scraping a generated library from scratch, then of
+# rescanning it with a share of it, changes, added to, touched and deleted,
+# then of a full rescan that lists every directory again
+    workdir = tempfile.mkdtemp(prefix="gdg-bench-")
+    try:
+        start = time.time()
+        images = make_library(workdir, count, galleries, get_photo_name, shape, collisions, database=False)
+        report = { 'images': count, 'shape': shape, 'galleries': galleries, 'collisions': collisions, 'library_s': time.time() - start }
+        report['first'] = run_scrape(workdir, images, processes=processes)
+
+        rnd = random.Random(count)
+        files = sorted(os.path.join(root, f) for root, dirs, names in os.walk(images) for f in names)
+        changed = rnd.sample(files, int(len(files) * changes))
+        third = len(changed) // 3
+        for f in changed[0:third]:
+            os.remove(f)
+        for f in changed[third:2 * third]:
+            with open(f, 'ab') as out:
+                out.write("\0")
+        for n, f in enumerate(changed[2 * third:]):
+            shutil.copyfile(f, os.path.join(os.path.dirname(f), "new{:06d}.jpg".format(n)))
+        report['changed'] = len(changed)
+        report['rescan'] = run_scrape(workdir, images, processes=processes)
+        report['full_rescan'] = run_scrape(workdir, images, full=True, processes=processes)
+
+        for name in ['first', 'rescan', 'full_rescan']:
+            r = report[name]
+            r['scanned_per_second'] = count / max(r['times_ms']['scan'] / 1000, 0.001)
+            r['processed_per_second'] = r['processed'] / max(r['times_ms']['process'] / 1000, 0.001)
+        return report
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def print_scrape(report):
+    print("{} images in {} {} galleries ({:.0f}s to generate), {} changed before the rescans".format(report['images'], report['galleries'], report['shape'], report['library_s'], report['changed']))
+    for name in ['first', 'rescan', 'full_rescan']:
+        r = report[name]
+        times = r['times_ms']
+        print("  {:11} scan {:8.0f}ms ({:.0f} images/s), process {:8.0f}ms ({:.0f} images/s)".format(name, times['scan'], r['scanned_per_second'], times['process'], r['processed_per_second']))
+        print("              " + ", ".join("{} {:.0f}ms".format(phase, times.get(phase, 0)) for phase in ['walk', 'add', 'update', 'move', 'remove', 'galleries', 'names', 'metadata', 'save']))
+        print("              peak RSS {:.0f}MB, {:.0f}MB a worker".format(r['peak_rss_kb'] / 1024.0, r['peak_worker_rss_kb'] / 1024.0))
+
+def flatten_report(report, prefix=""):
+# the numbers in a report, by their path through it
+    numbers = {}
+    for key, value in report.iteritems():
+        if isinstance(value, dict):
+            numbers.update(flatten_report(value, prefix + key + "."))
+        elif isinstance(value, (int, long, float)) and not isinstance(value, bool):
+            numbers[prefix + key] = value
+    return numbers
+
+def compare_reports(old, new):
+# [(name, old value, new value)] for each number in either of two reports
+    a, b = flatten_report(old), flatten_report(new)
+    return [(name, a.get(name), b.get(name)) for name in sorted(set(a) | set(b))]
+
+def print_comparison(rows):
+    for name, a, b in rows:
+        if a == None or b == None:
+            print("  {:50} {:>12} {:>12}".format(name, a, b))
+        else:
+            change = "" if a == 0 else "{:+.1f}%".format(100.0 * (b - a) / abs(a))
+            print("  {:50} {:12.2f} {:12.2f} {:>9}".format(name, a, b, change))
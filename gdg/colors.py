@@ -0,0 +1,104 @@
+import re
+from gdg.data import ImageColor, insert_rows, delete_rows
+
+# Colors are compared in CIELAB, where the distance between two roughly follows
+# how different they look, and filed by which cell of a grid over it they're in.
+# Finding the colors near one only has to look in the cells around it.
+cell_size = 10.0
+cell_count = 32
+
+hex_color = re.compile("^#?([0-9a-fA-F]{6}|[0-9a-fA-F]{3})$")
+
+def parse_color(text):
+# (r, g, b) from "#RRGGBB" or "#RGB", the # being optional, or None
+    m = hex_color.match(text.strip())
+    if m == None:
+        return None
+    h = m.group(1)
+    if len(h) == 3:
+        h = "".join(c * 2 for c in h)
+    return (int(h[0:2], 16), int(h[2:4], 16), int(h[4:6], 16))
+
+def format_color(rgb):
+    return "#%02X%02X%02X" % rgb
+
+def parse_colors(text):
+# [((r, g, b), percent)] from what's stored in images.colors
+    colors = []
+    for entry in (text or "").split(','):
+        if not ':' in entry:
+            continue
+        color, share = entry.split(':')
+        rgb = parse_color(color)
+        if not rgb == None:
+            colors.append((rgb, int(share)))
+    return colors
+
+def format_colors(colors):
+    return ",".join("{:02x}{:02x}{:02x}:{}".format(rgb[0], rgb[1], rgb[2], share) for rgb, share in colors)
+
+def to_linear(c):
+    c = c / 255.0
+    return c / 12.92 if c <= 0.04045 else ((c + 0.055) / 1.055) ** 2.4
+
+def to_lab(rgb):
+# sRGB to CIELAB, under D65 light
+    r, g, b = [to_linear(c) for c in rgb]
+    x = (0.4124 * r + 0.3576 * g + 0.1805 * b) / 0.95047
+    y = 0.2126 * r + 0.7152 * g + 0.0722 * b
+    z = (0.0193 * r + 0.1192 * g + 0.9505 * b) / 1.08883
+    fx, fy, fz = [t ** (1 / 3.0) if t > 0.008856 else 7.787 * t + 16 / 116.0 for t in (x, y, z)]
+    return (116 * fy - 16, 500 * (fx - fy), 200 * (fy - fz))
+
+def get_distance(a, b):
+    return ((a[0] - b[0]) ** 2 + (a[1] - b[1]) ** 2 + (a[2] - b[2]) ** 2) ** 0.5
+
+def get_cell_range(value, distance, offset=0):
+    lo = int((value + offset - distance) // cell_size)
+    hi = int((value + offset + distance) // cell_size)
+    return range(max(lo, 0), min(hi, cell_count - 1) + 1)
+
+def get_cell(lab):
+    l, a, b = [min(max(n, 0), cell_count - 1) for n in (int(lab[0] // cell_size), int((lab[1] + 128) // cell_size), int((lab[2] + 128) // cell_size))]
+    return (l * cell_count + a) * cell_count + b
+
+def get_cells_near(lab, distance):
+# every cell with room for a color within distance of lab
+    cells = []
+    for l in get_cell_range(lab[0], distance):
+        for a in get_cell_range(lab[1], distance, 128):
+            for b in get_cell_range(lab[2], distance, 128):
+                cells.append((l * cell_count + a) * cell_count + b)
+    return cells
+
+def index_colors(images):
+# files the images' colors away for searching, replacing whatever they had before
+    delete_rows(ImageColor, [i.id for i in images], ImageColor.image)
+    rows = []
+    for image in images:
+        for rgb, share in parse_colors(image.colors):
+            lab = to_lab(rgb)
+            rows.append({ 'image': image.id, 'color': (rgb[0] << 16) | (rgb[1] << 8) | rgb[2], 'share': share, 'cell': get_cell(lab), 'l': lab[0], 'a': lab[1], 'b': lab[2] })
+    insert_rows(ImageColor, rows)
+
+def select_colors_near(lab, distance):
+# the colors in the box around lab, found through the cells it covers
+    box = [(f, lab[n] - distance, lab[n] + distance) for n, f in enumerate([ImageColor.l, ImageColor.a, ImageColor.b])]
+    return ImageColor.select(ImageColor.image, ImageColor.share, ImageColor.l, ImageColor.a, ImageColor.b).where(ImageColor.cell << get_cells_near(lab, distance), *[f.between(lo, hi) for f, lo, hi in box])
+
+def find_images_by_color(rgb, limit=100, max_distance=25.0):
+# ids of the images with one of their main colors nearest rgb, nearest first
+# and then those with more of it.  Looks in a small area around it to begin
+# with, doubling it until there are enough images or it reaches max_distance.
+    lab = to_lab(rgb)
+    distance = min(cell_size / 2, max_distance)
+    while True:
+        best = {}
+        for id, share, l, a, b in select_colors_near(lab, distance).tuples():
+            d = get_distance(lab, (l, a, b))
+            if d <= distance and (not id in best or (d, -share) < best[id]):
+                best[id] = (d, -share)
+        if len(best) >= limit or distance >= max_distance:
+            break
+        distance = min(distance * 2, max_distance)
+    return [id for id, rank in sorted(best.iteritems(), key=lambda f: (f[1], f[0]))[:limit]]
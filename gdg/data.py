@@ -1,7 +1,33 @@
 import os
+import time
+import sqlite3
+import threading
 from peewee import *
+from gdg import metrics
 
-database = SqliteDatabase(None)
+# Applied once to each new connection.  Any of them can be overridden in the
+# [database] section of gdg.conf.
+pragmas = [('journal_mode', 'wal'), ('synchronous', 'normal'), ('mmap_size', 268435456), ('cache_size', -16000)]
+
+class TimedDatabase(SqliteDatabase):
+# counts and times every query towards the request it was run for, if any, see
+# gdg/metrics.py.  Rows are fetched as they're read, so this is up to the first.
+    def execute_sql(self, sql, params=None, require_commit=True):
+        if not metrics.enabled:
+            return super(TimedDatabase, self).execute_sql(sql, params, require_commit)
+        start = time.time()
+        try:
+            return super(TimedDatabase, self).execute_sql(sql, params, require_commit)
+        finally:
+            metrics.record_query(time.time() - start)
+
+database = TimedDatabase(None, pragmas=pragmas)
+
+# Keep each thread's connection open between requests
+persistent_connections = True
+
+init_lock = threading.Lock()
+connections = threading.local()
 
 class BaseModel(Model):
     class Meta:
@@ -18,10 +44,41 @@ class Image(BaseModel):
     r = IntegerField(null=True)
     g = IntegerField(null=True)
     b = IntegerField(null=True)
+    mtime = FloatField(null=True)
+    size = IntegerField(null=True)
+    inode = IntegerField(null=True)
+    hash = CharField(null=True)
+    thumb_key = CharField(null=True)
+    phash = IntegerField(null=True)
+    colors = CharField(null=True)
+    orientation = IntegerField(null=True)
+    taken = CharField(null=True)
+    camera = CharField(null=True)
+    frames = IntegerField(null=True)
+    animation = CharField(null=True)
 
     class Meta:
         db_table = 'images'
 
+class Directory(BaseModel):
+    path = CharField(unique=True)
+    parent = CharField(null=True)
+    mtime = FloatField()
+
+    class Meta:
+        db_table = 'directories'
+
+class Gallery(BaseModel):
+    path = CharField(unique=True)
+    parent = CharField(null=True)
+    images = IntegerField(default=0)
+    total = IntegerField(default=0)
+    cover = ForeignKeyField(Image, null=True, related_name='covers')
+    mtime = FloatField(null=True)
+
+    class Meta:
+        db_table = 'galleries'
+
 class Tag(BaseModel):
     name = CharField()
     slug = CharField()
@@ -36,6 +93,28 @@ class TagImage(BaseModel):
     class Meta:
         db_table = 'tag_image'
 
+class ImageColor(BaseModel):
+    image = ForeignKeyField(Image)
+    color = IntegerField()
+    share = IntegerField()
+    cell = IntegerField()
+    l = FloatField()
+    a = FloatField()
+    b = FloatField()
+
+    class Meta:
+        db_table = 'image_colors'
+
+class Job(BaseModel):
+    image = ForeignKeyField(Image, primary_key=True)
+    state = CharField(default='pending')
+    attempts = IntegerField(default=0)
+    due = FloatField(default=0)
+    error = TextField(null=True)
+
+    class Meta:
+        db_table = 'jobs'
+
 class User(BaseModel):
     name = CharField(unique=True)
     email = CharField()
@@ -44,15 +123,406 @@ class User(BaseModel):
     class Meta:
         db_table = "users"
 
+thumb_extensions = { 'jpeg': '.jpg', 'webp': '.webp' }
+animation_extensions = { 'webp': '.webp', 'gif': '.gif' }
+
+def get_thumb_sizes(value):
+    return [int(s) for s in value.split(',') if s.strip()]
+
+def get_thumb_formats(value):
+    formats = [f.strip().lower() for f in value.split(',') if f.strip()]
+    return ['jpeg' if f == 'jpg' else f for f in formats]
+
+def get_thumb_name(key, size, format):
+    return "{}_{}{}".format(key, size, thumb_extensions[format])
+
+def get_animation_name(key, size, format):
+    return "{}_{}_animated{}".format(key, size, animation_extensions[format])
+
+def configure_database(options):
+    for n, (name, value) in enumerate(pragmas):
+        if name in options:
+            pragmas[n] = (name, str(options[name]).strip('"\''))
+
+def close_database():
+# closes this thread's connection, e.g. before forking
+    if not database.deferred and not database.is_closed():
+        database.close()
+    connections.dbname = None
+
 class GoddamnDatabase(object):
+# hands out this thread's connection to the database, opening it the first time
+# it's needed.  The connection stays open for the next caller on the same thread,
+# so nesting these is cheap and the pragmas only run once per connection.
     def __init__(self, path, **connect_args):
         if path == None:
             path = os.path.dirname(__file__)
         self.dbname = os.path.join(path, 'gallery.db')
         self.connect_args = connect_args
     def __enter__(self):
-        database.init(self.dbname, **self.connect_args)
-        database.connect()
+        if not getattr(connections, 'dbname', None) == self.dbname:
+            close_database()
+            with init_lock:
+                if not database.database == self.dbname or not database.connect_kwargs == self.connect_args:
+                    database.init(self.dbname, **self.connect_args)
+        if database.is_closed():
+            database.connect()
+            connections.dbname = self.dbname
         return database
     def __exit__(self, t, v, tb):
-        database.close()
\ No newline at end of file
+        if not persistent_connections:
+            close_database()
+
+schema = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'gallery.sql')
+
+def add_scraper_columns(db):
+# what the scraper needs to skip unchanged files and directories
+    columns = [c.name for c in db.get_columns('images')]
+    for name, definition in [('mtime', 'REAL'), ('size', 'INTEGER'), ('inode', 'INTEGER'), ('hash', 'VARCHAR( 32 )'), ('thumb_key', 'VARCHAR( 40 )')]:
+        if not name in columns:
+            db.execute_sql("ALTER TABLE images ADD COLUMN {} {}".format(name, definition))
+    db.execute_sql("CREATE INDEX IF NOT EXISTS images_inode ON images ( inode )")
+    db.execute_sql("CREATE INDEX IF NOT EXISTS images_hash ON images ( hash )")
+    db.execute_sql("CREATE INDEX IF NOT EXISTS images_thumb_key ON images ( thumb_key )")
+    db.execute_sql("""CREATE TABLE IF NOT EXISTS directories ( 
+    id     INTEGER         PRIMARY KEY,
+    path   VARCHAR( 255 )  NOT NULL
+                           UNIQUE,
+    parent VARCHAR( 255 ),
+    mtime  REAL            NOT NULL
+)""")
+    db.execute_sql("CREATE INDEX IF NOT EXISTS directories_parent ON directories ( parent )")
+
+def add_lookup_indexes(db):
+# indexes for the lookups every page does, and one tag per image at most
+    db.execute_sql("CREATE INDEX IF NOT EXISTS images_path ON images ( path )")
+    db.execute_sql("CREATE INDEX IF NOT EXISTS images_gallery ON images ( gallery, path )")
+    db.execute_sql("CREATE INDEX IF NOT EXISTS images_parent ON images ( parent, gallery )")
+    db.execute_sql("DELETE FROM tag_image WHERE id NOT IN ( SELECT MIN( id ) FROM tag_image GROUP BY image_id, tag_id )")
+    db.execute_sql("CREATE UNIQUE INDEX IF NOT EXISTS tag_image_image ON tag_image ( image_id, tag_id )")
+    db.execute_sql("CREATE INDEX IF NOT EXISTS tag_image_tag ON tag_image ( tag_id, image_id )")
+
+def add_galleries(db):
+# a row per gallery with its counts and cover, kept up to date by the scraper.
+# Triggers note which galleries changed so it doesn't have to track them itself.
+    db.execute_sql("""CREATE TABLE IF NOT EXISTS galleries ( 
+    id       INTEGER         PRIMARY KEY,
+    path     VARCHAR( 255 )  NOT NULL
+                             UNIQUE,
+    parent   VARCHAR( 255 ),
+    images   INTEGER         NOT NULL
+                             DEFAULT 0,
+    total    INTEGER         NOT NULL
+                             DEFAULT 0,
+    cover_id INTEGER,
+    mtime    REAL
+)""")
+    db.execute_sql("CREATE INDEX IF NOT EXISTS galleries_parent ON galleries ( parent, path )")
+    db.execute_sql("CREATE TABLE IF NOT EXISTS gallery_changes ( path VARCHAR( 255 ) PRIMARY KEY )")
+    db.execute_sql("""CREATE TRIGGER IF NOT EXISTS images_added AFTER INSERT ON images
+BEGIN
+    INSERT OR IGNORE INTO gallery_changes ( path ) VALUES ( NEW.gallery );
+END""")
+    db.execute_sql("""CREATE TRIGGER IF NOT EXISTS images_removed AFTER DELETE ON images
+BEGIN
+    INSERT OR IGNORE INTO gallery_changes ( path ) VALUES ( OLD.gallery );
+END""")
+    db.execute_sql("""CREATE TRIGGER IF NOT EXISTS images_changed AFTER UPDATE OF path, gallery, mtime ON images
+WHEN OLD.path IS NOT NEW.path OR OLD.gallery IS NOT NEW.gallery OR OLD.mtime IS NOT NEW.mtime
+BEGIN
+    INSERT OR IGNORE INTO gallery_changes ( path ) VALUES ( OLD.gallery );
+    INSERT OR IGNORE INTO gallery_changes ( path ) VALUES ( NEW.gallery );
+END""")
+    db.execute_sql("INSERT OR IGNORE INTO gallery_changes ( path ) SELECT DISTINCT gallery FROM images")
+    # The generation table doesn't exist yet at this point in the migrations
+    refresh_galleries(db, bump=False)
+
+def add_listing_indexes(db):
+# the API lists images case-insensitively, a page at a time
+    db.execute_sql("CREATE INDEX IF NOT EXISTS images_path_nocase ON images ( path COLLATE NOCASE )")
+    db.execute_sql("CREATE INDEX IF NOT EXISTS images_gallery_nocase ON images ( gallery, path COLLATE NOCASE )")
+
+def add_name_changes(db):
+# which images the name index hasn't caught up with yet, see gdg/names.py
+    db.execute_sql("CREATE TABLE IF NOT EXISTS name_changes ( image_id INTEGER PRIMARY KEY )")
+    db.execute_sql("""CREATE TRIGGER IF NOT EXISTS images_named AFTER INSERT ON images
+BEGIN
+    INSERT OR IGNORE INTO name_changes ( image_id ) VALUES ( NEW.id );
+END""")
+    db.execute_sql("""CREATE TRIGGER IF NOT EXISTS images_unnamed AFTER DELETE ON images
+BEGIN
+    INSERT OR IGNORE INTO name_changes ( image_id ) VALUES ( OLD.id );
+END""")
+    db.execute_sql("""CREATE TRIGGER IF NOT EXISTS images_renamed AFTER UPDATE OF path ON images
+WHEN OLD.path IS NOT NEW.path
+BEGIN
+    INSERT OR IGNORE INTO name_changes ( image_id ) VALUES ( NEW.id );
+END""")
+
+def add_image_search(db):
+# full text search over file names, galleries and tags, which triggers keep in
+# step with the tables they come from.  Needs SQLite built with FTS5.
+    db.execute_sql("""CREATE VIRTUAL TABLE IF NOT EXISTS image_search USING fts5 ( name, gallery, tags, tokenize = 'unicode61' )""")
+    db.execute_sql("""CREATE TRIGGER IF NOT EXISTS image_search_added AFTER INSERT ON images
+BEGIN
+    INSERT INTO image_search ( rowid, name, gallery, tags )
+         VALUES ( NEW.id, replace( NEW.path, rtrim( NEW.path, replace( NEW.path, '/', '' ) ), '' ), NEW.gallery, '' );
+END""")
+    db.execute_sql("""CREATE TRIGGER IF NOT EXISTS image_search_removed AFTER DELETE ON images
+BEGIN
+    DELETE FROM image_search WHERE rowid = OLD.id;
+END""")
+    db.execute_sql("""CREATE TRIGGER IF NOT EXISTS image_search_moved AFTER UPDATE OF path, gallery ON images
+WHEN OLD.path IS NOT NEW.path OR OLD.gallery IS NOT NEW.gallery
+BEGIN
+    UPDATE image_search
+       SET name = replace( NEW.path, rtrim( NEW.path, replace( NEW.path, '/', '' ) ), '' ),
+           gallery = NEW.gallery
+     WHERE rowid = NEW.id;
+END""")
+    db.execute_sql("""CREATE TRIGGER IF NOT EXISTS image_search_tagged AFTER INSERT ON tag_image
+BEGIN
+    UPDATE image_search SET tags = ( SELECT group_concat( t.name, ' ' ) FROM tag_image ti JOIN tags t ON t.id = ti.tag_id WHERE ti.image_id = NEW.image_id )
+     WHERE rowid = NEW.image_id;
+END""")
+    db.execute_sql("""CREATE TRIGGER IF NOT EXISTS image_search_untagged AFTER DELETE ON tag_image
+BEGIN
+    UPDATE image_search SET tags = coalesce( ( SELECT group_concat( t.name, ' ' ) FROM tag_image ti JOIN tags t ON t.id = ti.tag_id WHERE ti.image_id = OLD.image_id ), '' )
+     WHERE rowid = OLD.image_id;
+END""")
+    db.execute_sql("""CREATE TRIGGER IF NOT EXISTS image_search_retagged AFTER UPDATE OF name ON tags
+WHEN OLD.name IS NOT NEW.name
+BEGIN
+    UPDATE image_search SET tags = ( SELECT group_concat( t.name, ' ' ) FROM tag_image ti JOIN tags t ON t.id = ti.tag_id WHERE ti.image_id = image_search.rowid )
+     WHERE rowid IN ( SELECT image_id FROM tag_image WHERE tag_id = NEW.id );
+END""")
+    db.execute_sql("DELETE FROM image_search")
+    db.execute_sql("""INSERT INTO image_search ( rowid, name, gallery, tags )
+SELECT i.id, replace( i.path, rtrim( i.path, replace( i.path, '/', '' ) ), '' ), i.gallery,
+       coalesce( ( SELECT group_concat( t.name, ' ' ) FROM tag_image ti JOIN tags t ON t.id = ti.tag_id WHERE ti.image_id = i.id ), '' )
+  FROM images i""")
+
+# A perceptual hash is indexed a 16 bit quarter at a time, see gdg/duplicates.py
+phash_chunks = ["phash & 65535", "( phash >> 16 ) & 65535", "( phash >> 32 ) & 65535", "( phash >> 48 ) & 65535"]
+
+def add_perceptual_hashes(db):
+# a perceptual hash of each image, filled in by the scraper as it processes them
+    columns = [c.name for c in db.get_columns('images')]
+    if not 'phash' in columns:
+        db.execute_sql("ALTER TABLE images ADD COLUMN phash INTEGER")
+    for n, chunk in enumerate(phash_chunks):
+        db.execute_sql("CREATE INDEX IF NOT EXISTS images_phash_{} ON images ( {} )".format(n, chunk))
+
+def add_image_colors(db):
+# each image's most common colors, as text on the image and as rows filed by
+# where they are in CIELAB for searching, see gdg/colors.py.  The rows are
+# written by the scraper; triggers throw them away when the colors change.
+    columns = [c.name for c in db.get_columns('images')]
+    if not 'colors' in columns:
+        db.execute_sql("ALTER TABLE images ADD COLUMN colors VARCHAR( 64 )")
+    db.execute_sql("""CREATE TABLE IF NOT EXISTS image_colors ( 
+    id       INTEGER PRIMARY KEY,
+    image_id INTEGER NOT NULL
+                     REFERENCES images ( id ) ON DELETE CASCADE,
+    color    INTEGER NOT NULL,
+    share    INTEGER NOT NULL,
+    cell     INTEGER NOT NULL,
+    l        REAL    NOT NULL,
+    a        REAL    NOT NULL,
+    b        REAL    NOT NULL
+)""")
+    db.execute_sql("CREATE INDEX IF NOT EXISTS image_colors_image ON image_colors ( image_id )")
+    db.execute_sql("CREATE INDEX IF NOT EXISTS image_colors_cell ON image_colors ( cell )")
+    db.execute_sql("""CREATE TRIGGER IF NOT EXISTS image_colors_removed AFTER DELETE ON images
+BEGIN
+    DELETE FROM image_colors WHERE image_id = OLD.id;
+END""")
+    db.execute_sql("""CREATE TRIGGER IF NOT EXISTS image_colors_changed AFTER UPDATE OF colors ON images
+WHEN OLD.colors IS NOT NEW.colors
+BEGIN
+    DELETE FROM image_colors WHERE image_id = NEW.id;
+END""")
+
+def add_image_metadata(db):
+# what the scraper reads from each image's headers, see gdg/metadata.py.  Images
+# it hasn't read yet have no frame count.
+    columns = [c.name for c in db.get_columns('images')]
+    for name, definition in [('orientation', 'INTEGER'), ('taken', 'VARCHAR( 19 )'), ('camera', 'VARCHAR( 128 )'), ('frames', 'INTEGER')]:
+        if not name in columns:
+            db.execute_sql("ALTER TABLE images ADD COLUMN {} {}".format(name, definition))
+    db.execute_sql("CREATE INDEX IF NOT EXISTS images_unread ON images ( id ) WHERE frames IS NULL")
+
+def add_animations(db):
+# a small animated thumbnail for each animated image, as well as the still one.
+# Animated images processed before this are processed again to make them.
+    columns = [c.name for c in db.get_columns('images')]
+    if not 'animation' in columns:
+        db.execute_sql("ALTER TABLE images ADD COLUMN animation VARCHAR( 255 )")
+    db.execute_sql("UPDATE images SET thumb = NULL WHERE frames > 1")
+
+def add_jobs(db):
+# what the scraper has left to do and how it went, see gdg/jobs.py.  Triggers
+# throw a job away when its image is removed or its file changes, so the image
+# is queued again from the start.
+    db.execute_sql("""CREATE TABLE IF NOT EXISTS jobs ( 
+    image_id INTEGER         PRIMARY KEY
+                             REFERENCES images ( id ) ON DELETE CASCADE,
+    state    VARCHAR( 16 )   NOT NULL
+                             DEFAULT 'pending',
+    attempts INTEGER         NOT NULL
+                             DEFAULT 0,
+    due      REAL            NOT NULL
+                             DEFAULT 0,
+    error    TEXT 
+)""")
+    db.execute_sql("CREATE INDEX IF NOT EXISTS jobs_due ON jobs ( state, due )")
+    db.execute_sql("""CREATE TRIGGER IF NOT EXISTS jobs_removed AFTER DELETE ON images
+BEGIN
+    DELETE FROM jobs WHERE image_id = OLD.id;
+END""")
+    db.execute_sql("""CREATE TRIGGER IF NOT EXISTS jobs_changed AFTER UPDATE OF mtime, size, inode ON images
+WHEN OLD.mtime IS NOT NEW.mtime OR OLD.size IS NOT NEW.size OR OLD.inode IS NOT NEW.inode
+BEGIN
+    DELETE FROM jobs WHERE image_id = NEW.id;
+END""")
+
+def add_generation(db):
+# a number bumped by whatever changes what the gallery shows, the scraper and
+# tag edits, which the web server's response cache is checked against
+    db.execute_sql("CREATE TABLE IF NOT EXISTS generation ( value INTEGER NOT NULL )")
+    if db.execute_sql("SELECT COUNT(*) FROM generation").fetchone()[0] == 0:
+        db.execute_sql("INSERT INTO generation ( value ) VALUES ( 0 )")
+
+# Never reorder or remove these, a database's version is how many it has had.
+# gallery.sql creates the latest schema and sets user_version to match.
+migrations = [add_scraper_columns, add_lookup_indexes, add_galleries, add_listing_indexes, add_name_changes, add_image_search, add_perceptual_hashes, add_image_colors, add_image_metadata, add_animations, add_jobs, add_generation]
+
+def get_database_version(db):
+    return db.execute_sql("PRAGMA user_version").fetchone()[0]
+
+def migrate_database(db):
+# creates the database from gallery.sql if it's empty, then applies whatever
+# migrations it hasn't had yet, each in its own transaction.  Databases from
+# before versioning start at 0; every migration is safe to run on them.
+    if not 'images' in db.get_tables():
+        with open(schema, 'r') as sql:
+            db.get_conn().executescript(sql.read())
+    while get_database_version(db) < len(migrations):
+        with db.transaction('IMMEDIATE'):
+            # Someone else may have gotten here first
+            version = get_database_version(db)
+            if version < len(migrations):
+                migrations[version](db)
+                db.execute_sql("PRAGMA user_version = {}".format(version + 1))
+    return get_database_version(db)
+
+# How many parameters one statement can have, see get_variable_limit()
+variable_limit = None
+
+def get_variable_limit():
+# SQLite's compile options only mention the limit when it isn't the default,
+# which went up from 999 in 3.32
+    global variable_limit
+    if variable_limit == None:
+        limit = 32766 if sqlite3.sqlite_version_info >= (3, 32, 0) else 999
+        for (option,) in database.execute_sql("PRAGMA compile_options"):
+            if option.startswith("MAX_VARIABLE_NUMBER="):
+                limit = int(option.split("=")[1])
+        variable_limit = limit
+    return variable_limit
+
+def insert_rows(model, rows, upsert=False):
+# inserts rows, dicts with the same keys, in as few statements as will fit,
+# replacing any they clash with if upsert is set.  Same as insert_many(), only
+# without the time peewee takes to build a statement that big.
+    if len(rows) == 0:
+        return
+    names = rows[0].keys()
+    fields = [model._meta.fields[name] for name in names]
+    sql = "INSERT {}INTO {} ( {} ) VALUES ".format("OR REPLACE " if upsert else "", model._meta.db_table, ", ".join(f.db_column for f in fields))
+    placeholders = "(" + ", ".join("?" * len(fields)) + ")"
+    per = max(get_variable_limit() // len(fields), 1)
+    for n in range(0, len(rows), per):
+        chunk = rows[n:n+per]
+        database.execute_sql(sql + ", ".join([placeholders] * len(chunk)), [f.db_value(row[name]) for row in chunk for name, f in zip(names, fields)])
+
+def update_rows(model, columns, rows, **values):
+# sets columns of many rows at once from rows of (id, one value per column),
+# and each column in values to the same value for all of them.  SQLite 3.33 and
+# up can take a chunk of them as one UPDATE ... FROM a list of VALUES; older
+# ones get one prepared UPDATE run for each row.
+    if len(rows) == 0:
+        return
+    table = model._meta.db_table
+    values = values.items()
+    sets = ["{0} = v.{0}".format(c) for c in columns] + ["{} = ?".format(c) for c, value in values]
+    shared = [value for c, value in values]
+    if sqlite3.sqlite_version_info < (3, 33, 0):
+        sets = ["{} = ?".format(c) for c in columns] + sets[len(columns):]
+        sql = "UPDATE {} SET {} WHERE id = ?".format(table, ", ".join(sets))
+        database.get_cursor().executemany(sql, [tuple(row[1:]) + tuple(shared) + (row[0],) for row in rows])
+        return
+    width = len(columns) + 1
+    per = max((get_variable_limit() - len(shared)) // width, 1)
+    for n in range(0, len(rows), per):
+        chunk = rows[n:n+per]
+        placeholders = ", ".join(["(" + ", ".join("?" * width) + ")"] * len(chunk))
+        sql = "WITH v ( {} ) AS ( VALUES {} ) UPDATE {} SET {} FROM v WHERE {}.id = v.id".format(", ".join(['id'] + columns), placeholders, table, ", ".join(sets), table)
+        database.execute_sql(sql, [value for row in chunk for value in row] + shared)
+
+def delete_rows(model, ids, field=None):
+# deletes the rows with the given ids, or the given values of field, as many
+# at a time as will fit
+    # Comparing a field with == builds a query expression rather than a bool,
+    # so the check has to use is
+    field = model._meta.primary_key if field is None else field
+    ids = list(ids)
+    per = get_variable_limit()
+    for n in range(0, len(ids), per):
+        model.delete().where(field << ids[n:n+per]).execute()
+
+def get_generation():
+    return database.execute_sql("SELECT value FROM generation").fetchone()[0]
+
+def bump_generation():
+# call this in the same transaction as the changes, so nothing sees them with
+# the old generation once they're committed
+    database.execute_sql("UPDATE generation SET value = value + 1")
+
+def get_parent_gallery(gallery):
+    return None if gallery == '' else os.path.dirname(gallery)
+
+def refresh_galleries(db, bump=True):
+# updates the galleries whose images changed since the last refresh, then their
+# ancestors from the bottom up, so each one's total only needs its children.
+# Returns how many galleries were refreshed.  Unless bump is False, the
+# generation is bumped along with them.
+    with db.transaction():
+        changed = [row[0] for row in db.execute_sql("SELECT path FROM gallery_changes").fetchall()]
+        if len(changed) == 0:
+            return 0
+        refresh = set()
+        for g in changed:
+            while not g == None and not g in refresh:
+                refresh.add(g)
+                g = get_parent_gallery(g)
+
+        # Deepest first
+        for g in sorted(refresh, key=lambda g: (-g.count('/'), g == '', g)):
+            images, mtime = Image.select(fn.Count(Image.id), fn.Max(Image.mtime)).where(Image.gallery == g).tuples().first()
+            cover = Image.select(Image.id).where(Image.gallery == g).order_by(Image.path).limit(1).scalar()
+            total = images
+            for child_total, child_cover, child_mtime in Gallery.select(Gallery.total, Gallery.cover, Gallery.mtime).where(Gallery.parent == g).order_by(Gallery.path).tuples():
+                total += child_total
+                if cover == None:
+                    cover = child_cover
+                if mtime == None or (not child_mtime == None and child_mtime > mtime):
+                    mtime = child_mtime
+            if total == 0:
+                Gallery.delete().where(Gallery.path == g).execute()
+            elif Gallery.update(images=images, total=total, cover=cover, mtime=mtime).where(Gallery.path == g).execute() == 0:
+                Gallery.create(path=g, parent=get_parent_gallery(g), images=images, total=total, cover=cover, mtime=mtime)
+        db.execute_sql("DELETE FROM gallery_changes")
+        if bump:
+            bump_generation()
+    return len(refresh)
@@ -0,0 +1,153 @@
+import itertools
+from peewee import SQL
+from gdg.data import Image, phash_chunks
+
+# Hashes are 64 bits, stored signed since that's what SQLite holds.  Any two
+# within max_distance bits of each other have at least one of their chunks
+# within max_distance / chunks bits of each other, so only images sharing a
+# chunk with one of those values need to be compared.
+hash_bits = 64
+chunk_bits = hash_bits / len(phash_chunks)
+
+# Hashes only see brightness, which would make every flat image a duplicate of
+# every other one, so duplicates need about the same average color as well
+max_color_difference = 24
+
+def to_signed(h):
+    return h - (1 << hash_bits) if h >= 1 << (hash_bits - 1) else h
+
+def to_unsigned(h):
+    return h + (1 << hash_bits) if h < 0 else h
+
+def hamming(a, b):
+    return bin(to_unsigned(a) ^ to_unsigned(b)).count('1')
+
+def similar_colors(a, b):
+# whether candidate color b is close enough to a.  A candidate that hasn't been
+# given a color yet can't be ruled out by it, but a has to have one.
+    if None in b:
+        return True
+    if None in a:
+        return False
+    return all(abs(x - y) <= max_color_difference for x, y in zip(a, b))
+
+def get_widths(count):
+# how many bits each of count pieces of a hash gets, the last one any left over
+    bits = hash_bits / count
+    return [bits] * (count - 1) + [hash_bits - bits * (count - 1)]
+
+def get_chunks(h, count=len(phash_chunks)):
+# h split into count pieces, the lowest bits first
+    h = to_unsigned(h)
+    chunks = []
+    shift = 0
+    for width in get_widths(count):
+        chunks.append((h >> shift) & ((1 << width) - 1))
+        shift += width
+    return chunks
+
+def get_flips(bits, radius):
+# masks that flip up to radius of a value's bits
+    flips = [0]
+    for r in range(1, radius + 1):
+        for flipped in itertools.combinations(range(bits), r):
+            flips.append(sum(1 << b for b in flipped))
+    return flips
+
+def get_neighbors(value, radius, bits=chunk_bits):
+# every value within radius bits of value
+    return [value ^ f for f in get_flips(bits, radius)]
+
+def count_flips(bits, radius):
+    total = n = 1
+    for r in range(1, radius + 1):
+        n = n * (bits - r + 1) / r
+        total += n
+    return total
+
+def get_piece_count(hashes, max_distance):
+# how many pieces to split hashes into when grouping them.  More pieces means
+# fewer variations of each to look up, but more hashes sharing each one.
+    best = None
+    for count in range(1, min(max_distance + 1, hash_bits) + 1):
+        bits = hash_bits / count
+        lookups = count * count_flips(bits, max_distance / count)
+        cost = lookups * (1 + float(hashes) / (1 << bits))
+        if best == None or cost < best[0]:
+            best = (cost, count)
+    return best[1]
+
+def select_similar(h, max_distance):
+# images that might be within max_distance of h, which still need checking.
+# Each chunk's lookup uses its own index.
+    radius = max_distance / len(phash_chunks)
+    clauses = []
+    for expression, value in zip(phash_chunks, get_chunks(h)):
+        clauses.append("{} IN ({})".format(expression, ", ".join(str(v) for v in get_neighbors(value, radius))))
+    return Image.select(Image.id, Image.path, Image.phash, Image.r, Image.g, Image.b).where(SQL("(" + " OR ".join(clauses) + ")"))
+
+def find_duplicates(image, max_distance):
+# (distance, id, path) of the images within max_distance of image, closest first
+    if image.phash == None:
+        return []
+    color = (image.r, image.g, image.b)
+    found = []
+    for id, path, h, r, g, b in select_similar(image.phash, max_distance).tuples():
+        if id == image.id:
+            continue
+        d = hamming(image.phash, h)
+        if d <= max_distance and similar_colors(color, (r, g, b)):
+            found.append((d, id, path))
+    return sorted(found, key=lambda f: (f[0], f[2].lower()))
+
+def find_duplicate_clusters(max_distance, chunk=10000):
+# groups of image ids where each is a duplicate of another in its group,
+# biggest group first.  Images with the same hash and color are grouped straight
+# away.  The distinct hashes are split into pieces and filed by each piece, and
+# each hash is only compared with those filed under a close enough variation of
+# one of its pieces, the same as the indexes do for a single image.
+    ids = {}
+    last = 0
+    while True:
+        rows = list(Image.select(Image.id, Image.phash, Image.r, Image.g, Image.b).where(Image.phash != None, Image.id > last).order_by(Image.id).limit(chunk).tuples())
+        if len(rows) == 0:
+            break
+        for row in rows:
+            ids.setdefault(row[1:], []).append(row[0])
+        last = rows[-1][0]
+
+    keys = ids.keys()
+    hashes = [to_unsigned(k[0]) for k in keys]
+    parents = range(len(hashes))
+    def find(n):
+        while not parents[n] == n:
+            parents[n] = parents[parents[n]]
+            n = parents[n]
+        return n
+
+    count = get_piece_count(len(hashes), max_distance)
+    radius = max_distance / count
+    pieces = [get_chunks(h, count) for h in hashes]
+    tables = []
+    for piece in range(count):
+        table = {}
+        for n, p in enumerate(pieces):
+            table.setdefault(p[piece], []).append(n)
+        tables.append(table)
+    flips = [get_flips(width, radius) for width in get_widths(count)]
+
+    for n, h in enumerate(hashes):
+        for piece, table in enumerate(tables):
+            value = pieces[n][piece]
+            for f in flips[piece]:
+                for m in table.get(value ^ f, ()):
+                    # Each pair is only compared from its first hash
+                    if m > n and bin(h ^ hashes[m]).count('1') <= max_distance and (similar_colors(keys[n][1:], keys[m][1:]) or similar_colors(keys[m][1:], keys[n][1:])):
+                        a, b = find(n), find(m)
+                        if not a == b:
+                            parents[b] = a
+
+    clusters = {}
+    for n, key in enumerate(keys):
+        clusters.setdefault(find(n), []).extend(ids[key])
+    return sorted((sorted(c) for c in clusters.itervalues() if len(c) > 1), key=lambda c: (-len(c), c[0]))
@@ -0,0 +1,119 @@
+import sys
+
+# Optional, it's only faster
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# How names are turned into arrays of characters, matching what len() counts
+if sys.maxunicode > 0xffff:
+    char_encoding, char_type = 'utf-32-le', 'uint32'
+else:
+    char_encoding, char_type = 'utf-16-le', 'uint16'
+
+def get_masks(name):
+# a bit for each position in name that holds each of its characters
+    masks = {}
+    for i, c in enumerate(name):
+        masks[c] = masks.get(c, 0) | (1 << i)
+    return masks
+
+def python_distances(name, names, max_dist=-1):
+# Myers' bit-parallel edit distance, one column of the usual table per step,
+# with every row of the column held in the bits of an int.  Gives up on a name
+# once it can't finish within max_dist.
+    m = len(name)
+    if m == 0:
+        return [len(n) if max_dist < 0 or len(n) <= max_dist else None for n in names]
+    masks = get_masks(name)
+    full = (1 << m) - 1
+    top = 1 << (m - 1)
+    results = []
+    for other in names:
+        remaining = len(other)
+        if max_dist >= 0 and abs(m - remaining) > max_dist:
+            results.append(None)
+            continue
+        pv, mv, score = full, 0, m
+        for c in other:
+            eq = masks.get(c, 0)
+            xv = eq | mv
+            xh = (((eq & pv) + pv) ^ pv) | eq
+            ph = mv | ~(xh | pv)
+            mh = pv & xh
+            if ph & top:
+                score += 1
+            elif mh & top:
+                score -= 1
+            ph = (ph << 1) | 1
+            mh = mh << 1
+            pv = (mh | ~(xv | ph)) & full
+            mv = ph & xv & full
+            remaining -= 1
+            # Each character left can take at most one off the score
+            if max_dist >= 0 and score - remaining > max_dist:
+                score = None
+                break
+        results.append(score)
+    return results
+
+def numpy_distances(name, names, max_dist=-1):
+# the same algorithm run on every name at once, a character position at a
+# time.  Only works for names of up to 63 characters.
+    m = len(name)
+    k = len(names)
+    lengths = numpy.array([len(n) for n in names], dtype='int64')
+    longest = int(lengths.max())
+
+    # Each name's characters, as the index of their mask (0 for none), in a row
+    chars = numpy.frombuffer(u"".join(names).encode(char_encoding), dtype=char_type)
+    codes = numpy.zeros(len(chars), dtype='int64')
+    masks = get_masks(name)
+    table = numpy.zeros(len(masks) + 1, dtype='uint64')
+    for n, (c, mask) in enumerate(masks.iteritems(), 1):
+        codes[chars == ord(c)] = n
+        table[n] = mask
+    rows = numpy.repeat(numpy.arange(k), lengths)
+    columns = numpy.arange(len(chars)) - numpy.repeat(numpy.cumsum(lengths) - lengths, lengths)
+    padded = numpy.zeros((k, longest), dtype='int64')
+    padded[rows, columns] = codes
+
+    one = numpy.uint64(1)
+    full = numpy.uint64((1 << m) - 1)
+    top = numpy.uint64(1 << (m - 1))
+    zero = numpy.uint64(0)
+    pv = numpy.full(k, full, dtype='uint64')
+    mv = numpy.zeros(k, dtype='uint64')
+    score = numpy.full(k, m, dtype='int64')
+    for j in range(longest):
+        active = lengths > j
+        eq = table[padded[:, j]]
+        xv = eq | mv
+        xh = (((eq & pv) + pv) ^ pv) | eq
+        ph = mv | ~(xh | pv)
+        mh = pv & xh
+        step = (ph & top != zero).astype('int64') - (mh & top != zero).astype('int64')
+        score += numpy.where(active, step, 0)
+        ph = (ph << one) | one
+        mh = mh << one
+        pv = numpy.where(active, (mh | ~(xv | ph)) & full, pv)
+        mv = numpy.where(active, ph & xv & full, mv)
+
+    results = score.tolist()
+    if max_dist >= 0:
+        results = [d if d <= max_dist else None for d in results]
+    return results
+
+def distances(name, names, max_dist=-1):
+# the Levenshtein distance from name to each of names, or None for those
+# further than max_dist (when it isn't negative), using the fastest way
+# available for them
+    if len(names) == 0:
+        return []
+    if numpy == None or len(names) < 32 or not 0 < len(name) <= 63:
+        return python_distances(name, names, max_dist)
+    try:
+        return numpy_distances(unicode(name), [unicode(n) for n in names], max_dist)
+    except UnicodeError:
+        return python_distances(name, names, max_dist)
@@ -0,0 +1,79 @@
+import time
+from peewee import fn
+from gdg.data import Image, Job, get_variable_limit
+
+# Every image the scraper has to process has a job, which goes from pending to
+# working when it's handed to a worker, then to done, or back to pending for
+# another try later on if it failed.  Images that keep failing end up failed and
+# are left alone until their file changes or they're retried by hand.  Jobs
+# survive the scraper stopping, so the next run picks up where the last left off.
+pending, working, done, failed = 'pending', 'working', 'done', 'failed'
+
+# Same as the scraper's, SQLite only takes so many variables at once
+chunk_size = 500
+
+def needs_processing():
+    return (Image.thumb == None) | (Image.phash == None) | (Image.colors == None)
+
+def queue_jobs(ids=None):
+# adds a job for each image that needs processing and doesn't have one yet, and
+# starts over the finished ones of images that need processing again.  Jobs of
+# images whose files changed were already removed when they changed.
+    if ids == None:
+        chunks = [None]
+    else:
+        ids = list(ids)
+        chunks = [ids[n:n+chunk_size] for n in range(0, len(ids), chunk_size)]
+    for chunk in chunks:
+        images = Image.select(Image.id).where(needs_processing())
+        if not chunk == None:
+            images = images.where(Image.id << chunk)
+        Job.insert_from([Job.image], images).on_conflict('IGNORE').execute()
+        Job.update(state=pending, attempts=0, due=0, error=None).where(Job.state == done, Job.image << images).execute()
+
+def resume_jobs():
+# jobs left working were interrupted by the scraper stopping without cleaning up
+# after itself.  They get another go, but it still counts as an attempt, in case
+# it was the image that brought the scraper down.
+    return Job.update(state=pending).where(Job.state == working).execute()
+
+def claim_jobs(count, now=None):
+# up to count jobs that are due, marked as working, as [(id, attempts)]
+    now = time.time() if now == None else now
+    jobs = list(Job.select(Job.image, Job.attempts).where(Job.state == pending, Job.due <= now).order_by(Job.due, Job.image).limit(count).tuples())
+    if len(jobs) > 0:
+        Job.update(state=working, attempts=Job.attempts + 1).where(Job.image << [id for id, attempts in jobs]).execute()
+    return [(id, attempts + 1) for id, attempts in jobs]
+
+def finish_jobs(ids):
+    ids = list(ids)
+    per = get_variable_limit()
+    for n in range(0, len(ids), per):
+        Job.update(state=done, error=None).where(Job.image << ids[n:n+per]).execute()
+
+def fail_job(id, attempts, error, max_attempts, retry_delay, now=None):
+# puts the job off for twice as long after each failed attempt, and gives up on
+# it after max_attempts of them.  Returns whether it was given up on.
+    now = time.time() if now == None else now
+    if attempts >= max_attempts:
+        Job.update(state=failed, error=error).where(Job.image == id).execute()
+        return True
+    Job.update(state=pending, due=now + retry_delay * 2 ** (attempts - 1), error=error).where(Job.image == id).execute()
+    return False
+
+def release_jobs(ids):
+# hands back jobs that were cut short through no fault of their own, without
+# counting the attempt
+    ids = list(ids)
+    for n in range(0, len(ids), chunk_size):
+        Job.update(state=pending, attempts=Job.attempts - 1).where(Job.image << ids[n:n+chunk_size], Job.state == working).execute()
+
+def retry_failed_jobs():
+    return Job.update(state=pending, attempts=0, due=0, error=None).where(Job.state == failed).execute()
+
+def get_next_due():
+# when the next pending job is due, or None if there aren't any
+    return Job.select(fn.Min(Job.due)).where(Job.state == pending).scalar()
+
+def get_failed_jobs():
+    return Job.select(Image.path, Job.attempts, Job.error).join(Image).where(Job.state == failed).order_by(Image.path).tuples()
@@ -0,0 +1,158 @@
+import struct
+import datetime
+import PIL
+from PIL import Image
+
+# EXIF tags worth keeping
+orientation_tag = 274
+make_tag = 271
+model_tag = 272
+datetime_tag = 306
+taken_tag = 36867
+
+# How to turn an image so it shows the way its EXIF orientation says it should
+transpositions = {
+    2: Image.FLIP_LEFT_RIGHT,
+    3: Image.ROTATE_180,
+    4: Image.FLIP_TOP_BOTTOM,
+    5: Image.TRANSPOSE,
+    6: Image.ROTATE_270,
+    7: Image.TRANSVERSE,
+    8: Image.ROTATE_90
+}
+
+def get_exif(img):
+# the image's EXIF tags, as long as they can be had without decoding it
+    if not 'exif' in img.info:
+        return {}
+    try:
+        return dict(img.getexif())
+    except Exception:
+        return {}
+
+def get_orientation(exif):
+    orientation = exif.get(orientation_tag)
+    return orientation if orientation in transpositions else 1
+
+def orient_image(img, orientation):
+    if not orientation in transpositions:
+        return img
+    return img.transpose(transpositions[orientation])
+
+def get_text(exif, tag):
+    value = exif.get(tag)
+    if not isinstance(value, basestring):
+        return None
+    value = value.strip('\x00 ')
+    if isinstance(value, str):
+        value = value.decode('utf-8', 'replace')
+    return value if value else None
+
+def get_taken(exif):
+# when the photo was taken, as "YYYY-MM-DD HH:MM:SS" in the camera's time
+    for tag in [taken_tag, datetime_tag]:
+        value = get_text(exif, tag)
+        try:
+            return datetime.datetime.strptime(value, "%Y:%m:%d %H:%M:%S").strftime("%Y-%m-%d %H:%M:%S")
+        except (TypeError, ValueError):
+            continue
+    return None
+
+def get_camera(exif):
+    make = get_text(exif, make_tag)
+    model = get_text(exif, model_tag)
+    if make == None or model == None:
+        return model or make
+    # Most models already start with the make, "Canon Canon EOS 5D" is silly
+    if model.lower().startswith(make.split()[0].lower()):
+        return model[0:128]
+    return (make + " " + model)[0:128]
+
+def skip_sub_blocks(f):
+    while True:
+        n = f.read(1)
+        if not n or n == '\x00':
+            return
+        f.seek(ord(n), 1)
+
+def count_gif_frames(f):
+# walks the blocks of a GIF, skipping over each frame's data
+    header = f.read(13)
+    if len(header) < 13 or not header[0:3] == 'GIF':
+        return None
+    flags = ord(header[10])
+    if flags & 0x80:
+        f.seek(3 << ((flags & 7) + 1), 1)
+    frames = 0
+    while True:
+        block = f.read(1)
+        if block == '\x2c':
+            descriptor = f.read(9)
+            if len(descriptor) < 9:
+                break
+            frames += 1
+            flags = ord(descriptor[8])
+            if flags & 0x80:
+                f.seek(3 << ((flags & 7) + 1), 1)
+            # LZW code size
+            f.read(1)
+            skip_sub_blocks(f)
+        elif block == '\x21':
+            f.read(1)
+            skip_sub_blocks(f)
+        else:
+            # The trailer, or the end of a truncated file
+            break
+    return frames
+
+def count_png_frames(f):
+# an animated PNG says how many frames it has before its image data starts
+    if not f.read(8) == '\x89PNG\r\n\x1a\n':
+        return None
+    while True:
+        head = f.read(8)
+        if len(head) < 8:
+            return 1
+        length, kind = struct.unpack(">I4s", head)
+        if kind == 'acTL':
+            return struct.unpack(">I", f.read(4))[0]
+        if kind in ('IDAT', 'IEND'):
+            return 1
+        f.seek(length + 4, 1)
+
+def count_webp_frames(f):
+    head = f.read(12)
+    if not head[0:4] == 'RIFF' or not head[8:12] == 'WEBP':
+        return None
+    frames = 0
+    while True:
+        chunk = f.read(8)
+        if len(chunk) < 8:
+            break
+        kind, length = struct.unpack("<4sI", chunk)
+        if kind == 'ANMF':
+            frames += 1
+        f.seek(length + (length & 1), 1)
+    return max(frames, 1)
+
+frame_counters = { 'GIF': count_gif_frames, 'PNG': count_png_frames, 'WEBP': count_webp_frames }
+
+def get_image_metadata(img, f):
+# what can be learned about the image from its headers alone: the size it's
+# shown at, its orientation, when it was taken and by what, and how many
+# frames it has.  f is the file img was opened from.
+    exif = get_exif(img)
+    orientation = get_orientation(exif)
+    x, y = img.size
+    if orientation >= 5:
+        x, y = y, x
+    frames = 1
+    counter = frame_counters.get(img.format)
+    if not counter == None:
+        f.seek(0)
+        frames = counter(f) or 1
+    return { 'x': x, 'y': y, 'orientation': orientation, 'taken': get_taken(exif), 'camera': get_camera(exif), 'frames': frames }
+
+def read_image_metadata(path):
+    with open(path, 'rb') as f:
+        return get_image_metadata(PIL.Image.open(f), f)
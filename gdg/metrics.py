@@ -0,0 +1,116 @@
+import os
+import time
+import bisect
+import threading
+
+# Upper bounds of the buckets histograms sort what they're given into, in
+# seconds for timings and as they are for counts
+time_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+count_buckets = (0, 1, 2, 5, 10, 20, 50, 100, 250, 1000)
+
+# Set from the [metrics] section of gdg.conf.  Off, nothing is timed or written.
+enabled = True
+
+# What the request being handled on this thread has done so far, if one is
+current = threading.local()
+
+class Histogram(object):
+# how many observations fell under each bucket, and their sum, for each set of
+# label values.  Only a lock and a bisect per observation, so it can be left on.
+    def __init__(self, name, help, labels=(), buckets=time_buckets):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.series = {}
+
+    def observe(self, value, *labels):
+        n = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(labels)
+            if series == None:
+                series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][n] += 1
+            series[1] += value
+
+    def render(self):
+    # the histogram in Prometheus' text format
+        lines = ["# HELP {} {}".format(self.name, self.help), "# TYPE {} histogram".format(self.name)]
+        with self.lock:
+            series = sorted((labels, list(counts), total) for labels, (counts, total) in self.series.iteritems())
+        for labels, counts, total in series:
+            names = ['{}="{}"'.format(name, escape(value)) for name, value in zip(self.labels, labels)]
+            count = 0
+            for bound, n in zip(self.buckets + ('+Inf',), counts):
+                count += n
+                lines.append("{}_bucket{{{}}} {}".format(self.name, ",".join(names + ['le="{}"'.format(bound)]), count))
+            suffix = "{" + ",".join(names) + "}" if names else ""
+            lines.append("{}_sum{} {!r}".format(self.name, suffix, total))
+            lines.append("{}_count{} {}".format(self.name, suffix, count))
+        return "\n".join(lines) + "\n"
+
+def escape(value):
+    return unicode(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n').encode('utf-8')
+
+requests = Histogram('gdg_request_seconds', "Time taken to handle a request, from routing to the last byte sent.", ('handler', 'method', 'status'))
+queries = Histogram('gdg_request_queries', "Database queries run per request.", ('handler',), count_buckets)
+query_time = Histogram('gdg_request_query_seconds', "Time per request spent running database queries, to their first row.", ('handler',))
+renders = Histogram('gdg_render_seconds', "Time taken to render a page's template.", ('template',))
+scrape_stages = Histogram('gdg_scrape_stage_seconds', "Time taken by each stage of processing an image.", ('stage',))
+
+web_metrics = [requests, queries, query_time, renders]
+scraper_metrics = [scrape_stages]
+
+class RequestStats(object):
+    __slots__ = ['queries', 'query_time', 'render_time']
+    def __init__(self):
+        self.queries = 0
+        self.query_time = 0.0
+        self.render_time = 0.0
+
+def start_request():
+    current.stats = RequestStats()
+
+def end_request():
+# the stats of the request on this thread, which is no longer being counted
+    stats = getattr(current, 'stats', None)
+    current.stats = None
+    return stats
+
+def record_query(seconds):
+# called for every query, but only counted towards a request's
+    stats = getattr(current, 'stats', None)
+    if not stats == None:
+        stats.queries += 1
+        stats.query_time += seconds
+
+def record_render(template, seconds):
+    if not enabled:
+        return
+    renders.observe(seconds, template)
+    stats = getattr(current, 'stats', None)
+    if not stats == None:
+        stats.render_time += seconds
+
+def render(metrics):
+    return "".join(m.render() for m in metrics)
+
+def write_metrics(path, metrics):
+# writes metrics to path for a Prometheus textfile collector, or for /metrics
+# to pass on.  The old file's replaced in one go so it's never read half-written.
+    temp = "{}.{}.tmp".format(path, os.getpid())
+    with open(temp, 'w') as f:
+        f.write(render(metrics))
+    os.rename(temp, path)
+
+class Stopwatch(object):
+# [(stage, seconds)] for each stage of some work, a lap at a time
+    def __init__(self):
+        self.laps = []
+        self.last = time.time()
+
+    def lap(self, stage):
+        now = time.time()
+        self.laps.append((stage, now - self.last))
+        self.last = now
@@ -0,0 +1,197 @@
+import os
+import re
+import bisect
+import cPickle
+import threading
+from array import array
+from gdg.data import Image
+
+# Files written by an older version are rebuilt
+format_version = 1
+
+word = re.compile(r"\w+")
+
+indexes = {}
+indexes_lock = threading.Lock()
+
+def trigrams(text):
+    return set(text[n:n + 3] for n in range(len(text) - 2))
+
+def contains(postings, position):
+    n = bisect.bisect_left(postings, position)
+    return n < len(postings) and postings[n] == position
+
+def get_name_index(dbpath):
+# the index for the database in dbpath, shared by every thread in the process
+    path = os.path.join(dbpath, 'gallery.names')
+    with indexes_lock:
+        if not path in indexes:
+            indexes[path] = NameIndex(path)
+        return indexes[path]
+
+class NameIndex(object):
+# a trigram index over image file names, kept in memory and in a file next to
+# the database.  Entries are only ever appended: when an image is renamed or
+# deleted its old entry is marked removed, and the index is compacted once a
+# quarter of it is dead.  The scraper updates it from the name_changes table,
+# everyone else reloads it when the file changes.
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.stamp = None
+        self._reset()
+
+    def _reset(self):
+        self.ids = array('i')
+        self.names = []
+        self.postings = {}
+        self.removed = set()
+        self.positions = None
+
+    def _add(self, id, name):
+        p = len(self.ids)
+        self.ids.append(id)
+        self.names.append(name)
+        for g in trigrams(name.lower()):
+            postings = self.postings.get(g)
+            if postings == None:
+                postings = self.postings[g] = array('i')
+            postings.append(p)
+        if not self.positions == None:
+            self.positions[id] = p
+
+    def _get_stamp(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return (st.st_mtime, st.st_size)
+
+    def _load(self):
+        stamp = self._get_stamp()
+        if stamp == None:
+            return False
+        try:
+            with open(self.path, 'rb') as f:
+                data = cPickle.load(f)
+        except Exception:
+            return False
+        if not data.get('version') == format_version:
+            return False
+        self._reset()
+        self.ids.fromstring(data['ids'])
+        self.names = data['names']
+        for g, postings in data['postings'].iteritems():
+            self.postings[g] = array('i', postings)
+        self.removed = set(data['removed'])
+        self.stamp = stamp
+        return True
+
+    def _build(self, db, chunk=10000):
+        self._reset()
+        self.positions = {}
+        last = 0
+        while True:
+            images = list(Image.select(Image.id, Image.path).where(Image.id > last).order_by(Image.id).limit(chunk).tuples())
+            if len(images) == 0:
+                break
+            for id, path in images:
+                self._add(id, os.path.basename(path))
+            last = images[-1][0]
+
+    def _compact(self):
+        ids, names = self.ids, self.names
+        removed = self.removed
+        tracked = not self.positions == None
+        self._reset()
+        if tracked:
+            self.positions = {}
+        for p, id in enumerate(ids):
+            if not p in removed:
+                self._add(id, names[p])
+
+    def _save(self):
+        if len(self.removed) * 4 > len(self.ids):
+            self._compact()
+        data = {
+            'version': format_version,
+            'ids': self.ids.tostring(),
+            'names': self.names,
+            'postings': dict((g, postings.tostring()) for g, postings in self.postings.iteritems()),
+            'removed': list(self.removed)
+        }
+        tmp = self.path + '.tmp'
+        with open(tmp, 'wb') as f:
+            cPickle.dump(data, f, 2)
+        os.rename(tmp, self.path)
+        self.stamp = self._get_stamp()
+
+    def refresh(self, db):
+    # picks up the scraper's latest changes, building the index if there's
+    # no file to load it from
+        with self.lock:
+            stamp = self._get_stamp()
+            if stamp == None:
+                self._build(db)
+                self.positions = None
+                self._save()
+            elif not stamp == self.stamp:
+                if not self._load():
+                    self._build(db)
+                    self.positions = None
+
+    def update(self, db, chunk=500):
+    # applies the changes recorded in name_changes since the last update.
+    # Returns how many images changed.
+        with self.lock:
+            with db.transaction():
+                changed = [row[0] for row in db.execute_sql("SELECT image_id FROM name_changes").fetchall()]
+                stamp = self._get_stamp()
+                if len(changed) == 0 and not stamp == None:
+                    return 0
+                if not stamp == None and stamp == self.stamp or self._load():
+                    self._apply(changed, chunk)
+                    # Rebuild rather than trust an index that's drifted from the database
+                    if not len(self.positions) == Image.select().count():
+                        self._build(db)
+                else:
+                    self._build(db)
+                self._save()
+                db.execute_sql("DELETE FROM name_changes")
+            return len(changed)
+
+    def _apply(self, changed, chunk):
+        if self.positions == None:
+            self.positions = dict((id, p) for p, id in enumerate(self.ids) if not p in self.removed)
+        for n in range(0, len(changed), chunk):
+            ids = changed[n:n + chunk]
+            paths = dict(Image.select(Image.id, Image.path).where(Image.id << ids).tuples())
+            for id in ids:
+                p = self.positions.pop(id, None)
+                if not p == None:
+                    self.removed.add(p)
+                if id in paths:
+                    self._add(id, os.path.basename(paths[id]))
+
+    def find(self, pattern, query):
+    # the (id, file name) of every image whose name matches pattern.  Every
+    # run of word characters in query has to appear in a matching name, so
+    # only names with all of their trigrams are tried against the pattern.
+        with self.lock:
+            ids, names, postings, removed = self.ids, self.names, self.postings, self.removed
+        grams = set()
+        for w in word.findall(query.lower()):
+            grams |= trigrams(w)
+        if len(grams) > 0:
+            lists = sorted((postings.get(g, ()) for g in grams), key=len)
+            candidates = lists[0]
+            for l in lists[1:]:
+                # Look the few up in a long list, otherwise intersect the lot
+                if len(l) > 16 * len(candidates):
+                    candidates = [p for p in candidates if contains(l, p)]
+                else:
+                    candidates = set(candidates).intersection(l)
+        else:
+            candidates = xrange(len(ids))
+        regex = re.compile(pattern, re.I)
+        return [(ids[p], names[p]) for p in candidates if not p in removed and regex.search(names[p])]
@@ -0,0 +1,48 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+class ResponseCache(object):
+# rendered pages and API responses, kept while the database's generation stays
+# the same, up to max_bytes of them, evicting the least recently used ones once
+# it fills up.  A new generation throws the lot away.
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.generation = None
+        self.entries = OrderedDict()
+        self.total = 0
+
+    def _check(self, generation):
+        if not generation == self.generation:
+            self.generation = generation
+            self.entries.clear()
+            self.total = 0
+
+    def get(self, key, generation):
+    # (etag, body) as cached for key, or None if it hasn't been cached since the
+    # database last changed
+        with self.lock:
+            self._check(generation)
+            entry = self.entries.pop(key, None)
+            if entry == None:
+                return None
+            self.entries[key] = entry
+            return entry[0:2]
+
+    def put(self, key, generation, body):
+    # caches body and returns it as get() would.  Bodies rendered from an older
+    # generation than the one now cached are handed back but not kept.
+        data = body.encode('utf-8') if isinstance(body, unicode) else body
+        entry = ('"{}"'.format(hashlib.md5(data).hexdigest()), body, len(data))
+        with self.lock:
+            if generation == self.generation and entry[2] <= self.max_bytes:
+                old = self.entries.pop(key, None)
+                if not old == None:
+                    self.total -= old[2]
+                self.entries[key] = entry
+                self.total += entry[2]
+                while self.total > self.max_bytes:
+                    old_key, old = self.entries.popitem(last=False)
+                    self.total -= old[2]
+        return entry[0:2]
@@ -1,30 +1,161 @@
 import os
-import mimetypes
+import io
+import sys
+import glob
+import time
+import errno
+import hashlib
 import ConfigParser
+import Queue
 import PIL
-from multiprocessing import Pool
-from PIL import Image, ImageOps
+from multiprocessing import Pool, cpu_count
+from PIL import Image, ImageOps, ImageSequence, features
 from peewee import *
 import gdg
 from gdg.data import *
+from gdg.names import get_name_index
+from gdg import metrics
+from gdg.metrics import Stopwatch
+from gdg.duplicates import to_signed, find_duplicate_clusters
+from gdg.colors import format_colors, index_colors
+from gdg.metadata import get_image_metadata, read_image_metadata, orient_image
+from gdg.walk import get_image_files, is_image, Exclusions
+from gdg.jobs import queue_jobs, resume_jobs, claim_jobs, finish_jobs, fail_job, release_jobs, retry_failed_jobs, get_next_due, get_failed_jobs
+from gdg.watch import Inotify, IN_CREATE, IN_MOVED_FROM, IN_MOVED_TO, IN_Q_OVERFLOW
 
 
 
 config = ConfigParser.ConfigParser()
 
-def is_image(file):
-    return (mimetypes.guess_type(file)[0] and mimetypes.guess_type(file)[0].startswith('image'))
+# Should these be configuration variables?
+# Rows read from the database at a time when diffing and processing
+chunk_size = 1000
+# Files hashed and written per transaction when diffing
+write_size = 1000
+# Results saved per transaction when processing
+batch_size = 50
 
-def get_image_files(path, follow_links=True):
-    images = []
-    for root, dirs, files in os.walk(path, followlinks=follow_links):
-        for filename in files:
-            if (is_image(filename)):
-                images.append(os.path.join(root, filename))
-    return images
+# What processing an image fills in, all of it thrown away when the file changes
+derived_columns = ['thumb', 'thumb_key', 'animation', 'x', 'y', 'r', 'g', 'b', 'phash', 'colors', 'orientation', 'taken', 'camera', 'frames']
+# and what's read from its headers before that, see gdg/metadata.py
+metadata_columns = ['x', 'y', 'orientation', 'taken', 'camera', 'frames']
 
-def get_thumb(path, base, ext):
-    return os.path.join(path, base + ext)
+def get_file_hash(path, size=None, block=65536):
+# a quick content hash of the file's size and first and last blocks, used to
+# recognize files that were moved between filesystems
+    if size == None:
+        size = os.path.getsize(path)
+    h = hashlib.md5(str(size))
+    with open(path, 'rb') as f:
+        h.update(f.read(block))
+        if size > block * 2:
+            f.seek(-block, os.SEEK_END)
+            h.update(f.read(block))
+    return h.hexdigest()
+
+class DirectoryTracker(object):
+# remembers which directories were visited and which of them changed since the
+# last scan, so their mtimes can be stored once the scan is complete.  It's
+# called from the walker's threads, so what's known about the directories is
+# loaded up front rather than looked up as they're visited.
+    def __init__(self, full=False):
+        self.full = full
+        self.seen = set()
+        self.unchanged = set()
+        self.changed = []
+        self.known = {}
+        self.children = {}
+        if not full:
+            for path, parent, mtime in Directory.select(Directory.path, Directory.parent, Directory.mtime).tuples():
+                self.known[path] = mtime
+                self.children.setdefault(parent, []).append(path)
+
+    def __call__(self, path, st):
+        self.seen.add(path)
+        if self.known.get(path) == st.st_mtime:
+            self.unchanged.add(path)
+            return self.children.get(path, [])
+        self.changed.append((path, os.path.dirname(path), st.st_mtime))
+        return None
+
+    def save(self, db):
+        with db.transaction():
+            insert_rows(Directory, [{ 'path': path, 'parent': parent, 'mtime': mtime } for path, parent, mtime in self.changed], upsert=True)
+        # Forget directories that no longer exist
+        last = None
+        while True:
+            q = Directory.select(Directory.path).order_by(Directory.path).limit(chunk_size)
+            if not last == None:
+                q = q.where(Directory.path > last)
+            paths = [d.path for d in q]
+            if len(paths) == 0:
+                break
+            stale = [p for p in paths if not p in self.seen]
+            if len(stale) > 0:
+                Directory.delete().where(Directory.path << stale).execute()
+            last = paths[-1]
+
+def get_known_images(chunk=chunk_size):
+# yields (id, path, thumb, mtime, size, inode, thumb_key) for every image in the
+# database, ordered by path.  Rows are fetched a chunk at a time, seeking past the
+# last path seen.
+    last = None
+    while True:
+        q = Image.select(Image.id, Image.path, Image.thumb, Image.mtime, Image.size, Image.inode, Image.thumb_key).order_by(Image.path).limit(chunk)
+        if not last == None:
+            q = q.where(Image.path > last)
+        rows = list(q.tuples())
+        if len(rows) == 0:
+            return
+        for row in rows:
+            yield row
+        last = rows[-1][1]
+
+class Workers(object):
+# the processes images are handed to.  A worker stuck on an image can't be
+# stopped on its own, so the whole pool is thrown away and started over.
+    def __init__(self, processes=None):
+        self.processes = processes or cpu_count()
+        self.pool = Pool(self.processes)
+
+    def submit(self, arg, callback):
+        self.pool.apply_async(scrape_image_data, (arg,), callback=callback)
+
+    def restart(self):
+        self.pool.terminate()
+        self.pool.join()
+        # Don't hand an open connection to the new workers
+        close_database()
+        self.pool = Pool(self.processes)
+
+    def close(self):
+        self.pool.close()
+
+    def terminate(self):
+        self.pool.terminate()
+
+    def join(self):
+        self.pool.join()
+
+def get_job_options():
+    get = lambda name, default: config.getfloat('scraper', name) if config.has_option('scraper', name) else default
+    return { 'timeout': get('job_timeout', 120), 'attempts': int(get('job_attempts', 3)), 'retry_delay': get('retry_delay', 30) }
+
+def get_thumb(path, key, size, format):
+# thumbnails are named after the content they were made from, sharded by the
+# first two bytes of that key so no one directory gets too big
+    return os.path.join(path, key[0:2], key[2:4], get_thumb_name(key, size, format))
+
+def get_animation(path, key, size, format):
+# animated thumbnails go alongside the still ones, so they're removed with them
+    return os.path.join(path, key[0:2], key[2:4], get_animation_name(key, size, format))
+
+def get_thumb_key(data, aspect_ratio, orientation=1):
+# images that have to be turned to be shown get thumbnails of their own, rather
+# than the unturned ones made before orientation was taken into account
+    if orientation in (None, 1):
+        return hashlib.sha1(aspect_ratio + data).hexdigest()
+    return hashlib.sha1(aspect_ratio + str(orientation) + data).hexdigest()
 
 def get_directory(path):
     path = path.translate(None, '"\'')
@@ -34,7 +165,45 @@ def get_directory(path):
         return os.path.abspath(path)
     return os.path.join(gdg.current_dir, path)
 
-def scrape_images():
+def get_image_directory():
+# the image directory as unicode, so that paths found on disk compare cleanly
+# with the ones stored in the database
+    path = get_directory(config.get('images', 'path'))
+    if isinstance(path, str):
+        path = path.decode(sys.getfilesystemencoding() or 'utf-8')
+    return path
+
+def get_exclusions(imgpath):
+    patterns = config.get('images', 'exclude').translate(None, '"\'') if config.has_option('images', 'exclude') else ""
+    # Thumbnails kept among the images would be found as images themselves
+    paths = [get_directory(config.get('thumbnails', p)) for p in ['path', 'cache_path'] if config.has_option('thumbnails', p)]
+    return Exclusions(imgpath, [p.strip() for p in patterns.split(',') if p.strip()], paths)
+
+def get_walk_threads():
+    return config.getint('images', 'walk_threads') if config.has_option('images', 'walk_threads') else 8
+
+def get_thumbnail_options():
+    formats = get_thumb_formats(config.get('thumbnails', 'formats').translate(None, '"\''))
+    if 'webp' in formats and not features.check('webp'):
+        print("This copy of Pillow doesn't support WebP, skipping WebP thumbnails.")
+        formats.remove('webp')
+    animation_format = config.get('thumbnails', 'animation_format').translate(None, '"\'').lower() if config.has_option('thumbnails', 'animation_format') else 'webp'
+    if animation_format == 'webp' and not features.check('webp_anim'):
+        print("This copy of Pillow can't make animated WebPs, making animated GIF thumbnails instead.")
+        animation_format = 'gif'
+    return {
+        'path': get_directory(config.get('thumbnails', 'path')),
+        'sizes': get_thumb_sizes(config.get('thumbnails', 'sizes').translate(None, '"\'')),
+        'formats': formats,
+        'aspect_ratio': config.get('thumbnails', 'aspect_ratio').translate(None, '"\''),
+        'draft': config.getboolean('thumbnails', 'draft') if config.has_option('thumbnails', 'draft') else True,
+        'animation_format': animation_format,
+        'animation_frames': config.getint('thumbnails', 'animation_frames') if config.has_option('thumbnails', 'animation_frames') else 48
+    }
+
+def open_database():
+# reads the configuration and makes sure the database exists and is up to date,
+# returning the database path
     config.read(os.path.join(gdg.current_dir, 'gdg.conf'))
     dbpath = get_directory(config.get('database', 'path'))
     dbfile = os.path.join(dbpath, 'gallery.db')
@@ -42,104 +211,644 @@ def scrape_images():
     print("Using database " + dbfile)
     
     if not os.path.isfile(dbfile):
-        try:
-            print("No database exists, initializing.")
-            initscript = os.path.join(gdg.current_dir, 'gallery.sql')
-            import io, sqlite3
-            conn = sqlite3.connect(dbfile)
-            with open(initscript, 'r') as sql:
-                script = sql.read()
-                conn.executescript(script)
-            conn.close()
-        except Exception as ex:
-            print("Unable to initialize database at {}: {}.  Aborting.".format(dbfile, str(ex)))
-            exit()
+        print("No database exists, initializing.")
+
+    configure_database(dict(config.items('database')))
+    metrics.enabled = config.getboolean('metrics', 'enabled') if config.has_option('metrics', 'enabled') else True
+    try:
+        with GoddamnDatabase(dbpath) as db:
+            migrate_database(db)
+    except Exception as ex:
+        print("Unable to initialize database at {}: {}.  Aborting.".format(dbfile, str(ex)))
+        exit()
+    close_database()
+    return dbpath
+
+def scrape_images(full=False):
+    dbpath = open_database()
 
     with GoddamnDatabase(dbpath) as db:
-        current = [i.path for i in Image.select()]
-        imgpath = get_directory(config.get('images', 'path'))
-        print("Searching {} for new images...".format(imgpath))
-        ondisk = get_image_files(imgpath, config.get('images', 'follow_links'))
-        new_files = set(ondisk) - set(current)
-        deleted_files = set(current) - set(ondisk)
-        
-        if len(new_files) > 0:
-            with db.transaction():
-                for f in new_files:
-                    i = Image()
-
-                    g = os.path.dirname(os.path.relpath(f, imgpath)).replace('\\', '/')
-                    
-                    i.path = f
-                    i.gallery = g
-
-                    if g == '':
-                        i.parent = None
-                    else:
-                        i.parent = os.path.dirname(g)
-
-                    i.save()
-                print("Added {} new images.".format(len(new_files)))
-                    
-        if len(deleted_files) > 0:
-            with db.transaction():
-                for f in deleted_files:
-                    img = Image.get(Image.path == f)
-                    try:
-                        if os.path.isfile(img.thumb):
-                            os.remove(img.thumb)
-                    except Exception as ex:
-                        print("Unable to delete thumbnail for deleted image: {}.  You will need to remove this manually.".format(img.thumb))
-                    img.delete_instance()
-                print("Removed records for {} deleted images.".format(len(deleted_files)))
-
-    # 2nd pass - derives metadata, etc 
-    # currently: if there's a thumbnail, assume all processing is complete.
+        print("Searching {} for new images...".format(get_image_directory()))
+        find_images(db, full)
+        resume_jobs()
+    # Don't hand an open connection to the workers
+    close_database()
+
+    workers = Workers()
+    try:
+        with GoddamnDatabase(dbpath) as db:
+            process_images(db, workers)
+            report_failures()
+        workers.close()
+    except KeyboardInterrupt:
+        workers.terminate()
+        print("Scrape halted.")
+    finally:
+        workers.join()
+
+def retry_images():
+# gives images that failed too many times another go
+    dbpath = open_database()
     with GoddamnDatabase(dbpath) as db:
-        q = Image.select().where(Image.thumb == None).naive()
-        total = q.count()
-        if total == 0:
-            return
+        print("{} images will be tried again.".format(retry_failed_jobs()))
+    close_database()
+    scrape_images()
+
+def report_failures():
+    failures = list(get_failed_jobs())
+    if len(failures) == 0:
+        return
+    imgpath = get_image_directory()
+    print("{} images couldn't be processed and were set aside:".format(len(failures)))
+    for path, attempts, error in failures:
+        print("  {} ({} attempts): {}".format(os.path.relpath(path, imgpath), attempts, error))
+    print("They'll be tried again when they change, or with --retry.")
+
+def report_duplicates():
+# prints each group of images that look the same, biggest group first
+    dbpath = open_database()
+    imgpath = get_image_directory()
+    max_distance = config.getint('duplicates', 'max_distance') if config.has_option('duplicates', 'max_distance') else 4
+
+    with GoddamnDatabase(dbpath) as db:
+        start = time.time()
+        clusters = find_duplicate_clusters(max_distance)
+        elapsed = time.time() - start
+        for c in clusters:
+            paths = []
+            for b in range(0, len(c), chunk_size):
+                paths.extend(path for (path,) in Image.select(Image.path).where(Image.id << c[b:b+chunk_size]).tuples())
+            print("")
+            for path in sorted(paths):
+                print("  " + os.path.relpath(path, imgpath))
+        unhashed = Image.select().where(Image.phash == None).count()
+
+    print("")
+    print("Found {} groups of duplicates, {} images in all, in {:.1f} seconds.".format(len(clusters), sum(len(c) for c in clusters), elapsed))
+    if unhashed > 0:
+        print("{} images haven't been processed yet and were left out.".format(unhashed))
+
+def find_images(db, full=False):
+# 1st pass - finds new, changed and deleted images
+    imgpath = get_image_directory()
+    directories = DirectoryTracker(full)
+    ondisk = get_image_files(imgpath, config.getboolean('images', 'follow_links'), directories, get_exclusions(imgpath), get_walk_threads())
+    indb = get_known_images()
+
+    # Anything with an id above this was added by this scan
+    newest = Image.select(fn.Max(Image.id)).scalar() or 0
+    db.execute_sql("CREATE TEMP TABLE IF NOT EXISTS scrape_deleted (id INTEGER PRIMARY KEY)")
+    db.execute_sql("DELETE FROM scrape_deleted")
+
+    # Both sides are sorted by path, so a single merge finds new, changed and deleted files.
+    new_files = []
+    changed_files = []
+    deleted_files = []
+    added = 0
+    changed = 0
+    f = next(ondisk, None)
+    known = next(indb, None)
+    while not f == None or not known == None:
+        if known == None or (not f == None and f[0] < known[1]):
+            new_files.append(f)
+            f = next(ondisk, None)
+        elif f == None or known[1] < f[0]:
+            # Files in unchanged directories aren't listed at all
+            if not os.path.dirname(known[1]) in directories.unchanged:
+                deleted_files.append(known[0])
+            known = next(indb, None)
+        else:
+            if not fingerprint(f[1]) == known[3:6]:
+                changed_files.append((known, f[1]))
+            f = next(ondisk, None)
+            known = next(indb, None)
+
+        if len(new_files) >= write_size:
+            added += add_images(db, imgpath, new_files)
+            new_files = []
+        if len(changed_files) >= write_size:
+            changed += update_images(db, changed_files)
+            changed_files = []
+        if len(deleted_files) >= write_size:
+            mark_deleted(db, deleted_files)
+            deleted_files = []
+
+    added += add_images(db, imgpath, new_files)
+    changed += update_images(db, changed_files)
+    mark_deleted(db, deleted_files)
+
+    moved = move_images(db, newest)
+    removed = remove_images(db)
+    directories.save(db)
+    refresh_galleries(db)
+    get_name_index(os.path.dirname(db.database)).update(db)
+    read = read_metadata(db)
+
+    if added - moved > 0:
+        print("Added {} new images.".format(added - moved))
+    if moved > 0:
+        print("Found {} moved or renamed images.".format(moved))
+    if changed > 0:
+        print("Found {} modified images.".format(changed))
+    if removed > 0:
+        print("Removed records for {} deleted images.".format(removed))
+    if read > 0:
+        print("Read details of {} images.".format(read))
+
+def read_metadata(db, chunk=chunk_size):
+# 2nd pass - reads each new or changed image's size and EXIF details from its
+# headers, without decoding it, so it can be shown properly before it's been
+# processed.  Images that can't be read are marked as having no frames.
+    read = 0
+    while True:
+        images = list(Image.select(Image.id, Image.path, Image.thumb, Image.thumb_key).where(Image.frames == None).order_by(Image.id).limit(chunk).tuples())
+        if len(images) == 0:
+            return read
+        rows = []
+        stale = []
+        for id, path, thumb, key in images:
+            try:
+                metadata = read_image_metadata(path)
+            except Exception:
+                metadata = { 'frames': 0 }
+            # Thumbnails made before orientation was read need making again
+            if not thumb == None and metadata.get('orientation', 1) > 1:
+                stale.append((thumb, key))
+                thumb = key = None
+            # and animations need an animated one, alongside the still one
+            elif metadata.get('frames', 1) > 1:
+                thumb = None
+            rows.append((id, thumb, key) + tuple(metadata.get(c) for c in metadata_columns))
+        with db.transaction():
+            update_rows(Image, ['thumb', 'thumb_key'] + metadata_columns, rows)
+            bump_generation()
+        for thumb, key in stale:
+            remove_thumbnail(thumb, key)
+        read += len(images)
+
+def process_images(db, workers, ids=None, wait=True):
+# 3rd pass - derives metadata, etc, for each image with a job due, see gdg/jobs.py.
+# Each worker gets one image at a time, so one that takes longer than job_timeout
+# can be caught and failed.  Its worker can't be stopped on its own, so no more
+# images are handed out until the others have finished theirs, then the workers
+# are replaced, without losing anyone else's work.  Results are saved a batch at a time as
+# they come back, so an interrupted scrape keeps everything finished so far, and
+# the next one carries on with what's left.  Unless wait is False, this waits
+# for failed images to come due for another try before returning.
+    thumb_options = get_thumbnail_options()
+    job_options = get_job_options()
+    queue_jobs(ids)
+    results = Queue.Queue()
+    running = {}
+    # Images that timed out, whose workers are still stuck on them
+    hung = set()
+    finished = []
+    saved = 0
+    try:
+        while True:
+            if len(hung) > 0 and len(running) == 0:
+                workers.restart()
+                hung.clear()
+
+            if len(hung) == 0 and len(running) < workers.processes:
+                claimed = dict(claim_jobs(workers.processes - len(running)))
+                if len(claimed) > 0:
+                    for i in Image.select().where(Image.id << claimed.keys()):
+                        running[i.id] = (claimed[i.id], time.time())
+                        workers.submit((i, thumb_options), results.put)
+
+            if len(running) == 0:
+                saved += save_results(db, finished, job_options)
+                finished = []
+                due = get_next_due() if wait else None
+                if due == None:
+                    break
+                if due > time.time():
+                    print("Waiting {:.0f} seconds to try failed images again.".format(due - time.time()))
+                    time.sleep(due - time.time())
+                continue
+
+            now = time.time()
+            for id, (attempts, started) in running.items():
+                if now - started > job_options['timeout']:
+                    del running[id]
+                    hung.add(id)
+                    i = Image.select().where(Image.id == id).first()
+                    # Unless it's been deleted since
+                    if not i == None:
+                        finished.append((i, attempts, "Timed out after {:g} seconds".format(job_options['timeout'])))
+            if len(running) == 0:
+                continue
+
+            # Queue.get() cannot be interrupted on Python 2 unless it has a timeout,
+            # and it shouldn't wait past the next image's deadline
+            deadline = min(started for attempts, started in running.itervalues()) + job_options['timeout']
+            try:
+                i, error, laps = results.get(True, min(max(deadline - now, 0.01), 1))
+            except Queue.Empty:
+                continue
+
+            if i.id in hung:
+                # Finished after all, its worker's free again
+                hung.discard(i.id)
+                continue
+            if not i.id in running:
+                continue
+            if metrics.enabled:
+                for stage, seconds in laps:
+                    metrics.scrape_stages.observe(seconds, stage)
+            attempts, started = running.pop(i.id)
+            finished.append((i, attempts, error))
+            if len(finished) >= batch_size:
+                saved += save_results(db, finished, job_options)
+                finished = []
+    finally:
+        release_jobs(running.keys())
+        saved += save_results(db, finished, job_options)
+        if saved > 0:
+            print("Processed {} images.".format(saved))
+        if saved > 0 and metrics.enabled:
+            # For /metrics to pass on, see gdg/metrics.py
+            metrics.write_metrics(os.path.join(os.path.dirname(db.database), 'scraper.prom'), metrics.scraper_metrics)
+
+def watch_images():
+# keeps the database up to date as files change, using inotify where it's
+# available and periodic incremental scans where it isn't
+    dbpath = open_database()
+    imgpath = get_image_directory()
+    follow_links = config.getboolean('images', 'follow_links')
+    exclude = get_exclusions(imgpath)
+    debounce = config.getfloat('scraper', 'watch_debounce')
+    latency = config.getfloat('scraper', 'watch_latency')
+    poll_interval = config.getfloat('scraper', 'poll_interval')
+
+    try:
+        watcher = Inotify()
+    except OSError as ex:
+        print("Unable to use inotify ({}), falling back to polling every {} seconds.".format(ex.strerror, poll_interval))
+        watcher = None
 
-        thumb_path = get_directory(config.get('thumbnails', 'path'))
-        thumb_prefix = config.get('thumbnails', 'prefix').translate(None, '"\'')
-        thumb_postfix = config.get('thumbnails', 'postfix').translate(None, '"\'')
-        thumb_aspect_ratio = config.get('thumbnails', 'aspect_ratio').translate(None, '"\'')
+    workers = Workers()
+    try:
+        with GoddamnDatabase(dbpath) as db:
+            resume_jobs()
+            if not watcher == None:
+                try:
+                    # Watch what we already know about before catching up so nothing is missed in between
+                    for d in Directory.select(Directory.path):
+                        try:
+                            watcher.add_watch(d.path)
+                        except OSError as ex:
+                            if ex.errno == errno.ENOSPC:
+                                raise
+                    find_images(db)
+                    for d in Directory.select(Directory.path):
+                        if not d.path in watcher.watches:
+                            watcher.add_watch(d.path)
+                except OSError as ex:
+                    print("Unable to watch {} ({}), falling back to polling every {} seconds.".format(imgpath, ex.strerror, poll_interval))
+                    watcher.close()
+                    watcher = None
+            else:
+                find_images(db)
+            process_images(db, workers, wait=False)
+
+            print("Watching {} for changes...".format(imgpath))
+            while True:
+                if watcher == None:
+                    time.sleep(poll_interval)
+                    find_images(db)
+                    process_images(db, workers, wait=False)
+                    continue
+
+                # Wait for something to happen, or for failed images to come
+                # due for another try, then for the burst to settle
+                due = get_next_due()
+                events = watcher.read(None if due == None else max(due - time.time(), 0))
+                if len(events) == 0:
+                    process_images(db, workers, wait=False)
+                    continue
+                deadline = time.time() + latency
+                while len(events) > 0:
+                    wait = min(debounce, deadline - time.time())
+                    if wait <= 0:
+                        break
+                    more = watcher.read(wait)
+                    if len(more) == 0:
+                        break
+                    events += more
+
+                if any(e.mask & IN_Q_OVERFLOW for e in events):
+                    print("Too many changes at once, rescanning.")
+                    find_images(db)
+                    for d in Directory.select(Directory.path):
+                        if not d.path in watcher.watches:
+                            watcher.add_tree(d.path, follow_links, exclude)
+                    process_images(db, workers, wait=False)
+                    continue
+
+                ids = apply_events(db, imgpath, follow_links, watcher, events, exclude)
+                if len(ids) > 0:
+                    process_images(db, workers, ids, wait=False)
+        workers.close()
+    except KeyboardInterrupt:
+        workers.terminate()
+        print("Watch stopped.")
+    finally:
+        workers.join()
+        if not watcher == None:
+            watcher.close()
+
+def apply_events(db, imgpath, follow_links, watcher, events, exclude=None):
+# brings the images table in line with a burst of filesystem events, returning
+# the ids of images that need processing.  Anything moved somewhere excluded is
+# as good as deleted.
+    moved_from = {}
+    moves = []
+    paths = set()
+    for e in events:
+        if exclude and exclude.under(e.path):
+            continue
+        if e.mask & IN_MOVED_FROM:
+            moved_from[e.cookie] = e
+        elif e.mask & IN_MOVED_TO and e.cookie in moved_from:
+            moves.append((moved_from.pop(e.cookie).path, e.path, e.is_dir))
+        elif e.is_dir:
+            paths.add(e.path)
+            if e.mask & (IN_CREATE | IN_MOVED_TO):
+                watcher.add_tree(e.path, follow_links, exclude)
+        elif is_image(e.path) and not e.mask & IN_CREATE:
+            # New files are picked up once they've been written and closed
+            paths.add(e.path)
+    # Anything moved out of the tree is as good as deleted
+    for e in moved_from.values():
+        if e.is_dir:
+            watcher.remove_tree(e.path)
+        if e.is_dir or is_image(e.path):
+            paths.add(e.path)
+
+    ids = set()
+    with db.transaction():
+        # Only what actually changed the database should empty the caches
+        changes = db.get_conn().total_changes
+        for old, new, is_dir in moves:
+            if is_dir:
+                watcher.move_tree(old, new)
+                rename_directory(imgpath, old, new)
+            elif is_image(new):
+                if not rename_image(imgpath, old, new):
+                    paths.add(new)
+            else:
+                paths.add(old)
+
+        for p in sorted(paths):
+            if os.path.isdir(p):
+                files = get_image_files(p, follow_links, exclude=exclude, threads=get_walk_threads())
+            elif os.path.isfile(p):
+                files = [(p, os.stat(p))]
+            else:
+                # Gone, along with anything underneath it
+                for id, thumb, key in list(Image.select(Image.id, Image.thumb, Image.thumb_key).where((Image.path == p) | ((Image.path > p + '/') & (Image.path < p + '0'))).tuples()):
+                    Image.delete().where(Image.id == id).execute()
+                    remove_thumbnail(thumb, key)
+                Directory.delete().where((Directory.path == p) | ((Directory.path > p + '/') & (Directory.path < p + '0'))).execute()
+                continue
+
+            for f, st in files:
+                i = Image.select().where(Image.path == f).first()
+                thumb = key = None
+                if i == None:
+                    i = Image(path=f)
+                    set_gallery(i, imgpath)
+                elif fingerprint(st) == (i.mtime, i.size, i.inode):
+                    continue
+                else:
+                    thumb, key = i.thumb, i.thumb_key
+                    for c in derived_columns:
+                        setattr(i, c, None)
+                i.mtime, i.size, i.inode = fingerprint(st)
+                try:
+                    i.hash = get_file_hash(f, i.size)
+                except IOError:
+                    pass
+                i.save()
+                remove_thumbnail(thumb, key)
+                ids.add(i.id)
+        if db.get_conn().total_changes > changes:
+            bump_generation()
+    refresh_galleries(db)
+    get_name_index(os.path.dirname(db.database)).update(db)
+    read_metadata(db)
+    return ids
+
+def rename_image(imgpath, old, new):
+    i = Image.select().where(Image.path == old).first()
+    if i == None:
+        return False
+    i.path = new
+    set_gallery(i, imgpath)
+    i.save()
+    return True
+
+def rename_directory(imgpath, old, new):
+    for i in list(Image.select().where((Image.path > old + '/') & (Image.path < old + '0'))):
+        i.path = new + i.path[len(old):]
+        set_gallery(i, imgpath)
+        i.save()
+    for d in list(Directory.select().where((Directory.path == old) | ((Directory.path > old + '/') & (Directory.path < old + '0')))):
+        d.path = new + d.path[len(old):]
+        d.parent = os.path.dirname(d.path)
+        d.save()
+
+def get_gallery(path, imgpath):
+    return os.path.dirname(os.path.relpath(path, imgpath)).replace('\\', '/')
+
+def set_gallery(i, imgpath):
+    i.gallery = get_gallery(i.path, imgpath)
+    i.parent = get_parent_gallery(i.gallery)
+
+def fingerprint(st):
+    return (st.st_mtime, st.st_size, st.st_ino)
 
-        pool = Pool()
-        to_save = []
+def add_images(db, imgpath, files):
+# files are hashed before the transaction starts, so it's only held for the inserts
+    rows = []
+    for f, st in files:
+        g = get_gallery(f, imgpath)
+        mtime, size, inode = fingerprint(st)
         try:
-            result = pool.map_async(scrape_image_data, [(i, thumb_path, thumb_prefix, thumb_postfix, thumb_aspect_ratio) for i in q.iterator()], 25)
-            to_save = result.get()
-        except KeyboardInterrupt:
-            pool.terminate()
-            print("Scrape halted.")
-            return
+            h = get_file_hash(f, size)
+        except IOError:
+            h = None
+        rows.append({ 'path': f, 'gallery': g, 'parent': get_parent_gallery(g), 'mtime': mtime, 'size': size, 'inode': inode, 'hash': h })
+    # Every change bumps the generation, which empties the web tier's caches
+    if len(rows) == 0:
+        return 0
+    with db.transaction():
+        insert_rows(Image, rows)
+        bump_generation()
+    return len(rows)
+
+def update_images(db, files):
+# refreshes the fingerprints of files that changed on disk.  Anything that was
+# already fingerprinted is queued to be processed again.
+    fingerprinted = []
+    changed = []
+    thumbs = []
+    for (id, path, thumb, mtime, size, inode, key), st in files:
+        if mtime == None:
+            # Fingerprinted for the first time, nothing to compare against
+            fingerprinted.append((id,) + fingerprint(st))
+            continue
+        try:
+            h = get_file_hash(path, st.st_size)
+        except IOError:
+            h = None
+        changed.append((id,) + fingerprint(st) + (h,))
+        thumbs.append((thumb, key))
+    if len(fingerprinted) + len(changed) == 0:
+        return 0
+    with db.transaction():
+        update_rows(Image, ['mtime', 'size', 'inode'], fingerprinted)
+        update_rows(Image, ['mtime', 'size', 'inode', 'hash'], changed, **dict.fromkeys(derived_columns))
+        bump_generation()
+    for thumb, key in thumbs:
+        remove_thumbnail(thumb, key)
+    return len(changed)
+
+def mark_deleted(db, ids):
+    if len(ids) == 0:
+        return
+    with db.transaction():
+        db.get_cursor().executemany("INSERT INTO scrape_deleted (id) VALUES (?)", [(id,) for id in ids])
 
-        # Should this be a configuration variable?
-        bsize = 50
+def move_images(db, newest):
+# matches images that disappeared against ones added by this scan, by inode or
+# by content hash.  The old record is kept, along with its thumbnail and tags,
+# and pointed at the new path.
+    matches = db.execute_sql("""
+        SELECT n.id, o.id FROM scrape_deleted d
+          JOIN images o ON o.id = d.id
+          JOIN images n ON n.size = o.size
+                       AND ((n.inode = o.inode AND n.mtime = o.mtime) OR n.hash = o.hash)
+         WHERE n.id > ?""", (newest,)).fetchall()
+    moved = set()
+    pairs = []
+    for new_id, old_id in matches:
+        if new_id in moved or old_id in moved:
+            continue
+        moved.add(new_id)
+        moved.add(old_id)
+        pairs.append((new_id, old_id))
 
-        for b in range(0, len(to_save), bsize):
-            with db.transaction():
-                for i in to_save[b:b+bsize]:
-                    if i == None: continue
-                    try:
-                        i.save()
-                    except Exception as e:
-                        print("Error saving data for image {}: {}".format(i.path), str(ex))
+    for b in range(0, len(pairs), chunk_size):
+        old = dict(pairs[b:b+chunk_size])
+        rows = [(old[row[0]],) + row[1:] for row in Image.select(Image.id, Image.path, Image.gallery, Image.parent, Image.mtime, Image.inode, Image.hash).where(Image.id << old.keys()).tuples()]
+        with db.transaction():
+            # The new records go first, the old ones are about to take their paths
+            delete_rows(Image, old.keys())
+            update_rows(Image, ['path', 'gallery', 'parent', 'mtime', 'inode', 'hash'], rows)
+            db.execute_sql("DELETE FROM scrape_deleted WHERE id IN ({})".format(','.join('?' * len(rows))), [row[0] for row in rows])
+            bump_generation()
+    return len(pairs)
 
-def scrape_image_data((i, thumb_path, thumb_prefix, thumb_postfix, thumb_aspect_ratio)):
+def remove_images(db):
+    removed = 0
+    while True:
+        images = list(Image.select(Image.id, Image.thumb, Image.thumb_key).where(Image.id << SQL("(SELECT id FROM scrape_deleted)")).limit(chunk_size).tuples())
+        if len(images) == 0:
+            break
+        ids = [id for id, thumb, key in images]
+        with db.transaction():
+            delete_rows(Image, ids)
+            db.execute_sql("DELETE FROM scrape_deleted WHERE id IN ({})".format(','.join('?' * len(ids))), ids)
+            bump_generation()
+        for id, thumb, key in images:
+            remove_thumbnail(thumb, key)
+        removed += len(images)
+    return removed
+
+def remove_thumbnail(thumb, key=None):
+# removes every size and format of an image's thumbnail, unless another image
+# with the same content still uses it.  Call this after the image's record is gone.
+    if not thumb:
+        return
+    thumbs = [thumb]
+    if key:
+        if Image.select().where(Image.thumb_key == key).exists():
+            return
+        thumbs = glob.glob(os.path.join(os.path.dirname(thumb), key + "_*"))
+    for t in thumbs:
+        try:
+            if os.path.isfile(t):
+                os.remove(t)
+        except Exception as ex:
+            print("Unable to delete thumbnail for deleted image: {}.  You will need to remove this manually.".format(t))
+
+def save_results(db, results, options):
+# saves what the workers made of each image, and how its job went, together.
+# Images missing something they should have are saved, but count as failed.
+    images = [i for i, attempts, error in results if error == None]
+    failures = [(i, attempts, error) for i, attempts, error in results if not error == None]
+    failures.extend((i, attempts, "Couldn't be fully processed") for i, attempts, error in results if error == None and None in (i.thumb, i.phash, i.colors))
+    if len(results) == 0:
+        return 0
+    with db.transaction():
+        update_rows(Image, derived_columns, [(i.id,) + tuple(getattr(i, c) for c in derived_columns) for i in images])
+        index_colors(images)
+        bump_generation()
+        finish_jobs(set(i.id for i in images) - set(i.id for i, attempts, error in failures))
+        for i, attempts, error in failures:
+            print("Error processing image {}: {}".format(i.path, error))
+            if fail_job(i.id, attempts, error, options['attempts'], options['retry_delay']):
+                print("Giving up on {} after {} attempts.".format(i.path, attempts))
+    return len(images)
+
+def scrape_image_data((i, options)):
+# returns the image, why it couldn't be processed if it couldn't, and how long
+# each stage of processing it took
+    timer = Stopwatch()
     try:
         # open image
-        image = PIL.Image.open(i.path)
+        with open(i.path, 'rb') as f:
+            data = f.read()
+        timer.lap('read')
+        f = io.BytesIO(data)
+        image = PIL.Image.open(f)
+        extract_image_metadata(i, image, f)
+        key = get_thumb_key(data, options['aspect_ratio'], i.orientation)
+        if options['draft']:
+            largest = max(options['sizes'])
+            image = reduce_image(image, (largest, largest))
+        image.load()
+        timer.lap('decode')
         image = normalize_image(image)
-        extract_image_metadata(i, image)
-        make_thumbnail(i, image, thumb_path, thumb_prefix, thumb_postfix, thumb_aspect_ratio)
+        image = orient_image(image, i.orientation)
+        timer.lap('normalize')
         derive_average_color(i, image)
-        # derive_frequent_colors(i, image)
-        return i
+        derive_perceptual_hash(i, image)
+        derive_frequent_colors(i, image)
+        timer.lap('color')
+        make_thumbnail(i, image, key, options)
+        if i.frames > 1:
+            f.seek(0)
+            make_animated_thumbnail(i, PIL.Image.open(f), key, options)
+        timer.lap('thumbnail')
+        return (i, None, timer.laps)
     except Exception as ex:
-        print("Error processing image {}: {}".format(i.path, str(ex)))
+        return (i, str(ex), timer.laps)
+
+def reduce_image(image, size):
+# shrinks the image to the smallest integer scale that still covers size.  JPEGs
+# are decoded at 1/2, 1/4 or 1/8 scale in draft mode, which skips most of the
+# decoding work; other formats are reduced after decoding where Pillow supports it.
+    if image.format == "JPEG":
+        image.draft("RGB", size)
+    elif hasattr(image, 'reduce'):
+        factor = min(image.size[0] // size[0], image.size[1] // size[1])
+        if factor >= 2:
+            image = image.reduce(factor)
+    return image
 
 def normalize_image(image):
 # ensures passed in PIL.Image is RGB
@@ -152,60 +861,134 @@ def normalize_image(image):
     return image
 
 
-def extract_image_metadata(i, img):
-# function determines image dimensions
+def extract_image_metadata(i, img, f):
+# function reads the image's dimensions and EXIF details from its headers, which
+# must happen before the image is reduced
     try:
-        i.x = img.size[0]
-        i.y = img.size[1]
+        for name, value in get_image_metadata(img, f).iteritems():
+            setattr(i, name, value)
 
     except Exception as ex:
         print("Unable to obtain metadata for image {}: {}".format(i.path, str(ex)))
 
 
-def make_thumbnail(i, img, thumb_path, thumb_prefix, thumb_postfix, thumb_aspect_ratio):
-# function generates 200px (square/ratio-maintained) thumbnail
-# NOTE: img is set to this reduced size thumbnail
+def make_thumbnail(i, img, key, options):
+# function generates a (square/ratio-maintained) thumbnail for each configured
+# size and format.  Thumbnails that already exist for the same content are reused.
     try:
-        # TODO: configurable thumb size 
-        size = (200, 200)
-        if (thumb_aspect_ratio == "square"):
-            img = ImageOps.fit(img, size, PIL.Image.ANTIALIAS)
-        elif (thumb_aspect_ratio == "top_square"):
-            x = 0
-            w = min(img.size)
-            h = w
-            
-            if (img.size[0] > img.size[1]):
-                x = int((img.size[0] - w) / 2)
-            
-            box = (x, 0, x + w, h)
-            
-            c = img.crop(box)
-            img = c.resize(size, PIL.Image.ANTIALIAS)
-        else:   # "proportional"
-            img.thumbnail(size, PIL.Image.ANTIALIAS)
+        thumbs = []
+        for s in options['sizes']:
+            targets = [(get_thumb(options['path'], key, s, f), f) for f in options['formats']]
+            thumbs.extend(t for t, f in targets)
+            if all(os.path.isfile(t) for t, f in targets):
+                continue
 
-        
-        path_parts = os.path.split(i.path)
-        name_parts = os.path.splitext(path_parts[1])
-        
-        thumb_name = thumb_prefix + name_parts[0] + thumb_postfix
-        
-        thumb = get_thumb(thumb_path, thumb_name, ".jpg")
-        
-        counter = 0
-        while os.path.isfile(thumb):
-            counter += 1
-            new_thumb_name = thumb_name + str(counter)
-            thumb = get_thumb(thumb_path, new_thumb_name, ".jpg") 
-            
-        img.save(thumb, "JPEG")
-        
-        i.thumb = thumb
+            thumb = fit_thumbnail(img, (s, s), options['aspect_ratio'])
+            for t, f in targets:
+                save_thumbnail(thumb, t, f)
+
+        i.thumb = thumbs[0]
+        i.thumb_key = key
 
     except Exception as ex:
         print("Unable to generate thumb for image {}: {}".format(i.path, str(ex)))
 
+def make_animated_thumbnail(i, img, key, options):
+# function makes a small animated thumbnail at the first configured size, from
+# at most animation_frames evenly spaced frames, each shown for as long as the
+# frames it stands in for.  Only the shrunken frames are kept as it goes, and
+# the average color is taken over all of them rather than just the first.
+    try:
+        size = options['sizes'][0]
+        path = get_animation(options['path'], key, size, options['animation_format'])
+        exists = os.path.isfile(path)
+        step = -(-max(i.frames, 1) // options['animation_frames'])
+        frames = []
+        durations = []
+        hist = [0] * 768
+        n = 0
+        for n, frame in enumerate(ImageSequence.Iterator(img), 1):
+            duration = frame.info.get('duration') or 100
+            if not (n - 1) % step == 0:
+                durations[-1] += duration
+                continue
+            rgb = frame.convert("RGB")
+            hist = [a + b for a, b in zip(hist, rgb.histogram())]
+            if not exists:
+                frames.append(fit_thumbnail(orient_image(rgb, i.orientation), (size, size), options['aspect_ratio']))
+            durations.append(duration)
+        # Pillow can't play every kind of animation, APNGs among them
+        if n < 2:
+            return
+        i.frames = n
+
+        total = sum(hist[0:256])
+        i.r, i.g, i.b = [sum(v * w for v, w in enumerate(hist[c:c+256])) / total for c in (0, 256, 512)]
+        if not exists:
+            save_animated_thumbnail(frames, durations, path, options['animation_format'])
+        i.animation = path
+
+    except Exception as ex:
+        print("Unable to generate animated thumb for image {}: {}".format(i.path, str(ex)))
+
+def save_animated_thumbnail(frames, durations, path, format):
+    d = os.path.dirname(path)
+    if not os.path.isdir(d):
+        try:
+            os.makedirs(d)
+        except OSError as ex:
+            if not ex.errno == errno.EEXIST:
+                raise
+    tmp = "{}.{}.tmp".format(path, os.getpid())
+    try:
+        if format == "webp":
+            frames[0].save(tmp, "WEBP", save_all=True, append_images=frames[1:], duration=durations, loop=0, background=(0, 0, 0, 0), quality=70, method=4)
+        else:
+            frames[0].save(tmp, "GIF", save_all=True, append_images=frames[1:], duration=durations, loop=0)
+    except Exception:
+        # Pillow leaves whatever it had written behind
+        if os.path.isfile(tmp):
+            os.remove(tmp)
+        raise
+    os.rename(tmp, path)
+
+def fit_thumbnail(img, size, aspect_ratio):
+# returns a new image of at most size, cropped according to aspect_ratio
+    if (aspect_ratio == "square"):
+        return ImageOps.fit(img, size, PIL.Image.ANTIALIAS)
+    elif (aspect_ratio == "top_square"):
+        x = 0
+        w = min(img.size)
+        h = w
+        
+        if (img.size[0] > img.size[1]):
+            x = int((img.size[0] - w) / 2)
+        
+        box = (x, 0, x + w, h)
+        
+        c = img.crop(box)
+        return c.resize(size, PIL.Image.ANTIALIAS)
+    else:   # "proportional"
+        thumb = img.copy()
+        thumb.thumbnail(size, PIL.Image.ANTIALIAS)
+        return thumb
+
+def save_thumbnail(img, path, format):
+# writes to a temporary file first, so other workers making the same thumbnail
+# never see half of one
+    d = os.path.dirname(path)
+    if not os.path.isdir(d):
+        try:
+            os.makedirs(d)
+        except OSError as ex:
+            if not ex.errno == errno.EEXIST:
+                raise
+    tmp = "{}.{}.tmp".format(path, os.getpid())
+    if format == "webp":
+        img.save(tmp, "WEBP", quality=80, method=4)
+    else:
+        img.save(tmp, "JPEG", quality=85)
+    os.rename(tmp, path)
 
 def derive_average_color(i, img):
 # function determines average color from histogram
@@ -225,6 +1008,32 @@ def derive_average_color(i, img):
     except Exception as ex:
         print("Unable to find average color for image {}: {}".format(i.path, str(ex)))
 
+def derive_perceptual_hash(i, img):
+# function computes a difference hash: a bit for each pair of neighbouring pixels
+# in a 9x8 grayscale copy of the image, set where the left one is brighter.
+# Resized or recompressed copies come out within a few bits of the original.
+    try:
+        pixels = list(img.convert("L").resize((9, 8), PIL.Image.ANTIALIAS).getdata())
+        h = 0
+        for row in range(8):
+            for col in range(8):
+                h = (h << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+        i.phash = to_signed(h)
+
+    except Exception as ex:
+        print("Unable to find perceptual hash for image {}: {}".format(i.path, str(ex)))
+
 def derive_frequent_colors(i, img, num_colors=3):
-    #lol
-    pass
+# function finds the image's most common colors and how much of it each covers,
+# by reducing a small copy of it to a palette of a few colors
+    try:
+        small = img.copy()
+        small.thumbnail((64, 64))
+        palette = small.quantize(colors=num_colors * 3, method=PIL.Image.FASTOCTREE)
+        entries = palette.getpalette()
+        counts = sorted(palette.getcolors(), reverse=True)[0:num_colors]
+        total = small.size[0] * small.size[1]
+        i.colors = format_colors([(tuple(entries[n * 3:n * 3 + 3]), int(round(100.0 * count / total))) for count, n in counts])
+
+    except Exception as ex:
+        print("Unable to find frequent colors for image {}: {}".format(i.path, str(ex)))
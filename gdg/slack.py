@@ -0,0 +1,135 @@
+import time
+import json
+import socket
+import httplib
+import threading
+import Queue
+from traceback import format_exc
+from urlparse import urlparse
+
+def print_log(message, traceback=False):
+# what's logged through when there's no cherrypy.log to use
+    print(message)
+    if traceback:
+        print(format_exc())
+
+class SlackDispatcher(object):
+# posts messages to Slack's webhooks from a few background threads, so a slash
+# command can be answered straight away.  Connections are kept alive and reused,
+# up to one per thread for each host.  A message that doesn't get through is
+# tried again, waiting twice as long each time, and dropped after retries more
+# attempts.  Only queue_size messages can be waiting at once.
+    def __init__(self, workers=2, queue_size=100, timeout=5, retries=3, retry_delay=1.0, log=print_log):
+        self.queue = Queue.Queue(queue_size)
+        self.timeout = timeout
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.log = log
+        self.max_idle = workers
+        self.lock = threading.Lock()
+        self.idle = {}
+        self.delivered = 0
+        self.dropped = 0
+        self.connections = 0
+        for n in range(workers):
+            t = threading.Thread(target=self._run, name="slack-{}".format(n))
+            t.daemon = True
+            t.start()
+
+    def send(self, url, message):
+    # queues message to be posted to url as JSON.  Returns False if the queue is full.
+        try:
+            self.queue.put_nowait((url, json.dumps(message)))
+        except Queue.Full:
+            return False
+        return True
+
+    def join(self):
+    # waits for everything queued so far to be delivered or dropped
+        self.queue.join()
+
+    def _run(self):
+        while True:
+            url, body = self.queue.get()
+            try:
+                delivered = self._deliver(url, body)
+            except Exception:
+                self.log("Something went horribly wrong sending a message to Slack.", traceback=True)
+                delivered = False
+            with self.lock:
+                if delivered:
+                    self.delivered += 1
+                else:
+                    self.dropped += 1
+            self.queue.task_done()
+
+    def _deliver(self, url, body):
+        host = urlparse(url).netloc
+        error = None
+        for attempt in range(self.retries + 1):
+            if attempt > 0:
+                time.sleep(delay)
+            delay = self.retry_delay * 2 ** attempt
+            try:
+                status, text, retry_after = self._post(url, body)
+            except (httplib.HTTPException, socket.error) as e:
+                error = str(e) or e.__class__.__name__
+                continue
+            if status < 300:
+                return True
+            error = "{} {}".format(status, text)
+            if status == 429 or status >= 500:
+                # Slack says how long to back off for when it's rate limiting
+                if retry_after and retry_after.isdigit():
+                    delay = max(delay, min(int(retry_after), 60))
+                continue
+            # Anything else is the message's or the webhook's fault, no use trying again
+            break
+        # The webhook's URL is its password, so only the host is logged
+        self.log("Gave up on a message to {} after {} attempts: {}".format(host, attempt + 1, error))
+        return False
+
+    def _post(self, url, body):
+    # (status, body, Retry-After) of the response to posting body to url
+        p = urlparse(url)
+        key = (p.scheme, p.netloc)
+        path = (p.path or '/') + ('?' + p.query if p.query else '')
+        while True:
+            con, reused = self._get_connection(key)
+            try:
+                con.request("POST", path, body, { 'Content-Type': "application/json" })
+                response = con.getresponse()
+                text = response.read()
+            except (httplib.HTTPException, socket.error) as e:
+                con.close()
+                # The other end closes connections that sit idle for long
+                # enough, which shouldn't count as an attempt.  A timeout
+                # might have been delivered all the same, so it does.
+                if reused and not isinstance(e, socket.timeout):
+                    continue
+                raise
+            if response.will_close:
+                con.close()
+            else:
+                self._release_connection(key, con)
+            return response.status, text[0:200], response.getheader('Retry-After')
+
+    def _get_connection(self, key):
+    # an idle connection to the host, or a new one, and whether it was idle
+        with self.lock:
+            idle = self.idle.get(key)
+            if idle:
+                return idle.pop(), True
+            self.connections += 1
+        scheme, netloc = key
+        if scheme == 'https':
+            return httplib.HTTPSConnection(netloc, timeout=self.timeout), False
+        return httplib.HTTPConnection(netloc, timeout=self.timeout), False
+
+    def _release_connection(self, key, con):
+        with self.lock:
+            idle = self.idle.setdefault(key, [])
+            if len(idle) < self.max_idle:
+                idle.append(con)
+                return
+        con.close()
@@ -0,0 +1,93 @@
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
+import PIL
+from gdg.data import thumb_extensions
+from gdg.scrape import reduce_image, normalize_image, fit_thumbnail, save_thumbnail
+from gdg.metadata import get_exif, get_orientation, orient_image
+
+def render_thumbnail(source, dest, size, format, aspect_ratio, draft=True):
+    if os.path.isfile(dest):
+        return
+    image = PIL.Image.open(source)
+    orientation = get_orientation(get_exif(image))
+    if draft:
+        image = reduce_image(image, (size, size))
+    image = normalize_image(image)
+    image = orient_image(image, orientation)
+    save_thumbnail(fit_thumbnail(image, (size, size), aspect_ratio), dest, format)
+
+class ThumbnailCache(object):
+# renders thumbnails on request into a directory capped at max_bytes, evicting
+# the least recently used ones once it fills up.  Renders run in a small pool of
+# threads, and concurrent requests for the same thumbnail share one render.
+    def __init__(self, path, max_bytes, workers=2, timeout=30):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.pool = ThreadPool(workers)
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.entries = OrderedDict()
+        self.total = 0
+        self._load()
+
+    def _load(self):
+    # picks up whatever a previous run left behind, oldest first
+        found = []
+        for root, dirs, files in os.walk(self.path):
+            for f in files:
+                if f.endswith('.tmp'):
+                    continue
+                p = os.path.join(root, f)
+                try:
+                    st = os.stat(p)
+                except OSError:
+                    continue
+                found.append((st.st_mtime, p, st.st_size))
+        found.sort()
+        with self.lock:
+            for mtime, p, size in found:
+                self._add(p, size)
+
+    def _add(self, path, size):
+        self.entries[path] = size
+        self.total += size
+        while self.total > self.max_bytes and len(self.entries) > 1:
+            old, old_size = self.entries.popitem(last=False)
+            self.total -= old_size
+            try:
+                os.remove(old)
+            except OSError:
+                pass
+
+    def get(self, source, size, format, aspect_ratio, draft=True):
+    # returns the path of the rendered thumbnail and a key that changes whenever
+    # the source file or the thumbnail settings do.  Raises TimeoutError if the
+    # render takes too long.
+        st = os.stat(source)
+        key = hashlib.sha1("{}:{}:{}:{}:{}:{}".format(source.encode('utf-8') if isinstance(source, unicode) else source, st.st_mtime, st.st_size, size, format, aspect_ratio)).hexdigest()
+        path = os.path.join(self.path, key[0:2], key + thumb_extensions[format])
+
+        with self.lock:
+            if path in self.entries:
+                # Most recently used goes to the back of the line
+                self.entries[path] = self.entries.pop(path)
+                return path, key
+            result = self.pending.get(path)
+            if result == None:
+                result = self.pool.apply_async(render_thumbnail, (source, path, size, format, aspect_ratio, draft))
+                self.pending[path] = result
+
+        try:
+            result.get(self.timeout)
+        finally:
+            with self.lock:
+                if self.pending.get(path) is result and result.ready():
+                    del self.pending[path]
+                    if os.path.isfile(path) and not path in self.entries:
+                        self._add(path, os.path.getsize(path))
+        return path, key
@@ -0,0 +1,152 @@
+import os
+import stat
+import fnmatch
+import mimetypes
+from multiprocessing.pool import ThreadPool
+
+# Python 3.5 has os.scandir, Python 2 needs the scandir package for it.  Without
+# either every entry is stat()ed to find the directories.
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+mimetypes.init()
+# Anything mimetypes calls an image, by extension, so files are sorted out
+# without a lookup each
+image_extensions = frozenset(ext for ext, t in mimetypes.types_map.iteritems() if t.startswith('image/'))
+
+def is_image(file):
+    return os.path.splitext(file)[1].lower() in image_extensions
+
+class Exclusions(object):
+# decides which files and directories the scraper leaves alone.  Patterns with
+# a / in them are matched against the path under root, the rest against the
+# name alone, so ".git" skips every .git and "2019/raw" only that one.  Paths
+# are excluded outright, along with everything under them.
+    def __init__(self, root, patterns=(), paths=()):
+        self.root = root
+        self.names = [p for p in patterns if not '/' in p]
+        self.relative = [p.strip('/') for p in patterns if '/' in p]
+        self.paths = set(os.path.abspath(p) for p in paths)
+
+    def __call__(self, path):
+        if path in self.paths:
+            return True
+        name = os.path.basename(path)
+        if any(fnmatch.fnmatchcase(name, p) for p in self.names):
+            return True
+        if len(self.relative) > 0:
+            rel = os.path.relpath(path, self.root)
+            return any(fnmatch.fnmatchcase(rel, p) for p in self.relative)
+        return False
+
+    def under(self, path):
+    # whether path or any directory it's in, up to root, is excluded
+        while len(path) > len(self.root) and path.startswith(self.root):
+            if self(path):
+                return True
+            path = os.path.dirname(path)
+        return False
+
+def list_entries(path, follow_links):
+# (key, path, stat) for the directories and images in path, stat being None for
+# directories.  Directories get "name/" as their key, see get_image_files.
+    entries = []
+    if scandir == None:
+        for name in os.listdir(path):
+            full = os.path.join(path, name)
+            try:
+                st = os.stat(full)
+            except OSError:
+                continue
+            if stat.S_ISDIR(st.st_mode):
+                if follow_links or not os.path.islink(full):
+                    entries.append((name + '/', full, None))
+            elif is_image(name):
+                entries.append((name, full, st))
+        return entries
+    for entry in scandir(path):
+        try:
+            if entry.is_dir():
+                if follow_links or not entry.is_symlink():
+                    entries.append((entry.name + '/', entry.path, None))
+            elif is_image(entry.name):
+                entries.append((entry.name, entry.path, entry.stat()))
+        except OSError:
+            continue
+    return entries
+
+def list_directory(path, follow_links, skip, exclude, ancestors):
+# runs on one of the walker's threads.  Returns the sorted entries of path and
+# the (dev, inode) of it and the directories above it, by which links back up
+# the tree are caught.
+    try:
+        st = os.stat(path)
+    except OSError:
+        return [], ancestors
+    if (st.st_dev, st.st_ino) in ancestors:
+        print("Skipping {}, it's a goddamn loop back to {}.".format(path, ancestors[(st.st_dev, st.st_ino)]))
+        return [], ancestors
+    ancestors = dict(ancestors)
+    ancestors[(st.st_dev, st.st_ino)] = path
+
+    subdirs = skip(path, st) if skip else None
+    if subdirs == None:
+        try:
+            entries = list_entries(path, follow_links)
+        except OSError:
+            return [], ancestors
+    else:
+        entries = [(os.path.basename(d) + '/', d, None) for d in subdirs]
+    if exclude:
+        entries = [e for e in entries if not exclude(e[1])]
+    entries.sort()
+    return entries, ancestors
+
+def wait(result):
+# AsyncResult.get() cannot be interrupted on Python 2 unless it has a timeout
+    while not result.ready():
+        result.wait(1)
+    return result.get()
+
+def get_image_files(path, follow_links=True, skip=None, exclude=None, threads=8, ahead=None):
+# yields (path, stat) for image files under path, in sorted order of their full
+# paths.  Directories sort as "name/" so that the output matches the database's
+# ORDER BY path, which lets the scraper merge the two without holding either
+# listing in memory.
+# skip is called with each directory and its stat before it is listed.  If it
+# returns a list of subdirectories, the directory's own files are assumed to be
+# unchanged and only those subdirectories are visited.  It's called from the
+# walker's threads.  exclude is called with each path found, see Exclusions.
+# Directories are listed on a pool of threads, each a few of its siblings ahead
+# of the one being yielded from, which keeps a slow disk busy without holding
+# much more than the current directories in memory.
+    ahead = threads * 2 if ahead == None else ahead
+    pool = ThreadPool(threads)
+    try:
+        list_args = (follow_links, skip, exclude)
+        for f in walk_listing(pool, pool.apply_async(list_directory, (path,) + list_args + ({},)), list_args, ahead):
+            yield f
+    finally:
+        pool.terminate()
+
+def walk_listing(pool, listing, list_args, ahead):
+    entries, ancestors = wait(listing)
+    subdirs = [full for key, full, st in entries if st == None]
+    listings = {}
+    queued = visited = 0
+    for key, full, st in entries:
+        if not st == None:
+            yield full, st
+            continue
+        # Keep the next few directories at this level listing in the background
+        while queued < len(subdirs) and queued < visited + ahead:
+            listings[subdirs[queued]] = pool.apply_async(list_directory, (subdirs[queued],) + list_args + (ancestors,))
+            queued += 1
+        visited += 1
+        for f in walk_listing(pool, listings.pop(full), list_args, ahead):
+            yield f
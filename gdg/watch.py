@@ -0,0 +1,151 @@
+import os
+import sys
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+
+# From <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_ONLYDIR
+
+event_header = struct.Struct('iIII')
+
+fs_encoding = sys.getfilesystemencoding() or 'utf-8'
+
+class Event(object):
+    def __init__(self, path, mask, cookie):
+        self.path = path
+        self.mask = mask
+        self.cookie = cookie
+
+    @property
+    def is_dir(self):
+        return bool(self.mask & IN_ISDIR)
+
+    def __repr__(self):
+        return "Event({!r}, {:#x}, {})".format(self.path, self.mask, self.cookie)
+
+class Inotify(object):
+# a minimal ctypes binding to Linux's inotify, watching directories recursively.
+# Raises OSError if inotify isn't available on this system.
+    def __init__(self):
+        name = ctypes.util.find_library('c')
+        if name == None:
+            raise OSError(errno.ENOSYS, "Unable to find the C library")
+        self.libc = ctypes.CDLL(name, use_errno=True)
+        if not hasattr(self.libc, 'inotify_init'):
+            raise OSError(errno.ENOSYS, "inotify is not available on this system")
+        self.fd = self.libc.inotify_init()
+        if self.fd < 0:
+            self._raise()
+        self.paths = {}
+        self.watches = {}
+
+    def _raise(self, path=None):
+        e = ctypes.get_errno()
+        raise OSError(e, os.strerror(e), path)
+
+    def add_watch(self, path):
+        if isinstance(path, unicode):
+            wd = self.libc.inotify_add_watch(self.fd, path.encode(fs_encoding), WATCH_MASK)
+        else:
+            wd = self.libc.inotify_add_watch(self.fd, path, WATCH_MASK)
+        if wd < 0:
+            self._raise(path)
+        self.paths[wd] = path
+        self.watches[path] = wd
+
+    def add_tree(self, path, follow_links=True, exclude=None):
+    # watches path and every directory below it that isn't excluded, returning the
+    # directories found.  A directory reached through more than one link is only
+    # watched once, which also stops links back up the tree going around forever.
+        found = []
+        seen = set()
+        for root, dirs, files in os.walk(path, followlinks=follow_links):
+            try:
+                st = os.stat(root)
+            except OSError:
+                dirs[:] = []
+                continue
+            if (st.st_dev, st.st_ino) in seen:
+                dirs[:] = []
+                continue
+            seen.add((st.st_dev, st.st_ino))
+            if exclude:
+                dirs[:] = [d for d in dirs if not exclude(os.path.join(root, d))]
+            try:
+                self.add_watch(root)
+                found.append(root)
+            except OSError as ex:
+                if ex.errno == errno.ENOSPC:
+                    raise
+        return found
+
+    def remove_tree(self, path):
+        for p in self._under(path):
+            wd = self.watches.pop(p)
+            self.paths.pop(wd, None)
+            self.libc.inotify_rm_watch(self.fd, wd)
+
+    def move_tree(self, old, new):
+    # watches follow the directory, only the paths they report need updating
+        for p in self._under(old):
+            wd = self.watches.pop(p)
+            p = new + p[len(old):]
+            self.paths[wd] = p
+            self.watches[p] = wd
+
+    def _under(self, path):
+        prefix = path + '/'
+        return [p for p in self.watches if p == path or p.startswith(prefix)]
+
+    def read(self, timeout=None):
+    # waits up to timeout seconds for events, returning a list of Event.  An
+    # Event with IN_Q_OVERFLOW set means some events were lost.
+        try:
+            ready, _, _ = select.select([self.fd], [], [], timeout)
+        except select.error as ex:
+            if ex.args[0] == errno.EINTR:
+                return []
+            raise
+        if len(ready) == 0:
+            return []
+        buf = os.read(self.fd, 65536)
+        events = []
+        offset = 0
+        while offset < len(buf):
+            wd, mask, cookie, length = event_header.unpack_from(buf, offset)
+            offset += event_header.size
+            name = buf[offset:offset + length].rstrip('\0')
+            try:
+                name = name.decode(fs_encoding)
+            except UnicodeDecodeError:
+                pass
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                events.append(Event(None, mask, cookie))
+                continue
+            if mask & IN_IGNORED:
+                path = self.paths.pop(wd, None)
+                if not path == None and self.watches.get(path) == wd:
+                    del self.watches[path]
+                continue
+            root = self.paths.get(wd)
+            if root == None:
+                continue
+            events.append(Event(os.path.join(root, name) if name else root, mask, cookie))
+        return events
+
+    def close(self):
+        os.close(self.fd)
@@ -1,5 +1,19 @@
 #!/usr/bin/env python2
-from gdg.scrape import scrape_images
+import argparse
+from gdg.scrape import scrape_images, watch_images, report_duplicates, retry_images
 
 if __name__ == '__main__':
-    scrape_images()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Finds new images and generates their thumbnails.")
+    parser.add_argument('--full', action='store_true', help="list every directory, even ones that haven't changed since the last scan")
+    parser.add_argument('--watch', action='store_true', help="keep running and pick up changes as they happen")
+    parser.add_argument('--retry', action='store_true', help="try images that failed too many times again")
+    parser.add_argument('--duplicates', action='store_true', help="list groups of images that look the same instead of scraping")
+    args = parser.parse_args()
+    if args.duplicates:
+        report_duplicates()
+    elif args.retry:
+        retry_images()
+    elif args.watch:
+        watch_images()
+    else:
+        scrape_images(full=args.full)